@@ -1,6 +1,11 @@
-import decode.evaluation.evaluation
-import decode.evaluation.match_emittersets
-import decode.evaluation.metric
-import decode.evaluation.utils
+from decode.utils.lazy import lazy_package
 
-from decode.evaluation.evaluation import DistanceEvaluation, SegmentationEvaluation, SMLMEvaluation
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['evaluation', 'match_emittersets', 'metric', 'predict_dist', 'utils'],
+    attributes={
+        'DistanceEvaluation': 'evaluation',
+        'IncrementalSMLMEvaluation': 'evaluation',
+        'SegmentationEvaluation': 'evaluation',
+        'SMLMEvaluation': 'evaluation',
+    })
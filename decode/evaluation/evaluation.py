@@ -1,6 +1,7 @@
 # from abc import ABC
 import warnings
 from collections import namedtuple
+from typing import Tuple
 
 import matplotlib.pyplot as plt
 import scipy.stats
@@ -143,6 +144,42 @@ class WeightedErrors:
             raise ValueError(f"Reduction type {self.reduction} not implemented. Available reduction types"
                              f"are {self._reduction_all}.")
 
+    def weighted_deviations(self, tp: EmitterSet, ref: EmitterSet) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Deviations of the true positives to the reference weighted as by the mode (not reduced).
+
+        Args:
+            tp (EmitterSet): true positives
+            ref (EmitterSet): matching ground truth
+
+        Returns:
+            dxyz_w (N x 3), dphot_w (N), dbg_w (N)
+
+        """
+        dxyz = tp.xyz_nm - ref.xyz_nm
+        dphot = tp.phot - ref.phot
+        dbg = tp.bg - ref.bg
+
+        if self.mode == 'phot':
+            """Definition of the 0st / 1st order approximations for the sqrt cramer rao"""
+            xyz_scr_est = 1 / ref.phot.unsqueeze(1).sqrt()
+            phot_scr_est = ref.phot.sqrt()
+            bg_scr_est = ref.bg.sqrt()
+
+            dxyz_w = dxyz / xyz_scr_est
+            dphot_w = dphot / phot_scr_est
+            dbg_w = dbg / bg_scr_est
+
+        elif self.mode == 'crlb':
+            dxyz_w = dxyz / ref.xyz_scr_nm
+            dphot_w = dphot / ref.phot_scr
+            dbg_w = dbg / ref.bg_scr
+
+        else:
+            raise ValueError
+
+        return dxyz_w, dphot_w, dbg_w
+
     @staticmethod
     def _reduce(dxyz: torch.Tensor, dphot: torch.Tensor, dbg: torch.Tensor, reduction):
         """
@@ -241,27 +278,7 @@ class WeightedErrors:
         if len(tp) != len(ref):
             raise ValueError(f"Size of true positives ({len(tp)}) does not match size of reference ({len(ref)}).")
 
-        dxyz = tp.xyz_nm - ref.xyz_nm
-        dphot = tp.phot - ref.phot
-        dbg = tp.bg - ref.bg
-
-        if self.mode == 'phot':
-            """Definition of the 0st / 1st order approximations for the sqrt cramer rao"""
-            xyz_scr_est = 1 / ref.phot.unsqueeze(1).sqrt()
-            phot_scr_est = ref.phot.sqrt()
-            bg_scr_est = ref.bg.sqrt()
-
-            dxyz_w = dxyz / xyz_scr_est
-            dphot_w = dphot / phot_scr_est
-            dbg_w = dbg / bg_scr_est
-
-        elif self.mode == 'crlb':
-            dxyz_w = dxyz / ref.xyz_scr_nm
-            dphot_w = dphot / ref.phot_scr
-            dbg_w = dbg / ref.bg_scr
-
-        else:
-            raise ValueError
+        dxyz_w, dphot_w, dbg_w = self.weighted_deviations(tp, ref)
 
         if plot:
             _ = self.plot_error(dxyz_w, dphot_w, dbg_w, axes=axes)
@@ -405,3 +422,106 @@ class SMLMEvaluation:
                             dy_red_mu=dy_red[0], dy_red_sig=dy_red[1],
                             dz_red_mu=dz_red[0], dz_red_sig=dz_red[1],
                             dphot_red_mu=weight_out.dphot_red[0].item(), dphot_red_sig=weight_out.dphot_red[1].item())
+
+
+class IncrementalSMLMEvaluation:
+    """
+    Evaluates emitters batch by batch. Only the counts of true positives, false positives and false negatives as well as
+    the sums (of squares) of the deviations are accumulated, i.e. the emitters are not kept. The result equals
+    SMLMEvaluation on all emitters at once (the gaussian fit of the weighted deviations is the maximum likelihood
+    estimate, i.e. mean and biased standard deviation).
+
+    Example:
+        >>> evaluation = IncrementalSMLMEvaluation()
+        >>> for tp, fp, fn, tp_match in batches:
+        >>>     evaluation.update(tp, fp, fn, tp_match)
+        >>> result = evaluation.compute()
+
+    """
+    alpha_lat = SMLMEvaluation.alpha_lat
+    alpha_ax = SMLMEvaluation.alpha_ax
+
+    def __init__(self, weighted_eval=WeightedErrors(mode='crlb', reduction='gaussian')):
+        self.weighted_eval = weighted_eval
+        self.reset()
+
+    def reset(self):
+        self.n_tp = 0
+        self.n_fp = 0
+        self.n_fn = 0
+
+        self._sq_sum = torch.zeros(3, dtype=torch.float64)  # sum of squared deviations in x, y, z
+        self._abs_sum = torch.zeros(3, dtype=torch.float64)  # sum of absolute deviations in x, y, z
+        self._w_sum = torch.zeros(5, dtype=torch.float64)  # sum of weighted deviations in x, y, z, phot, bg
+        self._w_sq_sum = torch.zeros(5, dtype=torch.float64)
+
+    def update(self, tp: EmitterSet, fp: EmitterSet, fn: EmitterSet, tp_match: EmitterSet):
+        """
+        Accumulate a batch of matched emitters.
+
+        Args:
+            tp: true positives
+            fp: false positives
+            fn: false negatives
+            tp_match: ground truth matched to the true positives
+
+        """
+        if len(tp) != len(tp_match):
+            raise ValueError(f"Size of true positives ({len(tp)}) does not match size of reference ({len(tp_match)}).")
+
+        self.n_tp += len(tp)
+        self.n_fp += len(fp)
+        self.n_fn += len(fn)
+
+        if len(tp) == 0:
+            return
+
+        dxyz = (tp.xyz_nm - tp_match.xyz_nm).double()
+        self._sq_sum += (dxyz ** 2).sum(0)
+        self._abs_sum += dxyz.abs().sum(0)
+
+        dxyz_w, dphot_w, dbg_w = self.weighted_eval.weighted_deviations(tp, tp_match)
+        d_w = torch.cat((dxyz_w, dphot_w.unsqueeze(1), dbg_w.unsqueeze(1)), 1).double()
+        self._w_sum += d_w.sum(0)
+        self._w_sq_sum += (d_w ** 2).sum(0)
+
+    def compute(self) -> SMLMEvaluation._return:
+        """
+        Evaluate what has been accumulated so far.
+
+        Returns:
+            namedtuple: see SMLMEvaluation.forward
+
+        """
+        prec, rec, jac, f1 = precision_recall_jaccard(self.n_tp, self.n_fp, self.n_fn)
+
+        n = self.n_tp
+        if n == 0:
+            rmse_lat, rmse_ax, rmse_vol, mad_lat, mad_ax, mad_vol = (float('nan'),) * 6
+            w_mu = w_sig = torch.full((5, ), float('nan'), dtype=torch.float64)
+
+        else:
+            # same definitions as in metric.rmse_mad_dist
+            rmse_lat = ((self._sq_sum[:2].sum() / n) ** 0.5).item()
+            rmse_ax = ((self._sq_sum[2] / n) ** 0.5).item()
+            rmse_vol = ((self._sq_sum.sum() / n) ** 0.5).item()
+            mad_lat = (self._abs_sum[:2].sum() / n).item()
+            mad_ax = (self._abs_sum[2] / n).item()
+            mad_vol = (self._abs_sum.sum() / n).item()
+
+            w_mu = self._w_sum / n
+            w_sig = (self._w_sq_sum / n - w_mu ** 2).clamp(min=0.).sqrt()
+            if self.weighted_eval.reduction == 'mstd':  # unbiased as torch.std
+                w_sig = w_sig * (n / (n - 1)) ** 0.5 if n >= 2 else torch.full_like(w_sig, float('nan'))
+
+        effcy_lat = efficiency(jac, rmse_lat, self.alpha_lat)
+        effcy_ax = efficiency(jac, rmse_ax, self.alpha_ax)
+
+        return SMLMEvaluation._return(prec=prec, rec=rec, jac=jac, f1=f1,
+                                      effcy_lat=effcy_lat, effcy_ax=effcy_ax, effcy_vol=(effcy_lat + effcy_ax) / 2,
+                                      rmse_lat=rmse_lat, rmse_ax=rmse_ax, rmse_vol=rmse_vol,
+                                      mad_lat=mad_lat, mad_ax=mad_ax, mad_vol=mad_vol,
+                                      dx_red_mu=w_mu[0].item(), dx_red_sig=w_sig[0].item(),
+                                      dy_red_mu=w_mu[1].item(), dy_red_sig=w_sig[1].item(),
+                                      dz_red_mu=w_mu[2].item(), dz_red_sig=w_sig[2].item(),
+                                      dphot_red_mu=w_mu[3].item(), dphot_red_sig=w_sig[3].item())
@@ -1,3 +1,11 @@
-import decode.generic.emitter
+from decode.utils.lazy import lazy_package
 
-from decode.generic.emitter import EmitterSet, CoordinateOnlyEmitter, RandomEmitterSet, EmptyEmitterSet
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['emitter', 'process', 'slicing', 'test_utils', 'utils'],
+    attributes={
+        'EmitterSet': 'emitter',
+        'CoordinateOnlyEmitter': 'emitter',
+        'RandomEmitterSet': 'emitter',
+        'EmptyEmitterSet': 'emitter',
+    })
@@ -1,16 +1,10 @@
-import decode.neuralfitter.dataset
-import decode.neuralfitter.de_bias
-import decode.neuralfitter.em_filter
-import decode.neuralfitter.frame_processing
-import decode.neuralfitter.loss
-import decode.neuralfitter.models
-import decode.neuralfitter.coord_transform
-import decode.neuralfitter.post_processing
-import decode.neuralfitter.utils.processing
-import decode.neuralfitter.scale_transform
-import decode.neuralfitter.weight_generator
-import decode.neuralfitter.train_val_impl
-import decode.neuralfitter.train
-import decode.neuralfitter.inference
+from decode.utils.lazy import lazy_package
 
-from decode.neuralfitter.inference.inference import Infer
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['coord_transform', 'dataset', 'de_bias', 'em_filter', 'frame_processing', 'inference', 'loss',
+                'models', 'post_processing', 'sampling', 'scale_transform', 'target_generator', 'train',
+                'train_val_impl', 'utils', 'weight_generator'],
+    attributes={
+        'Infer': 'inference.inference',
+    })
@@ -16,6 +16,9 @@ class Offset2Coordinate:
             yextent (tuple): extent in y
             img_shape (tuple): image shape
         """
+        self.xextent = xextent
+        self.yextent = yextent
+        self.img_shape = img_shape
 
         off_psf = UnifiedEmbeddingTarget(xextent=xextent,
                                          yextent=yextent,
@@ -1,9 +1,12 @@
 import time
+from pathlib import Path
+from typing import Optional, Union
 
 import torch
 from torch.utils.data import Dataset
 
 from decode.generic import emitter
+from decode.neuralfitter.utils import dataset_cache, shared_store
 
 
 class SMLMDataset(Dataset):
@@ -211,6 +214,10 @@ class SMLMLiveDataset(SMLMStaticDataset):
     A SMLM dataset where new datasets is sampleable via the sample() method of the simulation instance.
     The final processing on frame, emitters and target is done online.
 
+    The sampled frames, background frames and emitters are kept in shared memory (see SharedSampleStore), i.e.
+    (persistent) dataloader workers read them zero-copy and see a new sample without being restarted, unless the
+    store had to be reallocated (store.generation changes).
+
     """
 
     def __init__(self, *, simulator, em_proc, frame_proc, bg_frame_proc, tar_gen, weight_gen, frame_window, pad,
@@ -222,6 +229,7 @@ class SMLMLiveDataset(SMLMStaticDataset):
                          frame_window=frame_window, pad=pad, return_em=return_em)
 
         self.simulator = simulator
+        self.store = None  # created on the first sample, such that subclasses with their own storage do not hold one
         self._bg_frames = None
 
     def sanity_check(self):
@@ -239,23 +247,78 @@ class SMLMLiveDataset(SMLMStaticDataset):
 
         """
 
-        def set_frame_ix(em):  # helper function
-            em.frame_ix = torch.zeros_like(em.frame_ix)
-            return em
-
         """Sample new dataset."""
         t0 = time.time()
         emitter, frames, bg_frames = self.simulator.sample()
         if verbose:
             print(f"Sampled dataset in {time.time() - t0:.2f}s. {len(emitter)} emitters on {frames.size(0)} frames.")
 
-        """Split Emitters into list of emitters (per frame) and set frame_ix to 0."""
-        emitter = emitter.split_in_frames(0, frames.size(0) - 1)
-        emitter = [set_frame_ix(em) for em in emitter]
+        """Copy into shared memory, emitters are split by frame on access."""
+        self._set_store(frames, bg_frames, emitter)
 
-        self._emitter = emitter
-        self._frames = frames.cpu()
-        self._bg_frames = bg_frames.cpu()
+    def _set_store(self, frames, bg_frames, emitter):
+        if self.store is None:
+            self.store = shared_store.SharedSampleStore()
+
+        self.store.update(frames, bg_frames, emitter)
+        self._frames = self.store.frames
+        self._bg_frames = self.store.bg_frames
+
+    def save_sample(self, path: Union[str, Path]):
+        """
+        Stores the current (unprocessed) sample, e.g. to resume training without re-simulation.
+
+        Args:
+            path: folder
+
+        """
+        # background frames in place of the target, the live dataset computes the target on access
+        dataset_cache.save_sample(path, self.store.frames, self.store.bg_frames, None, self.store.get_emitter_set(),
+                                  overwrite=True)
+
+    def load_sample(self, path: Union[str, Path]) -> bool:
+        """
+        Loads a sample stored by save_sample.
+
+        Args:
+            path: folder
+
+        Returns:
+            bool: whether there was a sample to load
+
+        """
+        cached = dataset_cache.load_sample(path)
+        if cached is None:
+            return False
+
+        frames, bg_frames, _, emitter = cached
+        self._set_store(frames, bg_frames, emitter)
+        return True
+
+    def __getitem__(self, ix):
+        """
+        Get a training sample.
+
+        Args:
+            ix (int): index
+
+        Returns:
+            frames (torch.Tensor): processed frames. C x H x W
+            tar (torch.Tensor): target
+            em_tar (optional): Ground truth emitters
+
+        """
+
+        """Pad index, get frames and emitters (frame index set to 0)."""
+        ix = self._pad_index(ix)
+
+        tar_emitter = self.store.get_emitter(ix)
+        frames = self._get_frames(self._frames, ix)
+        bg_frame = self._bg_frames[ix].clone() if self._bg_frames is not None else None
+
+        frames, target, weight, tar_emitter = self._process_sample(frames, tar_emitter, bg_frame)
+
+        return self._return_sample(frames, target, weight, tar_emitter)
 
 
 class SMLMAPrioriDataset(SMLMLiveDataset):
@@ -296,22 +359,42 @@ class SMLMAPrioriDataset(SMLMLiveDataset):
         else:
             raise ValueError
 
-    def sample(self, verbose: bool = False):
+    def sample(self, verbose: bool = False, seed: Optional[int] = None, cache: Optional[Union[str, Path]] = None):
         """
         Sample new dataset and process them instantaneously.
 
         Args:
             verbose:
+            seed: sample with this seed (the global random state is left untouched)
+            cache: folder in which the processed sample is stored. If it already holds a sample, it is (memory-mapped)
+                loaded instead of sampled. The caller is responsible that the folder is specific to the simulation
+                parameters and seed (see decode.neuralfitter.utils.dataset_cache.test_set_key).
 
         """
         t0 = time.time()
-        emitter, frames, bg_frames = self.simulator.sample()
+        if cache is not None:
+            cached = dataset_cache.load_sample(cache)
+            if cached is not None:
+                if verbose:
+                    print(f"Loaded dataset from cache {cache} in {time.time() - t0:.2f}s.")
+                self._set_sample(*cached)
+                return
+
+        with dataset_cache.seeded(seed):
+            emitter, frames, bg_frames = self.simulator.sample()
 
         if verbose:
             print(f"Sampled dataset in {time.time() - t0:.2f}s. {len(emitter)} emitters on {frames.size(0)} frames.")
 
         frames, target, weight, tar_emitter = self._process_sample(frames, emitter, bg_frames)
-        self._frames = frames.cpu()
+        frames = frames.cpu()
+        if cache is not None:
+            dataset_cache.save_sample(cache, frames, target, weight, tar_emitter)
+
+        self._set_sample(frames, target, weight, tar_emitter)
+
+    def _set_sample(self, frames, target, weight, tar_emitter):
+        self._frames = frames
         self._emitter = tar_emitter
         self._em_split = tar_emitter.split_in_frames(0, frames.size(0) - 1)
         self._target, self._weight = target, weight
@@ -1 +1,8 @@
-import decode.neuralfitter.inference.inference
+from decode.utils.lazy import lazy_package
+
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['export', 'inference', 'pred_tif', 'quantization'],
+    attributes={
+        'Infer': 'inference',
+    })
@@ -0,0 +1,310 @@
+import copy
+import pathlib
+from typing import Union, Tuple, List
+
+import torch
+import torch.nn.functional as F
+
+from .. import coord_transform
+from .. import post_processing
+from .. import scale_transform
+from ..utils import processing
+from ...generic import emitter
+
+
+class InferenceGraph(torch.nn.Module):
+    __jit_unused_properties__ = ['frame_size']
+
+    def __init__(self, model: torch.nn.Module, rescale: scale_transform.InverseParamListRescale,
+                 coord: coord_transform.Offset2Coordinate, post_proc: post_processing.LookUpPostProcessing):
+        """
+        Model and the tensor part of the post-processing (InverseParamListRescale, Offset2Coordinate and
+        LookUpPostProcessing / SpatialIntegration) as one module that maps frame windows to flat localization tensors,
+        such that it can be scripted and saved as a single graph (see export). Rescaling and conversion of the
+        sub-pixel offsets are applied as one affine transformation of the model output. The pixel centres are computed for
+        the size of the input, with origin and pixel size of the coordinate conversion, i.e. the graph is not limited
+        to the frame size of the coordinate conversion. Frame pre-processing is not part of the graph.
+
+        Args:
+            model: model in eval mode (or traced model)
+            rescale: inverse rescaling of the model output
+            coord: conversion of sub-pixel offsets to coordinates
+            post_proc: look-up post-processing, with non-maximum suppression if SpatialIntegration
+
+        """
+        super().__init__()
+
+        if type(post_proc) not in (post_processing.LookUpPostProcessing, post_processing.SpatialIntegration):
+            raise TypeError(f"Post-processing {type(post_proc).__name__} is not supported in the graph.")
+
+        self.model = model
+
+        """Scale and offset per channel (channel order of the model output)"""
+        ch_out = 10
+        scale = torch.ones(ch_out)
+        scale[[1, 5]] = rescale.phot_max
+        scale[[4, 8]] = rescale.z_max
+        scale[-1] = rescale.bg_max
+
+        """Pixel size and centre of the first pixel in x and y"""
+        px_size = torch.tensor([(coord.xextent[1] - coord.xextent[0]) / coord.img_shape[0],
+                                (coord.yextent[1] - coord.yextent[0]) / coord.img_shape[1]])
+        px_origin = torch.tensor([coord.xextent[0], coord.yextent[0]]) + px_size / 2
+
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('px_step', px_size)
+        self.register_buffer('px_origin', px_origin)
+        self._frame_size = tuple(coord.img_shape)
+
+        """Look-up"""
+        self.raw_th = float(post_proc.raw_th)
+        mapping = [ix % ch_out for ix in post_proc.pphotxyzbg_mapping]
+        self.p_ch = mapping[0]
+        self.register_buffer('feature_ix', torch.tensor(mapping[1:]))
+
+        self.has_sigma = post_proc.photxyz_sigma_mapping is not None
+        sigma_mapping = post_proc.photxyz_sigma_mapping if self.has_sigma else (0, 0, 0, 0)
+        self.register_buffer('sigma_ix', torch.tensor([ix % ch_out for ix in sigma_mapping]))
+
+        """Non-Maximum Suppression (only for SpatialIntegration)"""
+        self.nms = isinstance(post_proc, post_processing.SpatialIntegration)
+        self.p_aggregation = self._p_aggregation_str(post_proc.p_aggregation) if self.nms else 'norm_sum'
+        self.split_th = float(post_processing.SpatialIntegration._split_th)
+        self.register_buffer('nms_filter', torch.tensor([[0., 1., 0.], [1., 1., 1.], [0., 1., 0.]]).view(1, 1, 3, 3))
+
+        """Meta for the conversion of the output to an EmitterSet"""
+        self.xy_unit: str = post_proc.xy_unit if post_proc.xy_unit is not None else ''
+        self.px_size: List[float] = [float(p) for p in post_proc.px_size] if post_proc.px_size is not None else []
+
+    @classmethod
+    def parse(cls, model: torch.nn.Module, param):
+        """
+        Graph with the post-processing as set up in training (PostProcessing 'LookUp' or 'NMS').
+
+        Args:
+            model: model (weights loaded)
+            param: parameters
+
+        """
+        rescale = scale_transform.InverseParamListRescale.parse(param)
+        coord = coord_transform.Offset2Coordinate.parse(param)
+
+        if param.PostProcessing == 'LookUp':
+            post_proc = post_processing.LookUpPostProcessing(raw_th=param.PostProcessingParam.raw_th,
+                                                             pphotxyzbg_mapping=[0, 1, 2, 3, 4, -1],
+                                                             xy_unit='px', px_size=param.Camera.px_size)
+        elif param.PostProcessing == 'NMS':
+            post_proc = post_processing.SpatialIntegration(raw_th=param.PostProcessingParam.raw_th,
+                                                           xy_unit='px', px_size=param.Camera.px_size)
+        else:
+            raise NotImplementedError(f"Post-processing {param.PostProcessing} is not supported in the graph.")
+
+        return cls(model=model, rescale=rescale, coord=coord, post_proc=post_proc)
+
+    @classmethod
+    def from_transform_sequence(cls, model: torch.nn.Module, post_proc: processing.TransformSequence):
+        """
+        Graph from the post-processing pipeline as set up in training, i.e. a TransformSequence of
+        InverseParamListRescale, Offset2Coordinate and LookUpPostProcessing / SpatialIntegration.
+
+        Args:
+            model: model
+            post_proc: post-processing pipeline
+
+        """
+        com = list(post_proc.com)
+        if len(com) != 3 or not isinstance(com[0], scale_transform.InverseParamListRescale) \
+                or not isinstance(com[1], coord_transform.Offset2Coordinate):
+            raise TypeError("Post-processing must be a sequence of InverseParamListRescale, Offset2Coordinate and "
+                            "look-up post-processing.")
+
+        return cls(model, *com)
+
+    @staticmethod
+    def _p_aggregation_str(p_aggregation) -> str:
+        if p_aggregation is torch.add:
+            return 'sum'
+        elif p_aggregation is torch.max:
+            return 'max'
+        elif p_aggregation is post_processing.SpatialIntegration._norm_sum:
+            return 'norm_sum'
+        raise ValueError(f"Probability aggregation {p_aggregation} is not supported in the graph.")
+
+    @property
+    def frame_size(self) -> Tuple[int, int]:
+        """Frame size of the coordinate conversion, at which the model is traced"""
+        return self._frame_size
+
+    def _nms(self, p: torch.Tensor) -> torch.Tensor:
+        """Non-Maximum Suppression as in SpatialIntegration._nms"""
+        p_clip = torch.where(p > self.raw_th, p, torch.zeros_like(p)).unsqueeze(1)
+
+        pool = F.max_pool2d(p_clip, 3, 1, padding=1)
+        max_mask1 = torch.eq(p.unsqueeze(1), pool).float()
+
+        conv = F.conv2d(p.unsqueeze(1), self.nms_filter, padding=1)
+        p_ps1 = max_mask1 * conv
+
+        p_copy = p * (1 - max_mask1[:, 0])
+        max_mask2 = (p_copy > self.split_th).float().unsqueeze(1)
+        p_ps2 = max_mask2 * conv
+
+        if self.p_aggregation == 'sum':
+            p_ps = p_ps1 + p_ps2
+        elif self.p_aggregation == 'max':
+            p_ps = torch.maximum(p_ps1, p_ps2)
+        else:
+            p_ps = torch.clamp(p_ps1 + p_ps2, 0., 1.)
+
+        return p_ps.squeeze(1)
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor,
+                                                 torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Forward frame windows through model and post-processing.
+
+        Args:
+            x: frame windows of size N x ch_in x H x W (pre-processed)
+
+        Returns:
+            frame_ix (batch index) of size M, xyz of size M x 3, phot, prob, bg of size M, xyz_sig of size M x 3,
+            phot_sig of size M. Sigmas are of size 0 if the post-processing has no sigma mapping.
+
+        """
+        y = self.model(x).float()
+        if y.size(1) != self.scale.size(1):
+            raise ValueError(f"Unsupported number of output channels {y.size(1)}")
+
+        x_ctr = torch.arange(y.size(-2), dtype=y.dtype, device=y.device) * self.px_step[0] + self.px_origin[0]
+        y_ctr = torch.arange(y.size(-1), dtype=y.dtype, device=y.device) * self.px_step[1] + self.px_origin[1]
+
+        y = y * self.scale
+        y[:, 2] += x_ctr.view(-1, 1)
+        y[:, 3] += y_ctr.view(1, -1)
+
+        p = y[:, self.p_ch]
+        if self.nms:
+            p = self._nms(p)
+
+        active_px = p >= self.raw_th
+        frame_ix = active_px.nonzero()[:, 0]
+        prob = p[active_px]
+
+        features = y.index_select(1, self.feature_ix).permute(1, 0, 2, 3)[:, active_px]
+        xyz = features[1:4].t()
+
+        if self.has_sigma:
+            sigma = y.index_select(1, self.sigma_ix).permute(1, 0, 2, 3)[:, active_px]
+            xyz_sig = sigma[1:4].t()
+            phot_sig = sigma[0]
+        else:
+            xyz_sig = y.new_zeros(0, 3)
+            phot_sig = y.new_zeros(0)
+
+        return frame_ix, xyz, features[0], prob, features[4], xyz_sig, phot_sig
+
+
+def export(model: torch.nn.Module, post_proc: Union[processing.TransformSequence, InferenceGraph],
+           path: Union[str, pathlib.Path, None] = None, device: Union[str, torch.device] = 'cpu') \
+        -> torch.jit.ScriptModule:
+    """
+    Exports model and post-processing as one TorchScript graph, which can be loaded by torch.jit.load (see load)
+    without the decode package. The model is traced (at the frame size of the coordinate conversion, batch and frame
+    size of the graph are arbitrary), the post-processing is scripted.
+
+    Args:
+        model: model (weights loaded)
+        post_proc: post-processing pipeline (see InferenceGraph.from_transform_sequence) or graph without model
+            (the model argument is used, the graph itself is not changed)
+        path: output file, not saved if None
+        device: device on which the model is traced
+
+    Returns:
+        scripted graph
+
+    """
+    if isinstance(post_proc, InferenceGraph):
+        # copy of the graph without copying its model, which is replaced
+        graph = copy.deepcopy(post_proc, memo={id(post_proc.model): model} if post_proc.model is not None else None)
+        graph.model = model
+    else:
+        graph = InferenceGraph.from_transform_sequence(model, post_proc)
+
+    model = model.to(device)
+    model.eval()
+
+    with torch.no_grad():
+        x = torch.rand(2, model.ch_in, *graph.frame_size, device=device)
+        graph.model = torch.jit.trace(model, x, check_trace=False)
+        graph = torch.jit.script(graph.to(device))
+
+    if path is not None:
+        torch.jit.save(graph, str(path))
+
+    return graph
+
+
+def load(path: Union[str, pathlib.Path], device: Union[str, torch.device] = 'cpu') -> torch.jit.ScriptModule:
+    """
+    Loads an exported graph.
+
+    Args:
+        path: graph file
+        device: device to load to
+
+    """
+    graph = torch.jit.load(str(path), map_location=device)
+    graph.eval()
+    return graph
+
+
+def to_emitterset(out: Tuple[torch.Tensor, ...], graph: Union[InferenceGraph, torch.jit.ScriptModule],
+                  frame_ix_offset: int = 0) -> emitter.EmitterSet:
+    """
+    Converts the output of the graph to an EmitterSet.
+
+    Args:
+        out: output of the graph
+        graph: the graph (exported or not) for units and pixel size
+        frame_ix_offset: frame index of the first frame of the batch
+
+    """
+    frame_ix, xyz, phot, prob, bg, xyz_sig, phot_sig = [o.cpu() for o in out]
+    has_sigma = len(xyz_sig) == len(xyz) and graph.has_sigma
+
+    return emitter.EmitterSet(xyz=xyz, frame_ix=frame_ix + frame_ix_offset, phot=phot, prob=prob, bg=bg,
+                              xyz_sig=xyz_sig if has_sigma else None, phot_sig=phot_sig if has_sigma else None,
+                              xy_unit=graph.xy_unit if graph.xy_unit != '' else None,
+                              px_size=graph.px_size if len(graph.px_size) != 0 else None)
+
+
+def graph_path(model_path: Union[str, pathlib.Path]) -> pathlib.Path:
+    """Path of the graph next to the model file, i.e. model.pt -> model_graph.pt"""
+    model_path = pathlib.Path(model_path)
+    return model_path.with_name(model_path.stem + '_graph.pt')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import decode.neuralfitter.models
+    import decode.utils
+
+    parse = argparse.ArgumentParser(
+        description="Export model and post-processing as one TorchScript graph (model.pt -> model_graph.pt).")
+    parse.add_argument('model_path', help='Path to the model file')
+    parse.add_argument('param_path', help='Path to the parameters of the training')
+    parse.add_argument('-o', '--output', default=None, help='Output file (default: next to the model file)')
+    parse.add_argument('-d', '--device', default='cpu', help='Device on which the graph is exported')
+
+    args = parse.parse_args()
+
+    param = decode.utils.param_io.load_params(args.param_path)
+
+    model = decode.neuralfitter.models.SigmaMUNet.parse(param)
+    model = decode.utils.model_io.LoadSaveModel(
+        model, input_file=args.model_path, output_file=None).load_init(args.device)
+
+    out = args.output if args.output is not None else graph_path(args.model_path)
+    export(model, InferenceGraph.parse(model, param), out, device=args.device)
+    print(f"Exported graph to {out}")
@@ -1,21 +1,34 @@
+import collections
+import math
 import time
 import warnings
+from concurrent import futures
 from functools import partial
-from typing import Union, Callable
+from typing import Union, Callable, Optional, Tuple, Iterable, Iterator, Any, TYPE_CHECKING
 
 import torch
 from tqdm import tqdm
 
+from .tiling import Tiling
 from .. import dataset
+from ..models import unet_param
+from ..utils import padding_calc
 from ...generic import emitter
+from ...utils import frames_io
 from ...utils import hardware
 
+if TYPE_CHECKING:  # emitter_io imports pandas and h5py
+    from ...utils import emitter_io
+
 
 class Infer:
+    _batch_size_fallback = 64  # batch size 'auto' where the memory of the model can not be measured
 
     def __init__(self, model, ch_in: int, frame_proc, post_proc, device: Union[str, torch.device],
                  batch_size: Union[int, str] = 'auto', num_workers: int = 0, pin_memory: bool = False,
-                 forward_cat: Union[str, Callable] = 'emitter'):
+                 forward_cat: Union[str, Callable] = 'emitter', sequential: bool = False,
+                 tile_size: Union[None, int, Tuple[int, int]] = None, tile_overlap: Optional[int] = None,
+                 memory_fraction: float = 0.5, batch_size_sweep: bool = False, post_proc_workers: int = 0):
         """
         Convenience class for inference.
 
@@ -25,12 +38,29 @@ class Infer:
             frame_proc: frame pre-processing pipeline
             post_proc: post-processing pipeline
             device: device where to run inference
-            batch_size: batch-size or 'auto' if the batch size should be determined automatically (only use in combination with cuda)
+            batch_size: batch-size or 'auto' if the batch size should be determined automatically (on cpu by the
+                measured peak memory of the model and memory_fraction, 64 where this is not possible). Determined once
+                per sample size.
             num_workers: number of workers
             pin_memory: pin memory in dataloader
             forward_cat: method which concatenates the output batches. Can be string or Callable.
             Use 'em' when the post-processor outputs an EmitterSet, or 'frames' when you don't use post-processing or if
             the post-processor outputs frames.
+            sequential: forward the shared part of the model (forward_shared, e.g. the shared UNet of DoubleMUnet /
+                SigmaMUNet) once per frame and reuse its output for all frame windows the frame is part of, instead of
+                once per frame window. Frames are not loaded by a dataloader in this mode, i.e. num_workers and
+                pin_memory are ignored. The frame processing must act on each frame independently.
+            tile_size: forward tiles of this size (incl. overlap) instead of whole frames, such that memory does not
+                depend on the frame size (see Tiling). The batch size then counts tiles, the post-processing must be
+                set up for the tile size and output px coordinates. Only with forward_cat 'emitter'.
+            tile_overlap: overlap of the tiles in px. If None, the receptive field radius of the model plus 2 px (for
+                the neighbourhood of the post-processing and sub-pixel offsets across core borders).
+            memory_fraction: fraction of the available host memory to be used when determining the batch size on cpu
+            batch_size_sweep: with batch size 'auto', measure the throughput of the batch sizes up to the maximum and
+                use the fastest one
+            post_proc_workers: number of threads for the post-processing. If >= 1, the post-processing of a batch
+                runs on a pool of threads while the model forwards the next batches (at most two batches per thread
+                are in flight, the output order is preserved). If 0, model and post-processing alternate.
         """
 
         self.model = model
@@ -41,14 +71,26 @@ class Infer:
         self.pin_memory = pin_memory
         self.frame_proc = frame_proc
         self.post_proc = post_proc
+        self.sequential = sequential
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.memory_fraction = memory_fraction
+        self.batch_size_sweep = batch_size_sweep
+        self.post_proc_workers = post_proc_workers
+        self._batch_size_auto = {}  # automatically determined batch size by sample size
+
+        if self.sequential and not hasattr(self.model, 'forward_features'):
+            raise ValueError(f"Sequential inference requires a model with shared part (forward_shared, "
+                             f"forward_features), which {type(self.model).__name__} does not have.")
+
+        if self.tile_size is not None and (self.sequential or forward_cat != 'emitter'):
+            raise ValueError("Tiled inference is only supported with forward_cat 'emitter' and not sequential.")
 
         self.forward_cat = None
         self._forward_cat_mode = forward_cat
 
-        if str(self.device) == 'cpu' and self.batch_size == 'auto':
-            warnings.warn("Automatically determining the batch size does not make sense on cpu device. "
-                          "Falling back to reasonable value.")
-            self.batch_size = 64
+        if 'cuda' in str(self.device):
+            hardware.check_device_capability()
 
     def forward(self, frames: torch.Tensor) -> emitter.EmitterSet:
         """
@@ -59,42 +101,188 @@ class Infer:
 
         """
 
-        """Move Model"""
-        model = self.model.to(self.device)
-        model.eval()
+        """In post processing we need to make sure that we get a single Emitterset for each batch,
+        so that we can easily concatenate."""
+        out = [o for o, _ in self._forward_batches(frames)]
+
+        """Cat to single emitterset / frame tensor depending on the specification of the forward_cat attr."""
+        out = self.forward_cat(out)
+
+        return out
+
+    def forward_to(self, frames: torch.Tensor, sink: 'emitter_io.EmitterSink') -> 'emitter_io.EmitterSink':
+        """
+        Forward frames as in forward, but pass the localizations of each batch to the sink as soon as they are
+        available instead of concatenating them, such that memory does not grow with the number of frames.
+        Only with forward_cat 'emitter'. The sink is not closed.
+
+        Args:
+            frames:
+            sink: receives an EmitterSet per batch, with frame indices relative to the first frame of frames
+
+        Returns:
+            the sink
+
+        """
+        if self._forward_cat_mode != 'emitter':
+            raise ValueError(f"Forwarding to a sink requires forward_cat 'emitter', not {self._forward_cat_mode}.")
+
+        for em, ix_frame in self._forward_batches(frames):
+            em.frame_ix = em.frame_ix + ix_frame
+            sink.write(em)
+
+        return sink
+
+    def _forward_batches(self, frames: torch.Tensor) -> Iterator[Tuple[Any, int]]:
+        """
+        Yields the post-processed output of each batch and the index of the frame its frame indices are relative to.
+        Sets up forward_cat accordingly.
+
+        """
+        model = self._prepare_model()
+        forward_kwargs = self._forward_kwargs(model)
 
         """Form Dataset and Dataloader"""
         ds = dataset.InferenceDataset(frames=frames, frame_proc=self.frame_proc, frame_window=self.ch_in)
 
-        if self.batch_size == 'auto':
-            # include safety factor of 20%
-            bs = int(0.8 * self.get_max_batch_size(model, ds[0].size(), 1, 512))
-        else:
-            bs = self.batch_size
+        if self.tile_size is not None:
+            self.forward_cat = emitter.EmitterSet.cat  # stitched localizations have absolute frame indices
+            yield from ((em, 0) for em in self._forward_tiled(model, ds, forward_kwargs))
+            return
+
+        bs = self._batch_size(model, ds[0].size())
 
         # generate concatenate function here because we need batch size for this
         self.forward_cat = self._setup_forward_cat(self._forward_cat_mode, bs)
 
-        dl = torch.utils.data.DataLoader(dataset=ds, batch_size=bs, shuffle=False, drop_last=False,
-                                         num_workers=self.num_workers, pin_memory=self.pin_memory)
+        if self.sequential:
+            y_out_iter = self._forward_sequential(model, frames, bs, forward_kwargs)
+        else:
+            dl = torch.utils.data.DataLoader(dataset=ds, batch_size=bs, shuffle=False, drop_last=False,
+                                             num_workers=self.num_workers, pin_memory=self.pin_memory)
+            model_forward = _forward_no_grad(model, **forward_kwargs)
+            y_out_iter = (model_forward(sample.to(self.device)) for sample in dl)
+
+        out_iter = _map_ordered(self.post_proc.forward, y_out_iter, self.post_proc_workers)
+        for i, out in enumerate(tqdm(out_iter, total=math.ceil(len(ds) / bs))):
+            yield out, i * bs
 
-        out = []
+    def _prepare_model(self):
+        """Moves the model to the device and sets it to eval mode."""
+        model = self.model.to(self.device)
+        model.eval()
 
-        with torch.no_grad():
+        return model
+
+    def _forward_kwargs(self, model) -> dict:
+        """
+        Keyword arguments of the forward of the model. On cuda, the heads of models which support it are fused (fewer
+        kernel launches, on cpu the separate heads are not slower), from the current weights on every forward.
+        """
+        if hasattr(model, 'fuse_heads') and 'cuda' in str(self.device):
+            return {'heads_fused': model.fuse_heads()}
+
+        return {}
+
+    @torch.no_grad()
+    def _forward_sequential(self, model, frames: torch.Tensor, batch_size: int, forward_kwargs: dict):
+        """
+        Yields the model output batch by batch (as the dataloader in forward would, incl. 'same' padding at the
+        borders), but computes the shared features of each frame only once. The features of the last few frames of a
+        batch are kept for the frame windows of the next batch.
+
+        """
+        n = len(frames)
+        hw = (self.ch_in - 1) // 2  # half window without centre
+
+        feat = None  # shared features of frames feat_low ... feat_high - 1
+        feat_low = feat_high = 0
+
+        for ix_low in range(0, n, batch_size):
+            ix_high = min(ix_low + batch_size, n)
+
+            """Shared features of the frames not yet in the cache"""
+            need_low, need_high = max(ix_low - hw, 0), min(ix_high + hw, n)
+            x = frames[feat_high:need_high]
+            if self.frame_proc is not None:
+                x = self.frame_proc.forward(x)
+            f_new = model.forward_shared(x.unsqueeze(1).to(self.device))
+
+            feat = f_new if feat is None else torch.cat([feat[need_low - feat_low:], f_new], 0)
+            feat_low, feat_high = need_low, need_high
+
+            """Gather the frame windows and forward the rest of the model"""
+            win_ix = torch.arange(ix_low, ix_high).unsqueeze(1) + torch.arange(-hw, hw + 1).unsqueeze(0)
+            win_ix = win_ix.clamp(0, n - 1) - feat_low
+            f = feat[win_ix.to(feat.device)]  # N x ch_in x C x H x W
+
+            yield model.forward_features(f.view(f.size(0), -1, *f.shape[-2:]), **forward_kwargs)
+
+    def _forward_tiled(self, model, ds, forward_kwargs: dict) -> Iterator[emitter.EmitterSet]:
+        """
+        Forwards tiles of the frames (batched across frames) and yields the stitched localizations of the tile cores
+        of each batch.
+
+        """
+        if self.tile_overlap is None:
+            self.tile_overlap = padding_calc.receptive_field(model, self.ch_in, device=self.device) + 2
+
+        tiling = Tiling(ds[0].size()[-2:], self.tile_size, self.tile_overlap, align=self._downsampling(model))
+
+        bs = self._batch_size(model, (self.ch_in, *tiling.tile_size))
+
+        dl = torch.utils.data.DataLoader(dataset=ds, batch_size=max(bs // len(tiling), 1), shuffle=False,
+                                         drop_last=False, num_workers=self.num_workers, pin_memory=self.pin_memory)
+
+        @torch.no_grad()
+        def y_out_iter():
+            n_tiles = 0  # tiles of the previous frame batches
             for sample in tqdm(dl):
-                x_in = sample.to(self.device)
+                tiles = tiling.crop(sample)
 
-                # compute output
-                y_out = model(x_in)
+                for ix in range(0, len(tiles), bs):
+                    yield model(tiles[ix:ix + bs].to(self.device), **forward_kwargs), n_tiles + ix
 
-                """In post processing we need to make sure that we get a single Emitterset for each batch, 
-                so that we can easily concatenate."""
-                out.append(self.post_proc.forward(y_out))
+                n_tiles += len(tiles)
 
-        """Cat to single emitterset / frame tensor depending on the specification of the forward_cat attr."""
-        out = self.forward_cat(out)
+        def post_proc(y_out_ix):
+            y_out, ix_offset = y_out_ix
+            return tiling.stitch(self.post_proc.forward(y_out), ix_offset=ix_offset)
 
-        return out
+        yield from _map_ordered(post_proc, y_out_iter(), self.post_proc_workers)
+
+    def _batch_size(self, model, sample_size) -> int:
+        """
+        Batch size as specified or determined automatically for samples of the given size (once per size, i.e. not
+        on every forward)
+        """
+        if self.batch_size != 'auto':
+            return self.batch_size
+
+        sample_size = tuple(sample_size)
+        if sample_size in self._batch_size_auto:
+            return self._batch_size_auto[sample_size]
+
+        try:
+            # include safety factor of 20%
+            bs = max(int(0.8 * self.get_max_batch_size(model, sample_size, 1, 512,
+                                                       memory_fraction=self.memory_fraction)), 1)
+
+        except (NotImplementedError, OSError) as err:  # peak memory not measurable (not Linux, hardened container)
+            warnings.warn(f"Could not determine the batch size automatically ({err}). "
+                          f"Falling back to {self._batch_size_fallback}.")
+            bs = self._batch_size_fallback
+
+        if self.batch_size_sweep:
+            bs = hardware.get_fastest_batch_size(_forward_no_grad(model), sample_size, self.device, bs)
+
+        self._batch_size_auto[sample_size] = bs
+        return bs
+
+    @staticmethod
+    def _downsampling(model) -> int:
+        """Total downsampling factor of a UNet based model, i.e. the pixel grid on which its output is equivariant"""
+        return max([2 ** m.depth for m in model.modules() if isinstance(m, unet_param.UNetBase)], default=1)
 
     def _setup_forward_cat(self, forward_cat, batch_size: int):
 
@@ -119,52 +307,126 @@ class Infer:
 
     @staticmethod
     def get_max_batch_size(model: torch.nn.Module, frame_size: Union[tuple, torch.Size],
-                           limit_low: int, limit_high: int):
+                           limit_low: int, limit_high: int, memory_fraction: float = 0.5):
         """
-        Get maximum batch size for inference.
+        Get maximum batch size for inference. On cuda by trial and error, on cpu by the peak memory of the model
+        extrapolated to a fraction of the available memory.
 
         Args: 
             model: model on correct device
             frame_size: size of frames (without batch dimension)
             limit_low: lower batch size limit
             limit_high: upper batch size limit
+            memory_fraction: fraction of the available memory to be used (cpu only)
         """
+        device = next(model.parameters()).device
+
+        if device.type == 'cpu':
+            return hardware.get_max_batch_size_cpu(_forward_no_grad(model), frame_size, limit_low, limit_high,
+                                                   memory_fraction=memory_fraction)
+
+        assert device.type == 'cuda', "Auto determining the max batch size is only supported on cpu and cuda."
 
-        def model_forward_no_grad(x: torch.Tensor):
-            """
-            Helper function because we need to account for torch.no_grad()
-            """
-            with torch.no_grad():
-                o = model.forward(x)
+        return hardware.get_max_batch_size(_forward_no_grad(model), frame_size, device, limit_low, limit_high)
 
-            return o
 
-        assert next(model.parameters()).is_cuda, \
-            "Auto determining the max batch size makes only sense when running on CUDA device."
+def _forward_no_grad(model: torch.nn.Module, **kwargs) -> Callable:
+    """Model forward (with keyword arguments kwargs) without gradient, e.g. to probe batch sizes"""
 
-        return hardware.get_max_batch_size(model_forward_no_grad, frame_size, next(model.parameters()).device,
-                                           limit_low, limit_high)
+    def model_forward_no_grad(x: torch.Tensor):
+        with torch.no_grad():
+            o = model.forward(x, **kwargs)
+
+        return o
+
+    return model_forward_no_grad
+
+
+def _map_ordered(func: Callable, iterable: Iterable, workers: int,
+                 pool: Optional[futures.Executor] = None) -> Iterator:
+    """
+    Yields func(x) for each x of iterable in order. With workers >= 1, func runs on a pool of threads while the items
+    are produced by the calling thread (e.g. the model forward). At most 2 * workers items are in flight, i.e. the
+    producer is blocked while the oldest result is not yet consumed.
+
+    Args:
+        func: function applied to the items
+        iterable: items
+        workers: number of threads, 0 to apply func in the calling thread
+        pool: executor (with the given number of workers) to be reused, otherwise a new one is created
+
+    """
+    if workers == 0:
+        yield from map(func, iterable)
+        return
+
+    if pool is None:
+        with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            yield from _map_ordered(func, iterable, workers, pool)
+        return
+
+    pending = collections.deque()
+
+    for x in iterable:
+        pending.append(pool.submit(func, x))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().result()
+
+    while len(pending) >= 1:
+        yield pending.popleft().result()
 
 
 class LiveInfer(Infer):
+    _time_poll = 0.05  # polling interval of the frame count / file in incremental mode
+
     def __init__(self,
                  model, ch_in: int, *,
                  stream, time_wait=5,
                  frame_proc=None, post_proc=None,
                  device: Union[str, torch.device] = 'cuda:0' if torch.cuda.is_available() else 'cpu',
                  batch_size: Union[int, str] = 'auto', num_workers: int = 0, pin_memory: bool = False,
-                 forward_cat: Union[str, Callable] = 'emitter'):
+                 forward_cat: Union[str, Callable] = 'emitter', incremental: bool = False,
+                 post_proc_workers: int = 0):
+        """
+        Inference of frames which are still being acquired. New frames are fitted in chunks, the output of each
+        chunk is passed to stream(out, n_low, n_high) with frame indices relative to the first frame n_low of the
+        chunk. Fitting ends when no new frames arrived for more than 2 times time_wait.
+
+        Args:
+            model: pytorch model
+            ch_in: number of input channels
+            stream: callable to which the output of each chunk is passed
+            time_wait: waiting time in s
+            frame_proc: frame pre-processing pipeline
+            post_proc: post-processing pipeline
+            device: device where to run inference
+            batch_size: batch size or 'auto'
+            num_workers: number of dataloader workers (not in incremental mode)
+            pin_memory: pin memory in dataloader
+            forward_cat: method which concatenates the output batches (see Infer)
+            incremental: the frame windows of all frames are formed across chunk borders, i.e. the last ch_in // 2
+                frames of a chunk are only fitted (in the next chunk) once their successors arrived or the
+                acquisition ended, and the preceding ch_in // 2 frames are kept as context. Model, batch size and
+                post-processing threads are set up once, frames are loaded in process. New frames are noticed
+                within a short polling interval (by the file of a TiffTensor, otherwise by the frame count) instead
+                of after time_wait.
+            post_proc_workers: number of post-processing threads (see Infer)
+        """
 
         super().__init__(
             model=model, ch_in=ch_in, frame_proc=frame_proc, post_proc=post_proc,
             device=device, batch_size=batch_size, num_workers=num_workers, pin_memory=pin_memory,
-            forward_cat=forward_cat)
+            forward_cat=forward_cat, post_proc_workers=post_proc_workers)
 
         self._stream = stream
         self._time_wait = time_wait
+        self.incremental = incremental
 
     def forward(self, frames):
 
+        if self.incremental:
+            return self._forward_incremental(frames)
+
         n_fitted = 0
         n_waited = 0
         while n_waited <= 2:
@@ -181,6 +443,67 @@ class LiveInfer(Infer):
             n_fitted = n
             n_waited = 0
 
+    def _forward_incremental(self, frames):
+        model = self._prepare_model()
+        forward_kwargs = self._forward_kwargs(model)
+        hw = (self.ch_in - 1) // 2  # half window without centre
+        watcher = frames_io.FileWatcher(frames.file, self._time_poll) if hasattr(frames, 'file') else None
+
+        bs = None
+        n_fitted = 0
+        n_waited = 0
+
+        with futures.ThreadPoolExecutor(max_workers=max(self.post_proc_workers, 1)) as pool:
+            while True:
+                n = len(frames)
+                ended = n_waited > 2
+
+                # frames with complete window, at the end the last ones are padded
+                n_ready = n if ended else max(n - hw, 0)
+
+                if n_ready > n_fitted:
+                    """Chunk incl. context frames, of which only the windows of the new frames are forwarded"""
+                    n_low, n_high = max(n_fitted - hw, 0), min(n_ready + hw, n)
+                    ds = dataset.InferenceDataset(frames=frames[n_low:n_high], frame_proc=self.frame_proc,
+                                                  frame_window=self.ch_in)
+                    ds = torch.utils.data.Subset(ds, range(n_fitted - n_low, n_ready - n_low))
+
+                    if bs is None:
+                        bs = self._batch_size(model, ds[0].size())
+                        self.forward_cat = self._setup_forward_cat(self._forward_cat_mode, bs)
+
+                    dl = torch.utils.data.DataLoader(dataset=ds, batch_size=bs, shuffle=False, drop_last=False)
+
+                    with torch.no_grad():
+                        out = list(_map_ordered(self.post_proc.forward,
+                                                (model(sample.to(self.device), **forward_kwargs) for sample in dl),
+                                                self.post_proc_workers, pool))
+
+                    self._stream(self.forward_cat(out), n_fitted, n_ready)
+
+                    n_fitted = n_ready
+                    n_waited = 0
+
+                if ended:
+                    break
+
+                n_waited = 0 if self._wait(frames, n, watcher) else n_waited + 1
+
+    def _wait(self, frames, n: int, watcher: Optional[frames_io.FileWatcher]) -> bool:
+        """Waits at most time_wait for more than n frames, returns whether they arrived"""
+        t_end = time.monotonic() + self._time_wait
+
+        while time.monotonic() < t_end:
+            if watcher is not None:
+                watcher.wait(t_end - time.monotonic())  # returns early when the file changed
+            else:
+                time.sleep(self._time_poll)
+
+            if len(frames) != n:
+                return True
+
+        return False
+
 
 if __name__ == '__main__':
     import argparse
@@ -0,0 +1,206 @@
+import copy
+import pathlib
+import time
+import warnings
+from collections import namedtuple
+from typing import Iterable, Optional
+
+import torch
+from torch import nn
+
+from .inference import Infer
+from .. import dataset
+from ...evaluation import evaluation
+from ...generic import emitter
+from ...utils import frames_io
+
+_backends = ('fbgemm', 'x86')
+
+
+class QuantizedTrunk(nn.Module):
+    def __init__(self, module: nn.Module):
+        """
+        Wraps a module for eager mode static quantization, i.e. input and output are float, everything in between is
+        quantized after convert.
+
+        Args:
+            module: module to be quantized (e.g. a UNet)
+
+        """
+        super().__init__()
+
+        self.quant = torch.ao.quantization.QuantStub()
+        self.module = module
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.module(self.quant(x)))
+
+
+def _fuse_conv_relu(module: nn.Module):
+    """Fuses all Conv2d directly followed by ReLU within the sequentials of module (in place)."""
+    for m in list(module.modules()):
+        if not isinstance(m, nn.Sequential):
+            continue
+
+        pairs = [[str(i), str(i + 1)] for i in range(len(m) - 1)
+                 if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.ReLU)]
+        if len(pairs) >= 1:
+            torch.ao.quantization.fuse_modules(m, pairs, inplace=True)
+
+
+def prepare(model: nn.Module, trunk: Iterable[str] = ('unet_shared', 'unet_union'),
+            backend: str = 'fbgemm') -> nn.Module:
+    """
+    Copy of the model with observers in the trunk (i.e. the UNets of DoubleMUnet / SigmaMUNet), ready for
+    calibration. The heads are not quantized, such that detection and sigma outputs stay in float. Sets the
+    quantized engine to the backend.
+
+    Args:
+        model: float model
+        trunk: names of the submodules to be quantized
+        backend: quantization backend 'fbgemm' or 'x86'
+
+    """
+    if backend not in _backends:
+        raise ValueError(f"Unsupported backend {backend}. Supported are {_backends}.")
+    if not all(hasattr(model, t) for t in trunk):
+        raise TypeError(f"{type(model).__name__} does not have the trunk {trunk}.")
+
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+
+    for t in trunk:
+        m = QuantizedTrunk(getattr(model, t))
+        _fuse_conv_relu(m.module)
+        m.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+        setattr(model, t, m)
+
+    return torch.ao.quantization.prepare(model, inplace=True)
+
+
+def calibration_frames(source, n_frames: Optional[int] = None) -> torch.Tensor:
+    """
+    Frames for calibration.
+
+    Args:
+        source: simulation (frames are sampled) or path to a tiff file
+        n_frames: limit number of frames
+
+    """
+    if isinstance(source, (str, pathlib.Path)):
+        frames = frames_io.load_tif(source)
+    else:
+        _, frames, _ = source.sample()
+
+    return frames[:n_frames] if n_frames is not None else frames
+
+
+def calibrate(model: nn.Module, frames: torch.Tensor, ch_in: int, frame_proc=None, batch_size: int = 32,
+              n_batches: Optional[int] = None) -> nn.Module:
+    """
+    Forwards frame windows through a prepared model to collect the statistics of the observers.
+
+    Args:
+        model: prepared model (see prepare)
+        frames: calibration frames (see calibration_frames)
+        ch_in: number of input channels
+        frame_proc: frame pre-processing as in inference
+        batch_size: batch size
+        n_batches: limit number of batches
+
+    """
+    ds = dataset.InferenceDataset(frames=frames, frame_proc=frame_proc, frame_window=ch_in)
+    dl = torch.utils.data.DataLoader(dataset=ds, batch_size=batch_size, shuffle=False)
+
+    with torch.no_grad():
+        for i, x in enumerate(dl):
+            if n_batches is not None and i >= n_batches:
+                break
+            model(x)
+
+    return model
+
+
+def convert(model: nn.Module) -> nn.Module:
+    """Converts a calibrated model (in place), i.e. the observed trunk to int8."""
+    return torch.ao.quantization.convert(model, inplace=True)
+
+
+def quantize(model: nn.Module, frames: torch.Tensor, ch_in: int, frame_proc=None, batch_size: int = 32,
+             n_batches: Optional[int] = None, backend: str = 'fbgemm', **kwargs) -> nn.Module:
+    """
+    Post-training static quantization of the trunk of the model for cpu inference (see prepare, calibrate and convert).
+    The model itself is not changed.
+
+    Args:
+        model: float model
+        frames: calibration frames (see calibration_frames)
+        ch_in: number of input channels
+        frame_proc: frame pre-processing as in inference
+        batch_size: calibration batch size
+        n_batches: limit number of calibration batches
+        backend: quantization backend 'fbgemm' or 'x86'
+        **kwargs: passed on to prepare
+
+    Returns:
+        quantized copy of the model
+
+    """
+    model = prepare(model, backend=backend, **kwargs)
+    model = calibrate(model, frames, ch_in=ch_in, frame_proc=frame_proc, batch_size=batch_size, n_batches=n_batches)
+
+    return convert(model)
+
+
+_comparison = namedtuple("comparison", ["float", "quantized", "fps_float", "fps_quantized"])
+
+
+def compare(model: nn.Module, model_quant: nn.Module, frames: torch.Tensor, ch_in: int, *, post_proc, matcher,
+            em_ref: Optional[emitter.EmitterSet] = None, frame_proc=None, batch_size: int = 32,
+            evaluator: Optional[evaluation.SMLMEvaluation] = None) -> _comparison:
+    """
+    Compares float and quantized model on cpu, i.e. evaluates the localizations of both against a reference and
+    measures the throughput.
+
+    Args:
+        model: float model
+        model_quant: quantized model
+        frames: frames
+        ch_in: number of input channels
+        post_proc: post-processing
+        matcher: matcher
+        em_ref: reference (ground truth) emitters. If None, the quantized model is evaluated against the output of the
+            float model.
+        frame_proc: frame pre-processing
+        batch_size: inference batch size
+        evaluator: evaluation (defaults to SMLMEvaluation, with photon weighted errors if em_ref is None)
+
+    Returns:
+        evaluation results (see SMLMEvaluation.forward) of float and quantized model, frames / s of both
+
+    """
+    if evaluator is None:  # the float output as reference has no cramer rao bounds
+        evaluator = evaluation.SMLMEvaluation() if em_ref is not None else \
+            evaluation.SMLMEvaluation(weighted_eval=evaluation.WeightedErrors(mode='phot', reduction='gaussian'))
+
+    em_out = []
+    fps = []
+    for m in (model, model_quant):
+        infer = Infer(model=m, ch_in=ch_in, frame_proc=frame_proc, post_proc=post_proc, device='cpu',
+                      batch_size=batch_size)
+
+        t0 = time.perf_counter()
+        em_out.append(infer.forward(frames))
+        fps.append(len(frames) / (time.perf_counter() - t0))
+
+    result = []
+    for em in em_out:
+        tp, fp, fn, tp_match = matcher.forward(em, em_ref if em_ref is not None else em_out[0])
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Non-Finite values encountered during fitting.")
+            result.append(evaluator.forward(tp, fp, fn, tp_match))
+
+    return _comparison(float=result[0], quantized=result[1], fps_float=fps[0], fps_quantized=fps[1])
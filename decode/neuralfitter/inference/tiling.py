@@ -0,0 +1,112 @@
+import math
+from typing import Union, Tuple
+
+import torch
+
+from ...generic import emitter
+
+
+class Tiling:
+
+    def __init__(self, frame_size: Tuple[int, int], tile_size: Union[int, Tuple[int, int]], overlap: int,
+                 align: int = 1):
+        """
+        Splits frames into overlapping tiles and stitches the localizations of the tiles back together. The frame is
+        partitioned into cores, each tile is a core plus a margin of the overlap on either side (tiles at the frame
+        border are shifted inwards instead of being padded), such that a network with receptive field radius below the
+        overlap gives the same output in the core as on the whole frame. Localizations outside the core of their tile
+        are discarded. Tiles start at multiples of align, such that models that downsample (e.g. UNets) see the
+        same pixel grid as on the whole frame.
+
+        Args:
+            frame_size: size of the frames (H, W)
+            tile_size: size of the tiles incl. overlap (must be compatible with the model)
+            overlap: overlap margin (in px), rounded up to a multiple of align
+            align: tiles start at multiples of align (e.g. the total downsampling factor of the model). Tile and frame
+                size must be multiples of it as well.
+
+        """
+        tile_size = (tile_size, tile_size) if isinstance(tile_size, int) else tuple(tile_size)
+
+        self.frame_size = tuple(frame_size)
+        self.tile_size = tuple(min(t, f) for t, f in zip(tile_size, self.frame_size))
+        self.overlap = math.ceil(overlap / align) * align
+        self.align = align
+
+        if any(s % align != 0 for s in self.frame_size + self.tile_size):
+            raise ValueError(f"Frame size {self.frame_size} and tile size {self.tile_size} must be multiples of "
+                             f"{align}.")
+
+        """Core and tile bounds per dimension"""
+        bounds = [self._bounds(f, t, self.overlap) for f, t in zip(self.frame_size, self.tile_size)]
+        self.cores = torch.tensor([[c0[0], c0[1], c1[0], c1[1]] for c0, _ in bounds[0] for c1, _ in bounds[1]])
+        self.origins = torch.tensor([[o0, o1] for _, o0 in bounds[0] for _, o1 in bounds[1]])
+
+    @staticmethod
+    def _bounds(frame: int, tile: int, overlap: int) -> list:
+        if tile == frame:
+            return [((0, frame), 0)]
+
+        stride = tile - 2 * overlap
+        if stride <= 0:
+            raise ValueError(f"Tile size {tile} must be larger than twice the overlap {overlap}.")
+
+        return [((c, min(c + stride, frame)), min(max(c - overlap, 0), frame - tile))
+                for c in range(0, frame, stride)]
+
+    def __len__(self) -> int:
+        return len(self.origins)
+
+    def crop(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Crops the tiles of all frames.
+
+        Args:
+            x: frames of size N x C x H x W
+
+        Returns:
+            tiles of size (N * n_tiles) x C x tile_h x tile_w, frame major
+
+        """
+        th, tw = self.tile_size
+        tiles = [x[..., o0:o0 + th, o1:o1 + tw] for o0, o1 in self.origins.tolist()]
+
+        return torch.stack(tiles, 1).view(-1, *x.size()[1:-2], th, tw)
+
+    def stitch(self, em: emitter.EmitterSet, ix_offset: int = 0) -> emitter.EmitterSet:
+        """
+        Localizations of tiles to frame coordinates. Discards localizations outside the core of their tile.
+
+        Args:
+            em: localizations in tile coordinates (px, pixel i centred at i), frame_ix is the index of the tile in
+                the output of crop
+            ix_offset: index of the first tile of em in the output of crop, i.e. if the tiles were forwarded in chunks
+
+        Returns:
+            localizations in frame coordinates, frame_ix is the frame index
+
+        """
+        if len(em) == 0:
+            return em
+
+        if em.xy_unit != 'px':
+            raise ValueError(f"Tiled localizations must be in px, not {em.xy_unit}.")
+
+        tile_ix = em.frame_ix + ix_offset
+        frame_ix, tile_ix = tile_ix // len(self), tile_ix % len(self)
+
+        em = em.clone()
+        em.frame_ix = frame_ix
+        em.xyz[:, :2] += self.origins[tile_ix].to(em.xyz.dtype)
+
+        """Keep localizations within the core, cores at the frame border are open towards the outside"""
+        core = self.cores[tile_ix].to(em.xyz.dtype) - 0.5
+        core[core[:, 0] == -0.5, 0] = -float('inf')
+        core[core[:, 1] == self.frame_size[0] - 0.5, 1] = float('inf')
+        core[core[:, 2] == -0.5, 2] = -float('inf')
+        core[core[:, 3] == self.frame_size[1] - 0.5, 3] = float('inf')
+
+        x, y = em.xyz[:, 0], em.xyz[:, 1]
+        ix = (x >= core[:, 0]) * (x < core[:, 1]) * (y >= core[:, 2]) * (y < core[:, 3])
+
+        return em[ix]
@@ -1,5 +1,6 @@
+import math
 from abc import ABC, abstractmethod  # abstract class
-from typing import Union, Tuple
+from typing import Optional, Union, Tuple
 
 import torch
 from deprecated import deprecated
@@ -7,6 +8,7 @@ from torch import distributions
 
 # from . import MixtureSameFamily as mixture
 from ..simulation import psf_kernel
+from .utils import amp
 
 
 class Loss(ABC):
@@ -138,19 +140,41 @@ class GaussianMMLoss(Loss):
 
     def __init__(self, *, xextent: tuple, yextent: tuple, img_shape: tuple, device: Union[str, torch.device],
                  chweight_stat: Union[None, tuple, list, torch.Tensor] = None,
+                 n_components: Optional[int] = None, radius: Optional[float] = None,
                  forward_safety: bool = True):
         """
 
+        By default every pixel is a component of the mixture. With n_components or radius set, only a subset of pixels
+        enters the mixture's log-sum-exp (the mixture weights are still normalised over all pixels). Since the dropped
+        terms of the sum are non-negative, the sparse log-likelihood is a lower bound of the full one (i.e. the loss an
+        upper bound) and the gap per target is log(1 + r / s), where s and r are the mixture densities of kept and
+        dropped pixels. Because the density of a pixel decays with the distance of its prediction to the target, the
+        gap vanishes as soon as the kept pixels cover the (predicted) neighbourhood of each target.
+
         Args:
             xextent: extent in x
             yextent: extent in y
             img_shape: image size
             device: device used in training (cuda / cpu)
             chweight_stat: static channel weight, mainly to disable background prediction
+            n_components: use only the n_components pixels with the highest detection probability (per frame) as
+                mixture components
+            radius: use only the pixels whose centre is within radius (in px) of the respective target as mixture
+                components. Mutually exclusive with n_components
             forward_safety: check inputs to the forward method
         """
         super().__init__()
 
+        if n_components is not None and radius is not None:
+            raise ValueError("n_components and radius are mutually exclusive.")
+        if n_components is not None and n_components < 1:
+            raise ValueError(f"n_components must be positive, not {n_components}.")
+        if radius is not None and radius < 0:
+            raise ValueError(f"radius must be non-negative, not {radius}.")
+
+        self.n_components = n_components
+        self.radius = radius
+
         if chweight_stat is not None:
             self._ch_weight = chweight_stat if isinstance(chweight_stat, torch.Tensor) else torch.Tensor(chweight_stat)
         else:
@@ -161,6 +185,15 @@ class GaussianMMLoss(Loss):
         self._offset2coord = psf_kernel.DeltaPSF(xextent=xextent, yextent=yextent, img_shape=img_shape)
         self.forward_safety = forward_safety
 
+        if radius is not None:
+            """Pixel offsets (in index space) of a disc which covers all pixel centres within radius of a target"""
+            # the target is somewhere within its own pixel, i.e. up to half a pixel off its centre
+            r_ix = math.ceil(radius + 0.5)
+            d = torch.arange(-r_ix, r_ix + 1)
+            dx, dy = torch.meshgrid(d, d, indexing='ij')
+            ix_disc = (dx.abs() - 0.5).clamp(min=0) ** 2 + (dy.abs() - 0.5).clamp(min=0) ** 2 <= radius ** 2
+            self._disc_offset = torch.stack((dx[ix_disc], dy[ix_disc]), 1)
+
     def log(self, loss_val):
         return loss_val.mean().item(), {'gmm': loss_val[:, 0].mean().item(),
                                         'bg': loss_val[:, 1].mean().item()}
@@ -203,7 +236,6 @@ class GaussianMMLoss(Loss):
 
         """
 
-        batch_size = pxyz_mu.size(0)
         log_prob = 0
 
         p_mean = p.sum(-1).sum(-1)
@@ -212,6 +244,30 @@ class GaussianMMLoss(Loss):
 
         log_prob = log_prob + p_gauss.log_prob(mask.sum(-1)) * mask.sum(-1)
 
+        """Calc log probs if there is anything there"""
+        if mask.sum():
+            if self.n_components is None and self.radius is None:
+                gmm_log = self._gmm_log_prob(p, pxyz_mu, pxyz_sig, pxyz_tar)
+            else:
+                gmm_log = self._gmm_log_prob_sparse(p, pxyz_mu, pxyz_sig, pxyz_tar)
+
+            gmm_log = (gmm_log * mask).sum(-1)
+            log_prob = log_prob + gmm_log
+
+        loss = log_prob * (-1)
+
+        return loss
+
+    def _gmm_log_prob(self, p, pxyz_mu, pxyz_sig, pxyz_tar) -> torch.Tensor:
+        """
+        Log-likelihood of the targets under the mixture of all pixels.
+
+        Returns:
+            torch.Tensor (size N x M)
+
+        """
+        batch_size = pxyz_mu.size(0)
+
         prob_normed = p / p.sum(-1).sum(-1).view(-1, 1, 1)
 
         """Hacky way to get all prob indices"""
@@ -231,18 +287,58 @@ class GaussianMMLoss(Loss):
         comp = distributions.Independent(distributions.Normal(pxyz_mu, pxyz_sig), 1)
         gmm = distributions.mixture_same_family.MixtureSameFamily(mix, comp)
 
-        """Calc log probs if there is anything there"""
-        if mask.sum():
-            gmm_log = gmm.log_prob(pxyz_tar.transpose(0, 1)).transpose(0, 1)
-            gmm_log = (gmm_log * mask).sum(-1)
-            # print(f"LogProb: {log_prob.mean()}, GMM_log: {gmm_log.mean()}")
-            log_prob = log_prob + gmm_log
+        return gmm.log_prob(pxyz_tar.transpose(0, 1)).transpose(0, 1)
 
-        # log_prob = log_prob.reshape(batch_size, 1)  # need?
+    def _gmm_log_prob_sparse(self, p, pxyz_mu, pxyz_sig, pxyz_tar) -> torch.Tensor:
+        """
+        Log-likelihood of the targets under the mixture of a subset of pixels (top-k by detection probability or
+        within radius of each target). Avoids materialising N x M x (HxW) x 4 tensors.
 
-        loss = log_prob * (-1)
+        Returns:
+            torch.Tensor (size N x M)
 
-        return loss
+        """
+        batch_size, h, w = p.size()
+
+        """Flatten img dimension --> N x (HxW) (x 4), and convert px shifts to absolute coordinates"""
+        p = p.reshape(batch_size, h * w)
+        pxyz_mu = pxyz_mu.reshape(batch_size, 4, h * w).transpose(1, 2)
+        pxyz_sig = pxyz_sig.reshape(batch_size, 4, h * w).transpose(1, 2)
+
+        bin_ctr_x = self._offset2coord.bin_ctr_x.to(p.device)
+        bin_ctr_y = self._offset2coord.bin_ctr_y.to(p.device)
+        ctr = torch.zeros(h * w, 4, device=p.device)
+        ctr[:, 1] = bin_ctr_x.repeat_interleave(w)
+        ctr[:, 2] = bin_ctr_y.repeat(h)
+        pxyz_mu = pxyz_mu + ctr
+
+        log_w = torch.log(p) - torch.log(p.sum(-1, keepdim=True))
+
+        ix_n = torch.arange(batch_size, device=p.device).view(-1, 1, 1)
+        if self.n_components is not None:
+            """Same components for all targets of a frame --> N x 1 x K"""
+            ix = p.topk(min(self.n_components, h * w), dim=-1)[1].unsqueeze(1)
+            log_w = log_w[ix_n, ix]
+
+        else:
+            """Components in disc around each target --> N x M x K"""
+            xextent, yextent = self._offset2coord.xextent, self._offset2coord.yextent
+            x_ix = ((pxyz_tar[..., 1] - xextent[0]) / (xextent[1] - xextent[0]) * h).floor().long()
+            y_ix = ((pxyz_tar[..., 2] - yextent[0]) / (yextent[1] - yextent[0]) * w).floor().long()
+
+            offset = self._disc_offset.to(p.device)
+            x_ix = x_ix.clamp(0, h - 1).unsqueeze(-1) + offset[:, 0]
+            y_ix = y_ix.clamp(0, w - 1).unsqueeze(-1) + offset[:, 1]
+            is_inside = (x_ix >= 0) * (x_ix < h) * (y_ix >= 0) * (y_ix < w)
+
+            ix = x_ix.clamp(0, h - 1) * w + y_ix.clamp(0, w - 1)
+            log_w = log_w[ix_n, ix].masked_fill(~is_inside, float('-inf'))  # the target's own pixel is always inside
+
+        """Log-prob of targets under each component and log-sum-exp over the components --> N x M"""
+        z = (pxyz_tar.unsqueeze(2) - pxyz_mu[ix_n, ix]) / pxyz_sig[ix_n, ix]
+        log_comp = (-0.5 * z ** 2 - torch.log(pxyz_sig[ix_n, ix])).sum(-1) - 2 * math.log(2 * math.pi)
+
+        return torch.logsumexp(log_w + log_comp, dim=-1)
 
     def _forward_checks(self, output: torch.Tensor, target: tuple, weight: None):
 
@@ -265,10 +361,13 @@ class GaussianMMLoss(Loss):
             self._forward_checks(output, target, weight)
 
         tar_param, tar_mask, tar_bg = target
-        p, pxyz_mu, pxyz_sig, bg = self._format_model_output(output)
 
-        bg_loss = self._bg_loss(bg, tar_bg).sum(-1).sum(-1)
-        gmm_loss = self._compute_gmm_loss(p, pxyz_mu, pxyz_sig, tar_param, tar_mask)
+        """Log-probabilities and the bernoulli variance are not stable in reduced precision (mixed precision mode)"""
+        with amp.autocast_disabled():
+            p, pxyz_mu, pxyz_sig, bg = self._format_model_output(output.float())
+
+            bg_loss = self._bg_loss(bg, tar_bg.float()).sum(-1).sum(-1)
+            gmm_loss = self._compute_gmm_loss(p, pxyz_mu, pxyz_sig, tar_param.float(), tar_mask)
 
         """Stack in 2 channels. 
         Factor 2 because original impl. adds the two terms, but this way it's better for logging."""
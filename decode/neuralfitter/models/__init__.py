@@ -1,5 +1,8 @@
-import decode.neuralfitter.models.unet_param
-import decode.neuralfitter.models.model_param
-import decode.neuralfitter.models.model_speced_impl
+from decode.utils.lazy import lazy_package
 
-from .model_speced_impl import SigmaMUNet
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['model_param', 'model_speced_impl', 'unet_param', 'unet_parts'],
+    attributes={
+        'SigmaMUNet': 'model_speced_impl',
+    })
@@ -1,4 +1,7 @@
+from typing import Sequence
+
 import torch
+import torch.nn.functional as F
 from torch import nn as nn
 
 from . import unet_param
@@ -76,6 +79,13 @@ class SimpleSMLMNet(unet_param.UNet2d):
         """
         return lyd.weight_by_gradient(self.mt_heads, loss, optimizer)
 
+    def last_layer_grad_rescale(self, all_reduce: bool = False) -> lyd.LastLayerGradRescale:
+        """
+        Rescaling as in rescale_last_layer_grad within the main backward pass
+
+        """
+        return lyd.LastLayerGradRescale(self.mt_heads, all_reduce=all_reduce)
+
     def apply_pnl(self, o):
         """
         Apply nonlinearity (sigmoid) to p channel. This is combined during training in the loss function.
@@ -200,6 +210,20 @@ class DoubleMUnet(nn.Module):
         """
         return lyd.weight_by_gradient(self.mt_heads, loss, optimizer)
 
+    def last_layer_grad_rescale(self, all_reduce: bool = False) -> lyd.LastLayerGradRescale:
+        """
+        Rescaling as in rescale_last_layer_grad but within the main backward pass, i.e. without an extra backward per
+        head.
+
+        Args:
+            all_reduce: average the gradient magnitudes over the ranks (distributed data-parallel training)
+
+        Returns:
+            rescaling to capture the forward pass with and to apply after backward
+
+        """
+        return lyd.LastLayerGradRescale(self.mt_heads, all_reduce=all_reduce)
+
     def apply_detection_nonlin(self, x: torch.Tensor) -> torch.Tensor:
         """
         Apply detection non-linearity. Useful for non-training situations. When BCEWithLogits loss is used, do not use this
@@ -249,7 +273,36 @@ class DoubleMUnet(nn.Module):
 
         """
         o = self._forward_core(x)
+        return self._forward_heads(o, force_no_p_nl=force_no_p_nl)
+
+    def forward_shared(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Forwards single frames through the shared UNet, i.e. the part of the model which is applied to every frame of
+        the frame window separately. Together with forward_features, this allows to compute the shared features once
+        per frame instead of once per frame window (see Infer(..., sequential=True)).
+
+        Args:
+            x: frames of size N x 1 x H x W
+
+        Returns:
+            features of size N x inter_features x H x W
+
+        """
+        return self.unet_shared.forward(x)
+
+    def forward_features(self, f: torch.Tensor, **kwargs) -> torch.Tensor:
+        """
+        Forward from the shared features on, i.e. forward(x) equals forward_features of the concatenated (along the
+        channel dimension) forward_shared outputs of the frames of x.
+
+        Args:
+            f: shared features of the frame window of size N x (ch_in * inter_features) x H x W
+            **kwargs: passed on as in forward
 
+        """
+        return self._forward_heads(self.unet_union.forward(f), **kwargs)
+
+    def _forward_heads(self, o: torch.Tensor, force_no_p_nl=False) -> torch.Tensor:
         o_head = []
         for i in range(self.ch_out):
             o_head.append(self.mt_heads[i].forward(o))
@@ -265,19 +318,15 @@ class DoubleMUnet(nn.Module):
         return o
 
     def _forward_core(self, x) -> torch.Tensor:
-        if self.ch_in == 3:
-            x0 = x[:, [0]]
-            x1 = x[:, [1]]
-            x2 = x[:, [2]]
-
-            o0 = self.unet_shared.forward(x0)
-            o1 = self.unet_shared.forward(x1)
-            o2 = self.unet_shared.forward(x2)
+        if self.ch_in == 1:
+            o = self.forward_shared(x)
 
-            o = torch.cat((o0, o1, o2), 1)
-
-        elif self.ch_in == 1:
-            o = self.unet_shared.forward(x)
+        else:
+            """Fold the frame window into the batch dimension to forward the shared UNet once, then unfold the
+            features such that they are concatenated along the channel dimension (frame major)"""
+            n, _, h, w = x.size()
+            o = self.forward_shared(x.reshape(n * self.ch_in, 1, h, w))
+            o = o.reshape(n, self.ch_in * o.size(1), *o.size()[2:])
 
         o = self.unet_union.forward(o)
 
@@ -303,7 +352,7 @@ class MLTHeads(nn.Module):
 
     def forward(self, x):
         o = self.core.forward(x)
-        o = self.out_conv.forward(o)
+        o = self.out_conv(o)  # call instead of .forward, such that hooks (see LastLayerGradRescale) are run
 
         return o
 
@@ -322,3 +371,70 @@ class MLTHeads(nn.Module):
                                  activation)
         else:
             raise NotImplementedError
+
+
+class FusedMLTHeads(nn.Module):
+    def __init__(self, heads: Sequence[MLTHeads]):
+        """
+        Inference-time fusion of MLTHeads that act on the same features. The 3x3 convolutions of the heads are stacked
+        into one (grouped, if the heads normalise their input) convolution and the output convolutions into one with
+        block diagonal weight, such that all heads are computed in two convolution calls. The output equals the
+        concatenation of the head outputs along the channel dimension.
+
+        The weights are copied from the heads as non-persistent buffers, i.e. the state dict of the model is not
+        changed, and must be fused again when the weights of the heads change.
+
+        Args:
+            heads: heads to be fused
+
+        """
+        super().__init__()
+
+        if len({(h.norm, h.norm_groups, type(h.core[-1])) for h in heads}) != 1:
+            raise ValueError("Heads can only be fused if they have the same normalisation and activation.")
+
+        conv = [h.core[-2] for h in heads]
+        out_conv = [h.out_conv for h in heads]
+
+        self.n_heads = len(heads)
+        self.norm = heads[0].norm
+        self.activation = heads[0].core[-1]
+        self.padding = conv[0].padding
+
+        if self.norm == 'GroupNorm':
+            """The normalisation is the same for all heads, only the affine transformation differs"""
+            self.num_groups = heads[0].core[0].num_groups
+            self.eps = heads[0].core[0].eps
+            self.register_buffer('norm_weight', torch.cat([h.core[0].weight for h in heads]).detach().clone(),
+                                 persistent=False)
+            self.register_buffer('norm_bias', torch.cat([h.core[0].bias for h in heads]).detach().clone(),
+                                 persistent=False)
+
+        self.register_buffer('conv_weight', torch.cat([c.weight for c in conv]).detach().clone(), persistent=False)
+        self.register_buffer('conv_bias', torch.cat([c.bias for c in conv]).detach().clone(), persistent=False)
+
+        """Output convolution with block diagonal weight, i.e. output channels of head i only see its features"""
+        c_in = conv[0].out_channels
+        out_weight = torch.zeros(sum(c.out_channels for c in out_conv), c_in * self.n_heads,
+                                 *out_conv[0].kernel_size, dtype=out_conv[0].weight.dtype)
+        ix = 0
+        for i, c in enumerate(out_conv):
+            out_weight[ix:ix + c.out_channels, i * c_in:(i + 1) * c_in] = c.weight.detach()
+            ix += c.out_channels
+
+        self.register_buffer('out_weight', out_weight, persistent=False)
+        self.register_buffer('out_bias', torch.cat([c.bias for c in out_conv]).detach().clone(), persistent=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.norm == 'GroupNorm':
+            x = F.group_norm(x, self.num_groups, eps=self.eps).repeat(1, self.n_heads, 1, 1)
+            x = x * self.norm_weight.view(1, -1, 1, 1) + self.norm_bias.view(1, -1, 1, 1)
+            groups = self.n_heads
+        else:
+            groups = 1  # all heads see the same input
+
+        o = F.conv2d(x, self.conv_weight, self.conv_bias, padding=self.padding, groups=groups)
+        o = self.activation(o)
+        o = F.conv2d(o, self.out_weight, self.out_bias)
+
+        return o
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Optional, Union
 
 import torch
 from torch import nn
@@ -51,12 +51,32 @@ class SigmaMUNet(model_param.DoubleMUnet):
             torch.nn.init.kaiming_normal_(self.mt_heads[0].out_conv.weight, mode='fan_in', nonlinearity='linear')
             torch.nn.init.constant_(self.mt_heads[0].out_conv.bias, -6.)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, heads_fused: Optional[model_param.FusedMLTHeads] = None) -> torch.Tensor:
+        """
+
+        Args:
+            x: frame windows
+            heads_fused: fused heads (see fuse_heads) to be used instead of the separate heads
+
+        """
         x = self._forward_core(x)
+        return self._forward_heads(x, heads_fused=heads_fused)
+
+    def fuse_heads(self) -> model_param.FusedMLTHeads:
+        """
+        Heads fused for inference (see FusedMLTHeads), to be passed to forward / forward_features. They hold a copy of
+        the current weights of the heads, i.e. fuse again after the weights changed.
+
+        """
+        return model_param.FusedMLTHeads(self.mt_heads)
+
+    def _forward_heads(self, x: torch.Tensor, heads_fused: Optional[model_param.FusedMLTHeads] = None) -> torch.Tensor:
+        if heads_fused is not None:
+            return self._forward_heads_fused(x, heads_fused)
 
         """Forward through the respective heads"""
         x_heads = [mt_head.forward(x) for mt_head in self.mt_heads]
-        x = torch.cat(x_heads, dim=1)
+        x = self._upcast(torch.cat(x_heads, dim=1))
 
         """Clamp prob before sigmoid"""
         x[:, [0]] = torch.clamp(x[:, [0]], min=-8., max=8.)
@@ -70,6 +90,23 @@ class SigmaMUNet(model_param.DoubleMUnet):
 
         return x
 
+    def _forward_heads_fused(self, x: torch.Tensor, heads_fused: model_param.FusedMLTHeads) -> torch.Tensor:
+        x = self._upcast(heads_fused(x))
+
+        """Non linearities in place on contiguous channel ranges (p, phot | xyz | phot, xyz sigma, bg)"""
+        x[:, 0].clamp_(min=-8., max=8.)
+        x[:, 0:2].sigmoid_()
+        x[:, 2:5].tanh_()
+        x[:, 5:10].sigmoid_()
+        x[:, self.pxyz_sig_ch_ix].mul_(3).add_(self.sigma_eps)
+
+        return x
+
+    @staticmethod
+    def _upcast(x: torch.Tensor) -> torch.Tensor:
+        """Reduced precision to float32, because the sigma epsilon is below its resolution. Other types unchanged."""
+        return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
+
     def apply_detection_nonlin(self, x: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
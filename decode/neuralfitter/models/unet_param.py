@@ -130,6 +130,9 @@ class UNetBase(nn.Module):
         # activation afterwards
         self.out_conv = self._out_conv(n_features[-1], out_channels)
         self.activation = get_activation(final_activation)
+        # the concatenations of the skip connections, as modules such that each one gets its own quantization
+        # parameters when the network is quantized (plain torch.cat in float)
+        self.skip_cat = nn.ModuleList([torch.ao.nn.quantized.FloatFunctional() for _ in range(self.depth)])
 
     @staticmethod
     def _crop_tensor(input_, shape_to_crop):
@@ -146,9 +149,9 @@ class UNetBase(nn.Module):
         return input_[crop]
 
     # crop the `from_encoder` tensor and concatenate both
-    def _crop_and_concat(self, from_decoder, from_encoder):
+    def _crop_and_concat(self, from_decoder, from_encoder, level):
         cropped = self._crop_tensor(from_encoder, from_decoder.shape)
-        return torch.cat((cropped, from_decoder), dim=1)
+        return self.skip_cat[level].cat((cropped, from_decoder), dim=1)
 
     def forward_parts(self, parts):
         if 'encoder' in parts:
@@ -169,7 +172,7 @@ class UNetBase(nn.Module):
             for level in range(self.depth):
                 x = self.upsamplers[level](x)
                 x = self.decoder[level](self._crop_and_concat(x,
-                                                              encoder_out[level]))
+                                                              encoder_out[level], level))
 
             # apply output conv and activation (if given)
             x = self.out_conv(x)
@@ -195,7 +198,7 @@ class UNetBase(nn.Module):
         for level in range(self.depth):
             x = self.upsamplers[level](x)
             x = self.decoder[level](self._crop_and_concat(x,
-                                                          encoder_out[level]))
+                                                          encoder_out[level], level))
 
         # apply output conv and activation (if given)
         x = self.out_conv(x)
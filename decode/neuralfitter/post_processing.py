@@ -291,6 +291,11 @@ class SpatialIntegration(LookUpPostProcessing):
 
             return p_ps.squeeze(1)
 
+    @staticmethod
+    def _norm_sum(*args):
+        # not a closure, such that the post-processing can be pickled (e.g. for asynchronous evaluation)
+        return torch.clamp(torch.add(*args), 0., 1.)
+
     @classmethod
     def set_p_aggregation(cls, p_aggr: Union[str, Callable]) -> Callable:
         """
@@ -308,10 +313,7 @@ class SpatialIntegration(LookUpPostProcessing):
             elif p_aggr == 'max':
                 return torch.max
             elif p_aggr == 'norm_sum':
-                def norm_sum(*args):
-                    return torch.clamp(torch.add(*args), 0., 1.)
-
-                return norm_sum
+                return cls._norm_sum
             else:
                 raise ValueError
 
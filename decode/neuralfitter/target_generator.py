@@ -287,18 +287,25 @@ class ParameterListTarget(TargetGenerator):
         else:
             raise NotImplementedError
 
-        """Set number of active elements per frame"""
-        for i in range(n_frames):
-            n_emitter = len(em.get_subset_frame(i, i))
+        """
+        Set active elements per frame in one pass. Emitters are sorted by frame (keeping their order within the frame)
+        and their rank within the frame is their slot in the target.
+        """
+        n_em = len(em)
+        frame_ix = em.frame_ix.long()
+        n_per_frame = torch.bincount(frame_ix, minlength=n_frames)
 
-            if n_emitter > self.n_max:
-                raise ValueError("Number of actual emitters exceeds number of max. emitters.")
+        if n_per_frame.max() > self.n_max:
+            raise ValueError("Number of actual emitters exceeds number of max. emitters.")
 
-            mask_tar[i, :n_emitter] = 1
+        # unique sort key (frame first, then original position) makes the sort stable
+        _, ix_sort = torch.sort(frame_ix * n_em + torch.arange(n_em))
+        frame_ix_sort = frame_ix[ix_sort]
+        rank = torch.arange(n_em) - (torch.cumsum(n_per_frame, 0) - n_per_frame)[frame_ix_sort]
 
-            ix = em.frame_ix == i
-            param_tar[i, :n_emitter, 0] = em[ix].phot
-            param_tar[i, :n_emitter, 1:] = xyz[ix]
+        mask_tar[frame_ix_sort, rank] = 1
+        param_tar[frame_ix_sort, rank, 0] = em.phot[ix_sort]
+        param_tar[frame_ix_sort, rank, 1:] = xyz[ix_sort]
 
         return self._postprocess_output(param_tar), self._postprocess_output(mask_tar), bg
 
@@ -1,2 +1,5 @@
-import decode.neuralfitter.train.random_simulation
-import decode.neuralfitter.train.live_engine
+from decode.utils.lazy import lazy_package
+
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['distributed', 'live_engine', 'random_simulation'])
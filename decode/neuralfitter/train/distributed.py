@@ -0,0 +1,115 @@
+import os
+import random
+from typing import NamedTuple, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class DistContext(NamedTuple):
+    rank: int
+    local_rank: int
+    world_size: int
+
+    @property
+    def distributed(self) -> bool:
+        return self.world_size > 1
+
+    @property
+    def is_main(self) -> bool:
+        return self.rank == 0
+
+
+def init(backend: Optional[str] = None) -> DistContext:
+    """
+    Initialises the default process group from the environment variables set by torchrun (RANK, LOCAL_RANK,
+    WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Without them (or with a world size of 1) nothing is initialised and the
+    context of a single process is returned.
+
+    Args:
+        backend: communication backend, defaults to nccl if cuda is available and gloo otherwise
+
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    rank = int(os.environ.get('RANK', 0))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    if world_size > 1 and not dist.is_initialized():
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        dist.init_process_group(backend=backend, init_method='env://', rank=rank, world_size=world_size)
+
+    return DistContext(rank=rank, local_rank=local_rank, world_size=world_size)
+
+
+def cleanup():
+    """
+    Waits for all ranks and destroys the default process group. A gloo group is left to the process exit, because
+    destroying it while the peer rank already exits occasionally hangs.
+    """
+    if dist.is_initialized():
+        dist.barrier()
+        if dist.get_backend() != 'gloo':
+            dist.destroy_process_group()
+
+
+def broadcast_object(obj, ctx: DistContext, src: int = 0):
+    """
+    Returns obj of rank src on all ranks (e.g. the experiment id which contains a timestamp).
+
+    Args:
+        obj: picklable object
+        ctx: distributed context
+        src: source rank
+
+    """
+    if not ctx.distributed:
+        return obj
+
+    obj_list = [obj]
+    dist.broadcast_object_list(obj_list, src=src)
+    return obj_list[0]
+
+
+def seed_rank(ctx: DistContext) -> int:
+    """
+    Seeds python, numpy and torch of each rank with a common base seed (drawn on rank 0) plus the rank, such that the
+    ranks simulate independent training data.
+
+    Returns:
+        int: seed of this rank
+
+    """
+    base = broadcast_object(torch.initial_seed() % 2 ** 31, ctx)
+    seed = base + ctx.rank
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    return seed
+
+
+def shard_param(param, world_size: int):
+    """
+    Splits the training data per epoch and the batch size over the ranks (inplace), such that the global dataset and
+    batch size remain the ones of the parameter file and gradients averaged over ranks correspond to single process
+    training.
+
+    Args:
+        param: parameters
+        world_size: number of ranks
+
+    """
+    if world_size == 1:
+        return param
+
+    if param.HyperParameter.batch_size % world_size != 0:
+        raise ValueError(f"Batch size ({param.HyperParameter.batch_size}) must be divisible by the number of "
+                         f"processes ({world_size}).")
+
+    param.HyperParameter.batch_size //= world_size
+    param.HyperParameter.pseudo_ds_size //= world_size
+
+    return param
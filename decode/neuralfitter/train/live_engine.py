@@ -5,6 +5,7 @@ import os
 import sys
 import shutil
 import socket
+import warnings
 from pathlib import Path
 
 import torch
@@ -15,9 +16,10 @@ import decode.neuralfitter.coord_transform
 import decode.neuralfitter.utils
 import decode.simulation
 import decode.utils
+from decode.neuralfitter.train import distributed
 from decode.neuralfitter.train.random_simulation import setup_random_simulation
 from decode.neuralfitter.utils import log_train_val_progress
-from decode.utils.checkpoint import CheckPoint
+from decode.utils.checkpoint import CheckPoint, get_rng_state, set_rng_state
 
 
 def parse_args():
@@ -51,16 +53,29 @@ def parse_args():
     parser.add_argument('-c', '--log_comment', default=None,
                         help='Add a log_comment to the run.')
 
+    parser.add_argument('-b', '--dist_backend', default=None,
+                        help='Backend for distributed training when launched via torchrun (gloo, nccl). '
+                             'Defaults to nccl if cuda is available, gloo otherwise.')
+
+    parser.add_argument('-r', '--resume', default=None,
+                        help='Resume the training of this experiment folder from its checkpoint (ckpt.pt).')
+
     args = parser.parse_args()
     return args
 
 
 def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False, no_log: bool = False,
                       num_worker_override: int = None,
-                      log_folder: str = 'runs', log_comment: str = None):
+                      log_folder: str = 'runs', log_comment: str = None, dist_backend: str = None,
+                      resume: str = None):
     """
     Sets up the engine to train DeepSMLM. Includes sample simulation and the actual training.
 
+    When launched via torchrun (e.g. torchrun --nproc_per_node 4 -m decode.neuralfitter.train.live_engine -p ...),
+    training is distributed data-parallel: each rank simulates its own shard of the training data with an
+    independent seed and gradients are averaged over ranks. Test set evaluation, logging and checkpointing are done
+    by rank 0 only.
+
     Args:
         param_file: parameter file path
         cuda_ix: overwrite cuda index specified by param file
@@ -69,9 +84,17 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
         num_worker_override: overwrite number of workers for dataloader
         log_folder: folder for logging (where tensorboard puts its stuff)
         log_comment: comment to the experiment
+        dist_backend: backend for distributed training
+        resume: experiment folder of a previous run. Model, optimizer, lr scheduler, gradient scaler, epoch, log,
+            random number generator states and (if InOut.checkpoint_train_set) the current training set are restored
+            from its checkpoint and the run continues in this folder. In distributed training, the random number
+            generators are seeded anew and the ranks simulate a new training set.
 
     """
 
+    """Distributed setup, no-op if not launched via torchrun"""
+    dist_ctx = distributed.init(dist_backend)
+
     """Load Parameters and back them up to the network output directory"""
     param_file = Path(param_file)
     param = decode.utils.param_io.ParamHandling().load_params(param_file)
@@ -80,7 +103,10 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
     param = decode.utils.param_io.autoset_scaling(param)
 
     """Experiment ID"""
-    if not debug:
+    if resume is not None:
+        experiment_id = Path(resume).name
+
+    elif not debug:
         experiment_id = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + '_' + socket.gethostname()
 
         if log_comment:
@@ -89,25 +115,32 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
     else:
         experiment_id = 'debug'
 
-    """Set up unique folder for experiment"""
-    experiment_path = Path(param.InOut.experiment_out) / Path(experiment_id)
-    if not experiment_path.parent.exists():
-        experiment_path.parent.mkdir()
-
-    if debug:
-        experiment_path.mkdir(exist_ok=True)
-    else:
-        experiment_path.mkdir(exist_ok=False)
+    experiment_id = distributed.broadcast_object(experiment_id, dist_ctx)  # timestamp of rank 0
 
+    """Set up unique folder for experiment"""
+    experiment_path = Path(resume) if resume is not None else Path(param.InOut.experiment_out) / Path(experiment_id)
     model_out = experiment_path / Path('model.pt')
     ckpt_path = model_out.parent / Path('ckpt.pt')
+    train_set_path = experiment_path / 'ckpt_train_set'
+
+    if resume is not None:  # continue in the existing folder, parameters were backed up by the initial run
+        ckpt_resume = CheckPoint.load(ckpt_path)
+
+    elif dist_ctx.is_main:
+        if not experiment_path.parent.exists():
+            experiment_path.parent.mkdir()
+
+        if debug:
+            experiment_path.mkdir(exist_ok=True)
+        else:
+            experiment_path.mkdir(exist_ok=False)
 
-    # Backup the parameter file under the network output path with the experiments ID
-    param_backup_in = experiment_path / Path('param_run_in').with_suffix(param_file.suffix)
-    shutil.copy(param_file, param_backup_in)
+        # Backup the parameter file under the network output path with the experiments ID
+        param_backup_in = experiment_path / Path('param_run_in').with_suffix(param_file.suffix)
+        shutil.copy(param_file, param_backup_in)
 
-    param_backup = experiment_path / Path('param_run').with_suffix(param_file.suffix)
-    decode.utils.param_io.ParamHandling().write_params(param_backup, param)
+        param_backup = experiment_path / Path('param_run').with_suffix(param_file.suffix)
+        decode.utils.param_io.ParamHandling().write_params(param_backup, param)
 
     if debug:
         decode.utils.param_io.ParamHandling.convert_param_debug(param)
@@ -115,10 +148,21 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
     if num_worker_override is not None:
         param.Hardware.num_worker_train = num_worker_override
 
+    """Split training data and batch over the ranks, each rank simulates with its own seed"""
+    param = distributed.shard_param(param, dist_ctx.world_size)
+    if dist_ctx.distributed:
+        distributed.seed_rank(dist_ctx)
+
     """Hardware / Server stuff."""
     cuda_ix = int(param.Hardware.device_ix) if cuda_ix is None else cuda_ix
+    if dist_ctx.distributed:
+        cuda_ix = dist_ctx.local_rank
+        if 'cuda' in str(param.Hardware.device_simulation):
+            param.Hardware.device_simulation = f'cuda:{cuda_ix}'
+
     if torch.cuda.is_available():
         torch.cuda.set_device(cuda_ix)  # do this instead of set env variable, because torch is inevitably already imported
+        decode.utils.hardware.check_device_capability()
         device = 'cuda'
 
     else:
@@ -135,7 +179,7 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
     torch.set_num_threads(param.Hardware.torch_threads)
 
     """Setup Log System"""
-    if no_log:
+    if no_log or not dist_ctx.is_main:
         logger = decode.neuralfitter.utils.logger.NoLog()
 
     else:
@@ -145,24 +189,69 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
             [decode.neuralfitter.utils.logger.SummaryWriter(log_dir=log_folder,
                                                             filter_keys=["dx_red_mu", "dx_red_sig", "dy_red_mu",
                                                                          "dy_red_sig", "dz_red_mu", "dz_red_sig",
-                                                                         "dphot_red_mu", "dphot_red_sig"]),
+                                                                         "dphot_red_mu", "dphot_red_sig"],
+                                                            # drop events logged after the checkpoint
+                                                            purge_step=ckpt_resume.step + 1 if resume else None),
              decode.neuralfitter.utils.logger.DictLogger()])
 
+        if resume is not None and ckpt_resume.log is not None:
+            logger.logger[1].log_dict = ckpt_resume.log
+
     sim_train, sim_test = setup_random_simulation(param)
     ds_train, ds_test, model, model_ls, optimizer, criterion, lr_scheduler, grad_mod, post_processor, matcher, ckpt = \
-        setup_trainer(sim_train, sim_test, logger, model_out, ckpt_path, device, param)
+        setup_trainer(sim_train, sim_test, logger, model_out, ckpt_path, device, param,
+                      sample_test=dist_ctx.is_main, sample_train=resume is None)
 
-    dl_train, dl_test = setup_dataloader(param, ds_train, ds_test)
+    dl_train, dl_test = setup_dataloader(param, ds_train, ds_test if dist_ctx.is_main else None)
+
+    """Wrap for distributed training, the unwrapped model is used for test, checkpoints and export"""
+    model_train = model
+    if dist_ctx.distributed:
+        model_train = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[cuda_ix] if device == 'cuda' else None)
+
+    grad_scaler = decode.neuralfitter.utils.amp.grad_scaler(device, enabled=param.HyperParameter.mixed_precision)
 
     # useful if we restart a training
     first_epoch = param.HyperParameter.epoch_0 if param.HyperParameter.epoch_0 is not None else 0
 
+    """Restore the full training state"""
+    if resume is not None:
+        model.load_state_dict(ckpt_resume.model_state)
+        optimizer.load_state_dict(ckpt_resume.optimizer_state)
+        lr_scheduler.load_state_dict(ckpt_resume.lr_sched_state)
+        if grad_scaler is not None and ckpt_resume.grad_scaler_state is not None:
+            grad_scaler.load_state_dict(ckpt_resume.grad_scaler_state)
+        first_epoch = ckpt_resume.step + 1
+
+        # the training set of the checkpoint stems from this rank only, the others must sample their own
+        if param.Simulation.mode == 'acquisition' and \
+                (dist_ctx.distributed or not ds_train.load_sample(train_set_path / str(ckpt_resume.step))):
+            ds_train.sample(True)
+
+        if not dist_ctx.distributed and ckpt_resume.rng_state is not None:
+            set_rng_state(ckpt_resume.rng_state)
+
+    if dist_ctx.is_main and param.Evaluation.streaming:
+        post_process_log_stream = log_train_val_progress.StreamingPostProcessLogTest(
+            post_processor=post_processor, matcher=matcher, em_tar=ds_test.emitter, px_border=-0.5, px_size=1.)
+
+    elif dist_ctx.is_main and param.Evaluation.asynchronous:
+        post_process_log_async = log_train_val_progress.AsyncPostProcessLogTest(
+            post_processor=post_processor, matcher=matcher, px_border=-0.5, px_size=1., logger=logger)
+
+    if param.Hardware.timing_trace and dist_ctx.is_main:
+        trace_path = experiment_path / 'timing'
+        trace_path.mkdir(exist_ok=True)
+
     for i in range(first_epoch, param.HyperParameter.epochs):
         logger.add_scalar('learning/learning_rate', optimizer.param_groups[0]['lr'], i)
+        timer = decode.utils.timing.StageTimer(cuda_sync=param.Hardware.timing_cuda_sync,
+                                               trace=param.Hardware.timing_trace)
 
         if i >= 1:
             train_loss = decode.neuralfitter.train_val_impl.train(
-                model=model,
+                model=model_train,
                 optimizer=optimizer,
                 loss=criterion,
                 dataloader=dl_train,
@@ -170,41 +259,90 @@ def live_engine_setup(param_file: str, cuda_ix: int = None, debug: bool = False,
                 grad_mod=grad_mod,
                 epoch=i,
                 device=torch.device(device),
-                logger=logger
+                logger=logger,
+                mixed_precision=param.HyperParameter.mixed_precision,
+                grad_scaler=grad_scaler,
+                timer=timer
             )
 
-        val_loss, test_out = decode.neuralfitter.train_val_impl.test(model=model, loss=criterion, dataloader=dl_test,
-                                                                     epoch=i,
-                                                                     device=torch.device(device))
-
-        """Post-Process and Evaluate"""
-        log_train_val_progress.post_process_log_test(loss_cmp=test_out.loss, loss_scalar=val_loss,
-                                                     x=test_out.x, y_out=test_out.y_out, y_tar=test_out.y_tar,
-                                                     weight=test_out.weight, em_tar=ds_test.emitter,
-                                                     px_border=-0.5, px_size=1.,
-                                                     post_processor=post_processor, matcher=matcher, logger=logger,
-                                                     step=i)
+        val_loss = None
+        if dist_ctx.is_main:  # test and evaluation on rank 0 only
+            with timer.stage('test'):
+                val_loss, test_out = decode.neuralfitter.train_val_impl.test(
+                    model=model, loss=criterion, dataloader=dl_test, epoch=i, device=torch.device(device),
+                    stream=post_process_log_stream if param.Evaluation.streaming else None)
+
+            """Post-Process and Evaluate"""
+            log_figures = bool(param.Evaluation.log_figures_every) and i % param.Evaluation.log_figures_every == 0
+            with timer.stage('evaluation'):
+                if param.Evaluation.streaming:  # post-processed and matched during test already
+                    post_process_log_stream.log(loss_cmp=test_out.loss, loss_scalar=val_loss, logger=logger, step=i,
+                                                log_figures=log_figures)
+                elif param.Evaluation.asynchronous:
+                    post_process_log_async.submit(loss_cmp=test_out.loss, loss_scalar=val_loss, x=test_out.x,
+                                                  y_out=test_out.y_out, y_tar=test_out.y_tar, weight=test_out.weight,
+                                                  em_tar=ds_test.emitter, step=i, log_figures=log_figures)
+                else:
+                    log_train_val_progress.post_process_log_test(loss_cmp=test_out.loss, loss_scalar=val_loss,
+                                                                 x=test_out.x, y_out=test_out.y_out,
+                                                                 y_tar=test_out.y_tar, weight=test_out.weight,
+                                                                 em_tar=ds_test.emitter, px_border=-0.5, px_size=1.,
+                                                                 post_processor=post_processor, matcher=matcher,
+                                                                 logger=logger, step=i, log_figures=log_figures)
+
+        val_loss = distributed.broadcast_object(val_loss, dist_ctx)  # all ranks need it for the lr scheduler
 
         if isinstance(lr_scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
             lr_scheduler.step(val_loss)
         else:
             lr_scheduler.step()
 
-        model_ls.save(model, None)
-        if no_log:
-            ckpt.dump(model.state_dict(), optimizer.state_dict(), lr_scheduler.state_dict(), step=i)
-        else:
-            ckpt.dump(model.state_dict(), optimizer.state_dict(), lr_scheduler.state_dict(),
-                      log=logger.logger[1].log_dict, step=i)
-
         """Draw new samples Samples"""
-        if param.Simulation.mode in 'acquisition':
-            ds_train.sample(True)
-        elif param.Simulation.mode != 'samples':
-            raise ValueError
-
-
-def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path, device, param):
+        with timer.stage('resample'):
+            if param.Simulation.mode in 'acquisition':
+                generation = ds_train.store.generation
+                ds_train.sample(True)
+                if ds_train.store.generation != generation:  # shared memory reallocated, restart the workers
+                    dl_train, _ = setup_dataloader(param, ds_train)
+            elif param.Simulation.mode != 'samples':
+                raise ValueError
+
+        """Checkpoint after resampling, i.e. training set and random state are the ones the next epoch starts with"""
+        if dist_ctx.is_main:
+            with timer.stage('checkpoint'):
+                model_ls.save(model, None)
+                ckpt.dump(model.state_dict(), optimizer.state_dict(), lr_scheduler.state_dict(), step=i,
+                          log=None if no_log else logger.logger[1].log_dict, rng_state=get_rng_state(),
+                          grad_scaler_state=grad_scaler.state_dict() if grad_scaler is not None else None)
+
+                if param.InOut.checkpoint_train_set and param.Simulation.mode == 'acquisition':
+                    ds_train.save_sample(train_set_path / str(i))
+                    # keep the previous two, i.e. those of the checkpoint in flight (the one of this step may be queued
+                    # behind it) and of the one on disk, in case the writes fail
+                    for p in train_set_path.iterdir():
+                        if p.name.isdigit() and int(p.name) < i - 2:
+                            shutil.rmtree(p)
+
+        log_train_val_progress.log_timing(timer, logger=logger, step=i)
+        if param.Hardware.timing_trace and dist_ctx.is_main:
+            timer.dump_chrome_trace(trace_path / f'epoch_{i}.json')
+
+    """Wait for the last evaluation to be logged and checkpoint / model to be written"""
+    if param.Evaluation.asynchronous and not param.Evaluation.streaming and dist_ctx.is_main:
+        post_process_log_async.close()
+    model_ls.wait()
+    ckpt.wait()
+
+    if param.InOut.export_graph and dist_ctx.is_main:
+        graph_out = decode.neuralfitter.inference.export.graph_path(model_out)
+        decode.neuralfitter.inference.export.export(model, post_processor, graph_out, device=device)
+        print(f"Exported model and post-processing to {graph_out}")
+
+    distributed.cleanup()
+
+
+def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path, device, param,
+                  sample_test: bool = True, sample_train: bool = True):
     """
 
     Args:
@@ -215,6 +353,8 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
         model_out:
         ckpt_path: path of checkpoint
         param:
+        sample_test: sample the test set (not needed on ranks other than 0 in distributed training)
+        sample_train: sample the training set (not needed if it is restored from a checkpoint)
 
     Returns:
 
@@ -231,7 +371,8 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
 
     model_ls = decode.utils.model_io.LoadSaveModel(model,
                                                    output_file=model_out,
-                                                   input_file=param.InOut.model_init)
+                                                   input_file=param.InOut.model_init,
+                                                   asynchronous=True)
 
     model = model_ls.load_init()
     model = model.to(torch.device(device))
@@ -250,7 +391,9 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
                                                         yextent=param.Simulation.psf_extent[1],
                                                         img_shape=param.Simulation.img_size,
                                                         device=device,
-                                                        chweight_stat=param.HyperParameter.chweight_stat)
+                                                        chweight_stat=param.HyperParameter.chweight_stat,
+                                                        n_components=param.HyperParameter.gmm_n_components,
+                                                        radius=param.HyperParameter.gmm_radius)
 
     """Learning Rate and Simulation Scheduling"""
     lr_scheduler_available = {
@@ -261,7 +404,7 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
     lr_scheduler = lr_scheduler(optimizer, **param.HyperParameter.learning_rate_scheduler_param)
 
     """Checkpointing"""
-    checkpoint = CheckPoint(path=ckpt_path)
+    checkpoint = CheckPoint(path=ckpt_path, asynchronous=True)
 
     """Setup gradient modification"""
     grad_mod = param.HyperParameter.grad_mod
@@ -319,7 +462,8 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
                                                                frame_window=param.HyperParameter.channels_in,
                                                                pad=None, return_em=False)
 
-        train_ds.sample(True)
+        if sample_train:
+            train_ds.sample(True)
 
     elif param.Simulation.mode == 'samples':
         train_ds = decode.neuralfitter.dataset.SMLMLiveSampleDataset(simulator=simulator_train, em_proc=em_filter,
@@ -336,7 +480,16 @@ def setup_trainer(simulator_train, simulator_test, logger, model_out, ckpt_path,
                                                              frame_window=param.HyperParameter.channels_in,
                                                              pad=None, return_em=False)
 
-    test_ds.sample(True)
+    test_cache = None
+    if param.TestSet.cache_dir is not None:
+        if param.TestSet.seed is None:
+            warnings.warn("Test set is only cached if a seed is specified (TestSet.seed).")
+        else:
+            test_cache = Path(param.TestSet.cache_dir) / decode.neuralfitter.utils.dataset_cache.test_set_key(
+                param, param.TestSet.seed)
+
+    if sample_test:
+        test_ds.sample(True, seed=param.TestSet.seed, cache=test_cache)
 
     """Set up post processor"""
     if param.PostProcessing is None:
@@ -399,6 +552,7 @@ def setup_dataloader(param, train_ds, test_ds=None):
         drop_last=True,
         shuffle=True,
         num_workers=param.Hardware.num_worker_train,
+        persistent_workers=param.Hardware.num_worker_train > 0,  # workers read resampled data via shared memory
         pin_memory=True,
         collate_fn=decode.neuralfitter.utils.collate.smlm_collate)
 
@@ -422,4 +576,4 @@ def setup_dataloader(param, train_ds, test_ds=None):
 if __name__ == '__main__':
     args = parse_args()
     live_engine_setup(args.param_file, args.cuda_ix, args.debug, args.no_log, args.num_worker_override, args.log_folder,
-                      args.log_comment)
+                      args.log_comment, args.dist_backend, args.resume)
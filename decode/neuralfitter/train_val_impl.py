@@ -1,53 +1,94 @@
+import contextlib
 import torch
 import time
-from typing import Union
+from typing import Optional, Union
 
 from tqdm import tqdm
 from collections import namedtuple
 
-from .utils import log_train_val_progress
+from .utils import amp, log_train_val_progress
 from ..evaluation.utils import MetricMeter
+from ..utils.timing import StageTimer
 
 
-def train(model, optimizer, loss, dataloader, grad_rescale, grad_mod, epoch, device, logger) -> float:
+def train(model, optimizer, loss, dataloader, grad_rescale, grad_mod, epoch, device, logger,
+          mixed_precision: bool = False, grad_scaler: Optional[torch.cuda.amp.GradScaler] = None,
+          timer: Optional[StageTimer] = None) -> float:
+    """
+    Trains the model for one epoch.
+
+    Args:
+        grad_rescale: weight the loss channels by the inverse gradient magnitude of the respective head's last layer
+            (Moeller et al.). Computed within the main backward pass, see LastLayerGradRescale.
+        mixed_precision: run the forward pass (model and loss) under autocast, i.e. in bfloat16 on CPU and float16 on
+            CUDA. The loss itself is computed in float32.
+        grad_scaler: gradient scaler (needed for float16 mixed precision, see amp.grad_scaler). Must persist across
+            epochs.
+        timer: records the time spent in the stages of the loop (data, h2d, forward, loss, backward, clip, optimizer)
+
+    Returns:
+        mean loss of epoch
+
+    """
 
     """Some Setup things"""
     model.train()
     tqdm_enum = tqdm(dataloader, total=len(dataloader), smoothing=0.)  # progress bar enumeration
-    t0 = time.time()
+    timer = timer if timer is not None else StageTimer()
+    if grad_rescale:  # hooks on the heads of the wrapped model, the normalisation must be the same on all ranks
+        ddp = isinstance(model, torch.nn.parallel.DistributedDataParallel)
+        grad_rescaler = (model.module if ddp else model).last_layer_grad_rescale(all_reduce=ddp)
+    else:
+        grad_rescaler = None
+    t0 = time.perf_counter()
     loss_epoch = MetricMeter()
 
     """Actual Training"""
     for batch_num, (x, y_tar, weight) in enumerate(tqdm_enum):  # model input (x), target (yt), weights (w)
 
         """Monitor time to get the data"""
-        t_data = time.time() - t0
+        t_data_end = time.perf_counter()
+        timer.record('data', t0, t_data_end)
+        t_data = t_data_end - t0
 
         """Ship the data to the correct device"""
-        x, y_tar, weight = ship_device([x, y_tar, weight], device)
-        
-        """Forward the data"""
-        y_out = model(x)
-
-        """Reset the optimiser, compute the loss and backprop it"""
-        loss_val = loss(y_out, y_tar, weight)
-
-        if grad_rescale:  # rescale gradients so that they are in the same order for the last layer
-            weight, _, _ = model.rescale_last_layer_grad(loss_val, optimizer)
-            loss_val = loss_val * weight
+        with timer.stage('h2d'):
+            x, y_tar, weight = ship_device([x, y_tar, weight], device)
 
-        optimizer.zero_grad()
-        loss_val.mean().backward()
+        """Forward the data and compute the loss"""
+        with amp.autocast(device, enabled=mixed_precision):
+            with timer.stage('forward'), grad_rescaler.capture() if grad_rescale else contextlib.nullcontext():
+                y_out = model(x)
+            with timer.stage('loss'):
+                loss_val = loss(y_out, y_tar, weight)
+
+        """Reset the optimiser and backprop"""
+        with timer.stage('backward'):
+            optimizer.zero_grad()
+            if grad_scaler is not None:
+                grad_scaler.scale(loss_val.mean()).backward()
+                grad_scaler.unscale_(optimizer)  # such that clipping acts on the actual gradients
+            else:
+                loss_val.mean().backward()
+
+            if grad_rescale:  # rescale gradients so that they are in the same order for the last layer
+                loss_val = loss_val.detach() * grad_rescaler.apply(model.parameters())
 
         """Gradient Modification"""
         if grad_mod:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=0.03, norm_type=2)
+            with timer.stage('clip'):
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=0.03, norm_type=2)
 
         """Update model parameters"""
-        optimizer.step()
+        with timer.stage('optimizer'):
+            if grad_scaler is not None:
+                grad_scaler.step(optimizer)  # skips the step if gradients are inf / nan
+                grad_scaler.update()
+            else:
+                optimizer.step()
 
         """Monitor overall time"""
-        t_batch = time.time() - t0
+        t_batch = time.perf_counter() - t0
 
         """Logging"""
         loss_mean, loss_cmp = loss.log(loss_val)  # compute individual loss components
@@ -55,7 +96,7 @@ def train(model, optimizer, loss, dataloader, grad_rescale, grad_mod, epoch, dev
         loss_epoch.update(loss_mean)
         tqdm_enum.set_description(f"E: {epoch} - t: {t_batch:.2} - t_dat: {t_data:.2} - L: {loss_mean:.3}")
 
-        t0 = time.time()
+        t0 = time.perf_counter()
 
     log_train_val_progress.log_train(loss_p_batch=loss_epoch.vals, loss_mean=loss_epoch.mean, logger=logger, step=epoch)
 
@@ -65,7 +106,19 @@ def train(model, optimizer, loss, dataloader, grad_rescale, grad_mod, epoch, dev
 _val_return = namedtuple("network_output", ["loss", "x", "y_out", "y_tar", "weight", "em_tar"])
 
 
-def test(model, loss, dataloader, epoch, device):
+def test(model, loss, dataloader, epoch, device, stream=None):
+    """
+    Forwards the test set through the model.
+
+    Args:
+        stream: if specified, the input and output of every batch are handed to stream.update (see
+            log_train_val_progress.StreamingPostProcessLogTest) instead of being kept for the whole test set. x and
+            y_out of the returned network output are None then.
+
+    Returns:
+        mean loss, network output
+
+    """
 
     """Setup"""
     x_ep, y_out_ep, y_tar_ep, weight_ep, em_tar_ep = [], [], [], [], []  # store things epoche wise (_ep)
@@ -96,13 +149,16 @@ def test(model, loss, dataloader, epoch, device):
             tqdm_enum.set_description(f"(Test) E: {epoch} - T: {t_batch:.2}")
 
             loss_cmp_ep.append(loss_val.detach().cpu())
-            x_ep.append(x.cpu())
-            y_out_ep.append(y_out.detach().cpu())
+            if stream is not None:
+                stream.update(x=x.cpu(), y_out=y_out.detach().cpu())
+            else:
+                x_ep.append(x.cpu())
+                y_out_ep.append(y_out.detach().cpu())
 
     """Epoch-Wise Merging"""
     loss_cmp_ep = torch.cat(loss_cmp_ep, 0)
-    x_ep = torch.cat(x_ep, 0)
-    y_out_ep = torch.cat(y_out_ep, 0)
+    x_ep = torch.cat(x_ep, 0) if stream is None else None
+    y_out_ep = torch.cat(y_out_ep, 0) if stream is None else None
 
     return loss_cmp_ep.mean(), _val_return(loss=loss_cmp_ep, x=x_ep, y_out=y_out_ep, y_tar=None, weight=None, em_tar=None)
 
@@ -1,2 +1,6 @@
-from . import logger
-from . import collate
\ No newline at end of file
+from decode.utils.lazy import lazy_package
+
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['amp', 'collate', 'dataset_cache', 'last_layer_dynamics', 'log_train_val_progress', 'logger',
+                'padding_calc', 'probability', 'processing', 'shared_store'])
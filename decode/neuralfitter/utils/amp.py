@@ -0,0 +1,61 @@
+import contextlib
+from typing import Union
+
+import torch
+
+
+def autocast_dtype(device: Union[str, torch.device]) -> torch.dtype:
+    """Reduced precision type used for autocasting on the respective device (bfloat16 on CPU, float16 on CUDA)."""
+    return torch.bfloat16 if torch.device(device).type == 'cpu' else torch.float16
+
+
+def autocast(device: Union[str, torch.device], enabled: bool = True):
+    """
+    Mixed precision context for the forward pass (model and loss) on the specified device.
+
+    Args:
+        device: device the forward pass runs on
+        enabled: if false, this is a no-op context
+
+    """
+    device_type = torch.device(device).type
+
+    if not enabled:
+        return contextlib.nullcontext()
+
+    if hasattr(torch, 'autocast'):  # torch >= 1.10
+        return torch.autocast(device_type=device_type, dtype=autocast_dtype(device_type))
+
+    if device_type == 'cuda':
+        return torch.cuda.amp.autocast()
+
+    raise RuntimeError(f"Mixed precision on {device_type} is not supported by this pytorch version "
+                       f"({torch.__version__}).")
+
+
+@contextlib.contextmanager
+def autocast_disabled():
+    """
+    Disables autocasting (on all devices) within the context, i.e. for numerically sensitive parts. Note that inputs
+    that are already in reduced precision must be cast by hand.
+
+    """
+    with contextlib.ExitStack() as stack:
+        if hasattr(torch, 'autocast'):
+            stack.enter_context(torch.autocast(device_type='cpu', enabled=False))
+        if torch.cuda.is_available():
+            stack.enter_context(torch.cuda.amp.autocast(enabled=False))
+
+        yield
+
+
+def grad_scaler(device: Union[str, torch.device], enabled: bool = True):
+    """
+    Gradient scaler for mixed precision training. Only float16 needs (and supports) gradient scaling, i.e. returns None
+    for CPU (bfloat16) or if mixed precision is disabled.
+
+    """
+    if not enabled or torch.device(device).type != 'cuda':
+        return None
+
+    return torch.cuda.amp.GradScaler()
@@ -0,0 +1,186 @@
+import contextlib
+import hashlib
+import json
+import os
+import random
+import shutil
+import warnings
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import torch
+
+import decode
+from decode.generic import emitter
+from decode.utils import calibration_io
+
+"""Parameters (section, keys) the processed test set depends on. None means the whole section."""
+_test_set_param_keys = (
+    ('Simulation', None),
+    ('TestSet', None),
+    ('Camera', None),
+    ('CameraPreset', None),
+    ('Scaling', None),
+    ('HyperParameter', ('channels_in', 'max_number_targets', 'emitter_label_photon_min', 'disabled_attributes')),
+    ('Hardware', ('device_simulation',)),
+)
+
+"""Keys of these sections which do not change the test set (e.g. where it is cached)"""
+_test_set_param_exclude = {'TestSet': ('cache_dir',)}
+
+
+@contextlib.contextmanager
+def seeded(seed: Optional[int]):
+    """
+    Seeds python, numpy and torch (incl. cuda) random number generators within the context and restores their
+    previous state afterwards, so that the surrounding random stream is unaffected. Does nothing if seed is None.
+
+    Args:
+        seed: seed
+
+    """
+    if seed is None:
+        yield
+        return
+
+    state_py, state_np = random.getstate(), np.random.get_state()
+    devices = list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+    try:
+        with torch.random.fork_rng(devices=devices):
+            random.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+            yield
+    finally:
+        random.setstate(state_py)
+        np.random.set_state(state_np)
+
+
+def test_set_key(param, seed: int) -> str:
+    """
+    Cache key of the test set, i.e. a hash of the simulation relevant parameters, the content of the calibration file,
+    the seed and the version of decode.
+
+    Args:
+        param: parameters
+        seed: seed with which the test set is sampled
+
+    """
+    param_dict = param.to_dict()
+
+    relevant = {}
+    for section, keys in _test_set_param_keys:
+        sec = param_dict.get(section)
+        if keys is not None and isinstance(sec, dict):
+            sec = {k: sec.get(k) for k in keys}
+        if isinstance(sec, dict):
+            sec = {k: v for k, v in sec.items() if k not in _test_set_param_exclude.get(section, ())}
+        relevant[section] = sec
+
+    relevant['calibration'] = calibration_io.hash_calibration(param.InOut.calibration_file)
+    relevant['seed'] = seed
+    relevant['version'] = decode.__version__
+
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _save_tensor(path: Path, x: Optional[torch.Tensor]):
+    if x is not None:
+        np.save(path, x.detach().cpu().numpy())
+
+
+def _load_tensor(path: Path, present: bool) -> Optional[torch.Tensor]:
+    if not present:
+        return None
+    # copy-on-write memory map, i.e. pages are shared between processes until someone writes to them
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+def save_sample(path: Union[str, Path], frames: torch.Tensor,
+                target: Union[torch.Tensor, Sequence[Optional[torch.Tensor]]], weight: Optional[torch.Tensor],
+                em: emitter.EmitterSet, overwrite: bool = False):
+    """
+    Stores a processed sample as folder of .npy files (one per tensor) plus a meta.json. The folder is written under a
+    temporary name and renamed at the end, so that concurrent readers never see a partial sample.
+
+    Args:
+        path: folder
+        frames: processed frames
+        target: target (tensor or tuple of tensors)
+        weight: weight
+        em: target emitters
+        overwrite: replace an existing sample at path, otherwise the existing one is kept
+
+    """
+    path = Path(path)
+    path_tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    path_old = path.with_name(f".{path.name}.{os.getpid()}.old")
+
+    try:
+        path_tmp.mkdir(parents=True, exist_ok=True)
+
+        _save_tensor(path_tmp / 'frames.npy', frames)
+        _save_tensor(path_tmp / 'weight.npy', weight)
+        target_tuple = isinstance(target, (tuple, list))
+        target = target if target_tuple else (target,)
+        for i, tar in enumerate(target):
+            _save_tensor(path_tmp / f'target_{i}.npy', tar)
+        for k, v in em.data.items():
+            _save_tensor(path_tmp / f'em_{k}.npy', v)
+
+        meta = {
+            'target': [tar is not None for tar in target],
+            'target_tuple': target_tuple,
+            'weight': weight is not None,
+            'em_data': [k for k, v in em.data.items() if v is not None],
+            'xy_unit': em.xy_unit,
+            'px_size': em.px_size.tolist() if em.px_size is not None else None,
+        }
+        (path_tmp / 'meta.json').write_text(json.dumps(meta))
+
+        if overwrite and path.exists():
+            os.replace(path, path_old)
+        os.replace(path_tmp, path)
+
+    except OSError as err:  # e.g. read-only folder or another process was faster
+        if not (path / 'meta.json').exists():
+            warnings.warn(f"Could not write sample cache to {path} ({err}).")
+
+    finally:
+        for p in (path_tmp, path_old):
+            if p.exists():
+                shutil.rmtree(p, ignore_errors=True)
+
+
+def load_sample(path: Union[str, Path]) -> Optional[tuple]:
+    """
+    Loads a sample stored by save_sample. Tensors are memory-mapped.
+
+    Args:
+        path: folder
+
+    Returns:
+        (frames, target, weight, emitter) or None if there is no (complete) sample at path
+
+    """
+    path = Path(path)
+    if not (path / 'meta.json').exists():
+        return None
+
+    try:
+        meta = json.loads((path / 'meta.json').read_text())
+
+        frames = _load_tensor(path / 'frames.npy', True)
+        weight = _load_tensor(path / 'weight.npy', meta['weight'])
+        target = tuple(_load_tensor(path / f'target_{i}.npy', present) for i, present in enumerate(meta['target']))
+        if not meta['target_tuple']:
+            target = target[0]
+
+        em = emitter.EmitterSet(**{k: _load_tensor(path / f'em_{k}.npy', True) for k in meta['em_data']},
+                                xy_unit=meta['xy_unit'], px_size=meta['px_size'])
+
+    except (OSError, ValueError, KeyError):  # corrupt or concurrently deleted cache, fall back to sampling
+        return None
+
+    return frames, target, weight, em
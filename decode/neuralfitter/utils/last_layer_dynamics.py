@@ -1,4 +1,6 @@
-from typing import Tuple
+import contextlib
+import functools
+from typing import Iterable, Tuple
 
 import torch
 
@@ -44,3 +46,90 @@ def weight_by_gradient(layer: torch.nn.ModuleList, loss: torch.Tensor, optimizer
     weight_cX_h1_w1 = weighting.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)  # weight tensor of size 1 x C x 1 x 1
 
     return weight_cX_h1_w1, loss_ch, loss_wch
+
+
+class LastLayerGradRescale:
+    def __init__(self, layer: torch.nn.ModuleList, all_reduce: bool = False):
+        """
+        Same weighting as weight_by_gradient, but within the main backward pass instead of one extra backward per
+        head. During backward, the gradient at the output of each head is divided by the gradient magnitude of the
+        head's last layer (out_conv) weight. The common normalisation is applied to all gradients afterwards (apply).
+
+        Assumes that channel i of the (non-reduced) loss depends on the output of head i only, as is the case for
+        channel-wise losses.
+
+        Args:
+            layer: heads, each with an out_conv (torch.nn.Conv2d) as last layer
+            all_reduce: average the gradient magnitudes of the heads over the ranks before the normalisation (apply),
+                such that all replicas of a distributed data-parallel model apply the same one
+
+        Example:
+            >>> rescale = LastLayerGradRescale(model.mt_heads)
+            >>> with rescale.capture():
+            >>>     out = model(x)
+            >>> loss(out, tar, weight).mean().backward()
+            >>> rescale.apply(model.parameters())
+
+        """
+        self.layer = layer
+        self.all_reduce = all_reduce
+        self._head_grads = [None] * len(layer)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """Rescale the gradients of the forward passes within this context."""
+        handles = [head.out_conv.register_forward_hook(functools.partial(self._forward_hook, i))
+                   for i, head in enumerate(self.layer)]
+        try:
+            yield
+        finally:
+            for h in handles:
+                h.remove()
+
+    def _forward_hook(self, i: int, conv: torch.nn.Conv2d, inp: tuple, out: torch.Tensor):
+        if out.requires_grad:
+            out.register_hook(functools.partial(self._rescale, i, conv, inp[0].detach()))
+
+    def _rescale(self, i: int, conv: torch.nn.Conv2d, x: torch.Tensor, grad_out: torch.Tensor) -> torch.Tensor:
+        """Tensor hook on the head output. Weight gradient of the last layer only, no backward through the head."""
+        grad_w = torch.nn.grad.conv2d_weight(x.float(), conv.weight.shape, grad_out.float(), stride=conv.stride,
+                                             padding=conv.padding, dilation=conv.dilation, groups=conv.groups)
+        head_grad = grad_w.abs().sum()
+        self._head_grads[i] = head_grad
+
+        # inactive heads are killed (weight 0), avoid cuda sync for the check
+        scale = torch.where(head_grad != 0., 1. / head_grad, torch.zeros_like(head_grad))
+        return grad_out * scale.to(grad_out.dtype)
+
+    def apply(self, parameters: Iterable[torch.nn.Parameter]) -> torch.Tensor:
+        """
+        Applies the normalisation to the gradients after backward.
+
+        Args:
+            parameters: parameters whose gradients are normalised (usually all of the model)
+
+        Returns:
+            weight_cX_h1_w1: weight per channel (1 x C x 1 x 1)
+
+        """
+        if any(h is None for h in self._head_grads):
+            raise RuntimeError("No rescaled backward pass since the last call.")
+
+        head_grads = torch.stack(self._head_grads)
+        self._head_grads = [None] * len(self.layer)
+
+        if self.all_reduce:
+            torch.distributed.all_reduce(head_grads)
+            head_grads = head_grads / torch.distributed.get_world_size()
+
+        ix_on = head_grads != 0.
+        weighting = torch.where(ix_on, 1. / head_grads, torch.zeros_like(head_grads))
+        norm = weighting.sum()
+        norm = torch.where(norm != 0., norm, torch.ones_like(norm))  # all heads inactive, gradients are zero anyways
+        weighting = weighting / norm
+
+        for p in parameters:
+            if p.grad is not None:
+                p.grad.div_(norm.to(p.grad.dtype))
+
+        return weighting.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
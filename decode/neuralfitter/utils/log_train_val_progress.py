@@ -1,3 +1,6 @@
+import collections
+import concurrent.futures
+import multiprocessing
 import warnings
 
 import matplotlib.pyplot as plt
@@ -10,6 +13,7 @@ from decode.evaluation import predict_dist
 from decode.plot import frame_coord
 
 from decode.evaluation import evaluation
+from decode.neuralfitter.utils.logger import RecordLogger
 
 
 def log_frames(x, y_out, y_tar, weight, em_out, em_tar, tp, tp_match, logger, step, colorbar=True):
@@ -135,8 +139,13 @@ def log_train(*, loss_p_batch: (list, tuple), loss_mean: float, logger, step: in
         logger.add_scalar('learning/train_batch', loss_batch, step_batch)
 
 
+def log_timing(timer, logger, step: int):
+    """Log percentiles and totals of the stage durations of a StageTimer (in s)."""
+    logger.add_scalar_dict('timing/', timer.percentiles(), step)
+
+
 def post_process_log_test(*, loss_cmp, loss_scalar, x, y_out, y_tar, weight, em_tar,
-                          px_border, px_size, post_processor, matcher, logger, step):
+                          px_border, px_size, post_processor, matcher, logger, step, log_figures: bool = True):
 
     """Post-Process"""
     em_out = post_processor.forward(y_out)
@@ -149,13 +158,185 @@ def post_process_log_test(*, loss_cmp, loss_scalar, x, y_out, y_tar, weight, em_
 
     """Log"""
     # raw frames
-    log_frames(x=x, y_out=y_out, y_tar=y_tar, weight=weight, em_out=em_out, em_tar=em_tar, tp=tp, tp_match=tp_match,
-               logger=logger, step=step)
+    if log_figures:
+        log_frames(x=x, y_out=y_out, y_tar=y_tar, weight=weight, em_out=em_out, em_tar=em_tar, tp=tp,
+                   tp_match=tp_match, logger=logger, step=step)
 
     # KPIs
     log_kpi(loss_scalar=loss_scalar, loss_cmp=loss_cmp, eval_set=result._asdict(), logger=logger, step=step)
 
     # distributions
-    log_dists(tp=tp, tp_match=tp_match, pred=em_out, px_border=px_border, px_size=px_size, logger=logger, step=step)
+    if log_figures:
+        log_dists(tp=tp, tp_match=tp_match, pred=em_out, px_border=px_border, px_size=px_size, logger=logger,
+                  step=step)
 
     return
+
+
+_async_worker_state = {}
+
+
+def _async_worker_init(post_processor, matcher, px_border, px_size):
+    plt.switch_backend('Agg')  # worker never shows figures
+    _async_worker_state.update(post_processor=post_processor, matcher=matcher, px_border=px_border, px_size=px_size)
+
+
+def _async_worker_post_process_log_test(kwargs: dict) -> RecordLogger:
+    logger = RecordLogger()
+    post_process_log_test(**kwargs, **_async_worker_state, logger=logger)
+
+    return logger
+
+
+class AsyncPostProcessLogTest:
+    def __init__(self, *, post_processor, matcher, px_border, px_size, logger, max_pending: int = 1):
+        """
+        Runs post_process_log_test (post-processing, matching, evaluation and figures) in a separate process, such
+        that training continues while the previous epoch is evaluated. The results are logged to logger (in the
+        calling process) once they are ready, in the order of submission.
+
+        Args:
+            post_processor: post-processor (must be picklable)
+            matcher: matcher (must be picklable)
+            px_border: see post_process_log_test
+            px_size: see post_process_log_test
+            logger: logger to which the results are written
+            max_pending: maximum number of evaluations in flight, submit blocks until the oldest one is done if
+                exceeded
+
+        """
+        self.logger = logger
+        self.max_pending = max_pending
+
+        # spawn, since forking a process with an initialised cuda context is not safe
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_async_worker_init, initargs=(post_processor, matcher, px_border, px_size))
+        self._pending = collections.deque()
+
+    def submit(self, *, loss_cmp, loss_scalar, x, y_out, y_tar, weight, em_tar, step, log_figures: bool = True):
+        """Non-blocking version of post_process_log_test (unless max_pending evaluations are in flight)."""
+        self.collect()
+        while len(self._pending) >= self.max_pending:
+            self._log(self._pending.popleft())
+
+        kwargs = {'loss_cmp': loss_cmp.cpu(), 'loss_scalar': float(loss_scalar), 'x': x.cpu(),
+                  'y_out': y_out.cpu(), 'y_tar': y_tar.cpu() if y_tar is not None else None,
+                  'weight': weight.cpu() if weight is not None else None, 'em_tar': em_tar,
+                  'step': step, 'log_figures': log_figures}
+
+        self._pending.append(self._executor.submit(_async_worker_post_process_log_test, kwargs))
+
+    def _log(self, future):
+        future.result().replay(self.logger)
+
+    def collect(self, wait: bool = False):
+        """
+        Log finished evaluations.
+
+        Args:
+            wait: wait for all pending evaluations
+
+        """
+        while self._pending and (wait or self._pending[0].done()):
+            self._log(self._pending.popleft())
+
+    def close(self):
+        """Wait for all pending evaluations, log them and shut down the worker."""
+        try:
+            self.collect(wait=True)
+        finally:
+            self._executor.shutdown()
+
+
+class StreamingPostProcessLogTest:
+    def __init__(self, *, post_processor, matcher, em_tar, px_border, px_size, n_frames_sample: int = 16):
+        """
+        Streaming version of post_process_log_test. The test set is post-processed and matched batch by batch (see
+        train_val_impl.test) and the evaluation is accumulated incrementally, such that the network output of the
+        whole test set is never held in memory. Only the first n_frames_sample frames (input and output) are kept for
+        the figures. The emitters (output, true positives and their ground truth) are kept for the distributions.
+
+        Args:
+            post_processor: post-processor
+            matcher: matcher
+            em_tar: target emitters of the test set (with the frame indexing of the test dataset)
+            px_border: see post_process_log_test
+            px_size: see post_process_log_test
+            n_frames_sample: number of frames kept for the figures
+
+        """
+        self.post_processor = post_processor
+        self.matcher = matcher
+        self.em_tar = em_tar
+        self.px_border = px_border
+        self.px_size = px_size
+        self.n_frames_sample = n_frames_sample
+
+        self.reset()
+
+    def reset(self):
+        self._n_frames = 0
+        self._eval = evaluation.IncrementalSMLMEvaluation(weighted_eval=WeightedErrors(mode='crlb',
+                                                                                       reduction='gaussian'))
+        self._x, self._y_out = [], []
+        self._frame_offset, self._em_out, self._tp, self._tp_match = [], [], [], []
+
+    def update(self, x: torch.Tensor, y_out: torch.Tensor):
+        """
+        Post-process, match and evaluate a batch. Batches must come in the order of the test set.
+
+        Args:
+            x: input of size N x C x H x W
+            y_out: output of size N x C x H x W
+
+        """
+        n, offset = x.size(0), self._n_frames
+        self._n_frames += n
+
+        """Post-Process and match with the target emitters of the frames of this batch"""
+        em_out = self.post_processor.forward(y_out)
+        em_tar = self.em_tar.get_subset_frame(offset, offset + n - 1, frame_ix_shift=-offset)
+
+        """Keep the first frames for the figures"""
+        n_sample = min(self.n_frames_sample - offset, n)
+        if n_sample > 0:
+            self._x.append(x[:n_sample].clone())
+            self._y_out.append(y_out[:n_sample].clone())
+
+        if len(em_out) == 0 and len(em_tar) == 0:
+            return
+
+        tp, fp, fn, tp_match = self.matcher.forward(em_out, em_tar)
+        self._eval.update(tp, fp, fn, tp_match)
+
+        self._frame_offset.append(offset)
+        self._em_out.append(em_out)
+        self._tp.append(tp)
+        self._tp_match.append(tp_match)
+
+    def _cat(self, em: list) -> decode.generic.emitter.EmitterSet:
+        if len(em) == 0:
+            return decode.generic.emitter.EmptyEmitterSet(xy_unit=self.em_tar.xy_unit, px_size=self.em_tar.px_size)
+
+        return decode.generic.emitter.EmitterSet.cat(em, remap_frame_ix=torch.tensor(self._frame_offset))
+
+    def log(self, *, loss_cmp, loss_scalar, logger, step, log_figures: bool = True):
+        """
+        Log what has been accumulated (same as post_process_log_test) and reset for the next epoch.
+
+        """
+        result = self._eval.compute()
+        em_out, tp, tp_match = self._cat(self._em_out), self._cat(self._tp), self._cat(self._tp_match)
+
+        if log_figures and len(self._x) >= 1:
+            log_frames(x=torch.cat(self._x, 0), y_out=torch.cat(self._y_out, 0), y_tar=None, weight=None,
+                       em_out=em_out, em_tar=self.em_tar, tp=tp, tp_match=tp_match, logger=logger, step=step)
+
+        log_kpi(loss_scalar=loss_scalar, loss_cmp=loss_cmp, eval_set=result._asdict(), logger=logger, step=step)
+
+        if log_figures:
+            log_dists(tp=tp, tp_match=tp_match, pred=em_out, px_border=self.px_border, px_size=self.px_size,
+                      logger=logger, step=step)
+
+        self.reset()
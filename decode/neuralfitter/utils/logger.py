@@ -1,7 +1,21 @@
 import time
 
 import matplotlib.pyplot as plt
+import numpy as np
 import torch.utils.tensorboard
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def _figure_to_image(figure, close: bool = True) -> np.ndarray:
+    """Renders a matplotlib figure to an RGB uint8 image of size 3 x H x W."""
+    canvas = FigureCanvasAgg(figure)
+    canvas.draw()
+    img = np.asarray(canvas.buffer_rgba())[..., :3].transpose(2, 0, 1).copy()
+
+    if close:
+        plt.close(figure)
+
+    return img
 
 
 class SummaryWriter(torch.utils.tensorboard.SummaryWriter):
@@ -129,6 +143,41 @@ class DictLogger(NoLog):
             self.log_dict.update({prefix: val_ini})
 
 
+class RecordLogger(NoLog):
+    """
+    Logger that records the calls made to it such that they can be replayed to another logger later on, e.g. to log
+    from a different process. Figures are rendered to images right away (as the SummaryWriter would do).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def add_scalar(self, *args, **kwargs):
+        self.records.append(('add_scalar', args, kwargs))
+
+    def add_scalar_dict(self, *args, **kwargs):
+        self.records.append(('add_scalar_dict', args, kwargs))
+
+    def add_histogram(self, *args, **kwargs):
+        self.records.append(('add_histogram', args, kwargs))
+
+    def add_image(self, *args, **kwargs):
+        self.records.append(('add_image', args, kwargs))
+
+    def add_text(self, *args, **kwargs):
+        self.records.append(('add_text', args, kwargs))
+
+    def add_figure(self, tag, figure, global_step=None, close=True, walltime=None):
+        self.records.append(('add_image', (tag, _figure_to_image(figure, close=close), global_step),
+                             {'walltime': walltime, 'dataformats': 'CHW'}))
+
+    def replay(self, logger):
+        """Replay the recorded calls to logger."""
+        for method, args, kwargs in self.records:
+            getattr(logger, method)(*args, **kwargs)
+
+
 class MultiLogger:
     """
     A 'Meta-Logger', i.e. a logger that calls its components.
@@ -1,3 +1,6 @@
+import torch
+
+
 def outsize_calc(i, p, k, s, d):
     """
     i = input_size
@@ -18,4 +21,39 @@ def pad_same_calc(i, k, s, d):
     if p % 1 != 0:
         raise ValueError('Padding Same not possible.')
 
-    return int(p)
\ No newline at end of file
+    return int(p)
+
+
+def receptive_field(model, ch_in: int, size: int = 64, size_max: int = 1024, device='cpu') -> int:
+    """
+    Radius (in px) of the receptive field of a fully convolutional model, i.e. output pixels are independent of input
+    pixels further away than the radius. Determined by the gradient of the centre output pixel w.r.t. the input, the
+    input size is doubled until the receptive field lies within.
+
+    Args:
+        model: model (in the mode in which it is used)
+        ch_in: number of input channels
+        size: initial input size (must be compatible with the model)
+        size_max: maximum input size
+        device: device of the model
+
+    """
+    if any(isinstance(m, torch.nn.GroupNorm) for m in model.modules()):
+        raise ValueError("GroupNorm normalises over the whole input, i.e. the receptive field is not limited.")
+
+    while True:
+        x = torch.rand(1, ch_in, size, size, device=device, requires_grad=True)
+        c = size // 2
+
+        # gradient w.r.t. the input only, nothing is accumulated in the parameters of the model
+        with torch.enable_grad():
+            grad = torch.autograd.grad(model(x)[..., c, c].sum(), x)[0]
+        ix = (grad.abs().sum(dim=(0, 1)) > 0).nonzero()
+
+        radius = int((ix - c).abs().max()) if len(ix) >= 1 else 0
+        if radius < c - 1:
+            return radius
+
+        if 2 * size > size_max:
+            raise ValueError(f"Receptive field exceeds maximum size {size_max}.")
+        size *= 2
@@ -0,0 +1,142 @@
+import math
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+from decode.generic import emitter
+
+
+class SharedSampleStore:
+    """
+    Frames, background frames and (target) emitters of a sampled acquisition in shared memory, such that DataLoader
+    workers read them zero-copy. Emitters are kept as a columnar table sorted by frame together with per frame offsets.
+
+    A new sample is copied into the existing block if it fits (same frame shape and dtype, emitter table within
+    capacity), so that persistent workers see it without being restarted. Otherwise a new block is allocated and
+    generation is incremented; workers forked before still hold the old block and must be restarted.
+
+    """
+    _em_attr = ('xyz', 'phot', 'id', 'prob', 'bg', 'xyz_cr', 'phot_cr', 'bg_cr', 'xyz_sig', 'phot_sig', 'bg_sig')
+
+    def __init__(self, headroom: float = 1.25):
+        """
+
+        Args:
+            headroom: factor by which the emitter capacity exceeds the number of emitters on allocation, to absorb
+                fluctuations between samples without reallocation
+
+        """
+        self.headroom = headroom
+        self.generation = 0
+
+        self.frames = None
+        self.bg_frames = None
+        self._em = None  # attribute -> table column
+        self._offsets = None  # start of frame i in the emitter table is _offsets[i]
+        self._xy_unit = None
+        self._px_size = None
+
+    def __len__(self):
+        return 0 if self.frames is None else self.frames.size(0)
+
+    @staticmethod
+    def _shared_like(x: torch.Tensor, size: Optional[Tuple[int, ...]] = None) -> torch.Tensor:
+        return torch.empty(x.size() if size is None else size, dtype=x.dtype).share_memory_()
+
+    def _fits(self, frames: torch.Tensor, bg_frames: Optional[torch.Tensor], em_data: dict, meta: tuple) -> bool:
+        if self.frames is None:
+            return False
+
+        if frames.size() != self.frames.size() or frames.dtype != self.frames.dtype:
+            return False
+
+        if (bg_frames is None) != (self.bg_frames is None):
+            return False
+        if bg_frames is not None and (bg_frames.size() != self.bg_frames.size() or
+                                      bg_frames.dtype != self.bg_frames.dtype):
+            return False
+
+        if em_data.keys() != self._em.keys() or meta != (self._xy_unit, self._px_size):
+            return False
+
+        n = next(iter(em_data.values())).size(0)
+        return all(v.size()[1:] == self._em[k].size()[1:] and v.dtype == self._em[k].dtype and
+                   n <= self._em[k].size(0) for k, v in em_data.items())
+
+    def _allocate(self, frames: torch.Tensor, bg_frames: Optional[torch.Tensor], em_data: dict, meta: tuple):
+        n = next(iter(em_data.values())).size(0)
+        capacity = max(math.ceil(n * self.headroom), 1)
+
+        self.frames = self._shared_like(frames)
+        self.bg_frames = self._shared_like(bg_frames) if bg_frames is not None else None
+        self._em = {k: self._shared_like(v, (capacity, *v.size()[1:])) for k, v in em_data.items()}
+        self._offsets = torch.zeros(frames.size(0) + 1, dtype=torch.long).share_memory_()
+        self._xy_unit, self._px_size = meta
+
+        self.generation += 1
+
+    def update(self, frames: torch.Tensor, bg_frames: Optional[torch.Tensor], em: emitter.EmitterSet) -> bool:
+        """
+        Puts a new sample into the store. Emitters outside of the frame range are dropped.
+
+        Args:
+            frames: frames of size N x H x W
+            bg_frames: background frames of size N x H x W
+            em: emitters with frame indices referring to the frames
+
+        Returns:
+            bool: whether the sample was copied into the existing block (i.e. no reallocation took place)
+
+        Raises:
+            ValueError: if the emitters carry attributes the store does not keep (see _em_attr)
+
+        """
+        unknown = [k for k, v in em.data.items() if v is not None and k not in ('frame_ix', *self._em_attr)]
+        if len(unknown) != 0:
+            raise ValueError(f"Emitter attributes {unknown} are not supported by the shared sample store.")
+
+        n_frames = frames.size(0)
+
+        em = em[(em.frame_ix >= 0) * (em.frame_ix < n_frames)]
+        sort_ix = torch.from_numpy(np.argsort(em.frame_ix.cpu().numpy(), kind='stable'))  # keep order within frames
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long),
+                             torch.bincount(em.frame_ix.cpu(), minlength=n_frames).cumsum(0)])
+
+        em_data = {k: getattr(em, k)[sort_ix] for k in self._em_attr if getattr(em, k) is not None}
+        meta = (em.xy_unit, tuple(em.px_size.tolist()) if em.px_size is not None else None)
+
+        in_place = self._fits(frames, bg_frames, em_data, meta)
+        if not in_place:
+            self._allocate(frames, bg_frames, em_data, meta)
+
+        self.frames.copy_(frames)
+        if bg_frames is not None:
+            self.bg_frames.copy_(bg_frames)
+        for k, v in em_data.items():
+            self._em[k][:v.size(0)].copy_(v)
+        self._offsets.copy_(offsets)
+
+        return in_place
+
+    def get_emitter(self, ix: int) -> emitter.EmitterSet:
+        """
+        Emitters of frame ix (copied out of the store), with frame index set to 0.
+
+        Args:
+            ix: frame index
+
+        """
+        start, stop = self._offsets[ix].item(), self._offsets[ix + 1].item()
+        data = {k: v[start:stop].clone() for k, v in self._em.items()}
+
+        return emitter.EmitterSet(frame_ix=torch.zeros(stop - start, dtype=torch.long), **data,
+                                  xy_unit=self._xy_unit, px_size=self._px_size)
+
+    def get_emitter_set(self) -> emitter.EmitterSet:
+        """All emitters of the store (copied out) with their frame indices."""
+        n = self._offsets[-1].item()
+        frame_ix = torch.repeat_interleave(torch.arange(len(self)), self._offsets[1:] - self._offsets[:-1])
+        data = {k: v[:n].clone() for k, v in self._em.items()}
+
+        return emitter.EmitterSet(frame_ix=frame_ix, **data, xy_unit=self._xy_unit, px_size=self._px_size)
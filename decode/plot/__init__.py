@@ -1,2 +1,12 @@
-from .frame_coord import PlotFrame, PlotFrameCoord, PlotCoordinates, PlotCoordinates3D
-from .fancy_plot import plot_crosshair
\ No newline at end of file
+from decode.utils.lazy import lazy_package
+
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['fancy_plot', 'frame_coord'],
+    attributes={
+        'PlotFrame': 'frame_coord',
+        'PlotFrameCoord': 'frame_coord',
+        'PlotCoordinates': 'frame_coord',
+        'PlotCoordinates3D': 'frame_coord',
+        'plot_crosshair': 'fancy_plot',
+    })
@@ -1,3 +1,8 @@
-import decode.renderer.renderer
+from decode.utils.lazy import lazy_package
 
-from .renderer import Renderer2D
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['renderer'],
+    attributes={
+        'Renderer2D': 'renderer',
+    })
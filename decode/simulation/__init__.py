@@ -1,10 +1,10 @@
-import decode.simulation.background
-import decode.simulation.noise_distributions
-import decode.simulation.camera
-import decode.simulation.emitter_generator
-import decode.simulation.psf_kernel
-import decode.simulation.simulator
-import decode.simulation.structure_prior
+from decode.utils.lazy import lazy_package
 
-from decode.simulation.simulator import Simulation
-from decode.simulation.structure_prior import RandomStructure
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['background', 'camera', 'emitter_generator', 'noise_distributions', 'psf_kernel', 'simulator',
+                'structure_prior'],
+    attributes={
+        'Simulation': 'simulator',
+        'RandomStructure': 'structure_prior',
+    })
@@ -1,5 +1,8 @@
+import threading
 from pathlib import Path
+
 import pytest
+import torch
 
 from ..utils import checkpoint
 
@@ -17,3 +20,78 @@ class TestCheckpoint:
 
         ckpt_re = checkpoint.CheckPoint.load(ckpt.path)
         assert ckpt.__dict__ == ckpt_re.__dict__
+
+    def test_save_load_async(self, ckpt):
+        ckpt.asynchronous = True
+        state = {'w': torch.rand(5)}
+        w = state['w'].clone()
+
+        assert ckpt.dump(state, 'b', 'c', 42, 'l')
+        state['w'] += 1.  # modify after dump must not affect the snapshot
+        ckpt.wait()
+
+        ckpt_re = checkpoint.CheckPoint.load(ckpt.path)
+        assert (ckpt_re.model_state['w'] == w).all()
+        assert ckpt_re.step == 42
+
+    def test_queue_in_flight(self, ckpt):
+        ckpt.asynchronous = True
+        ckpt._writer = checkpoint.AsyncWriter()
+
+        block = threading.Event()
+        ckpt._writer.submit(block.wait)
+
+        assert not ckpt.dump('a', 'b', 'c', 42)  # queued because previous write is in flight
+        assert not ckpt.dump('a', 'b', 'c', 43)  # replaces the queued one
+
+        block.set()
+        ckpt.wait()
+        assert checkpoint.CheckPoint.load(ckpt.path).step == 43
+
+        assert ckpt.dump('a', 'b', 'c', 44)
+        ckpt.wait()
+        assert checkpoint.CheckPoint.load(ckpt.path).step == 44
+
+    def test_keep_last(self, tmpdir):
+        path = Path(tmpdir) / 'ckpt.pt'
+        ckpt = checkpoint.CheckPoint(path, keep_last=3)
+
+        for step in range(5):
+            ckpt.dump('a', 'b', 'c', step)
+
+        assert checkpoint.CheckPoint.load(path).step == 4
+        assert checkpoint.CheckPoint.load(Path(tmpdir) / 'ckpt_1.pt').step == 3
+        assert checkpoint.CheckPoint.load(Path(tmpdir) / 'ckpt_2.pt').step == 2
+        assert not (Path(tmpdir) / 'ckpt_3.pt').exists()
+        assert len(list(Path(tmpdir).iterdir())) == 3  # no temporary files left over
+
+        """Killed after the rotation, before the new checkpoint is moved in"""
+        ckpt._rotate()
+        assert checkpoint.CheckPoint.load(path).step == 4
+        assert checkpoint.CheckPoint.load(Path(tmpdir) / 'ckpt_1.pt').step == 4
+
+
+def test_atomic_save_failure(tmpdir):
+    path = Path(tmpdir) / 'dummy.pt'
+    checkpoint.atomic_save('a', path)
+
+    def fail():
+        raise IOError
+
+    with pytest.raises(IOError):
+        checkpoint.atomic_save('b', path, pre_replace=fail)
+
+    assert torch.load(path) == 'a'  # previous file untouched
+    assert len(list(Path(tmpdir).iterdir())) == 1
+
+
+def test_rng_state(tmpdir):
+    import random
+    import numpy as np
+
+    path = Path(tmpdir) / 'ckpt.pt'
+    checkpoint.CheckPoint(path).dump('a', 'b', 'c', 0, rng_state=checkpoint.get_rng_state())
+    r = (random.random(), np.random.rand(), torch.rand(1))
+
+    checkpoint.set_rng_state(checkpoint.CheckPoint.load(path).rng_state)
+    assert (random.random(), np.random.rand(), torch.rand(1)) == r
@@ -168,6 +168,75 @@ class TestSMLMLiveDataset:
         assert y_tar.dim() == 3
         assert weight.dim() == 3
 
+    def test_get_emitter(self, ds):
+        em = ds.simulator.sample()[0]
+        ds.simulator.sample = lambda: (em, torch.rand((256, 64, 64)), torch.rand((256, 64, 64)))
+        ds.sample()
+
+        em_split = em.split_in_frames(0, 255)
+        for ix in (0, 50, 255):
+            em_ix = em_split[ix]
+            em_ix.frame_ix = torch.zeros_like(em_ix.frame_ix)
+
+            em_out = ds.store.get_emitter(ix)
+
+            """Order within a frame is not defined"""
+            assert em_out[em_out.xyz[:, 0].argsort()] == em_ix[em_ix.xyz[:, 0].argsort()]
+
+    def test_resample_in_place(self, ds):
+        ds.sample()
+        generation, ptr = ds.store.generation, ds._frames.data_ptr()
+
+        ds.sample()
+        assert ds.store.generation == generation
+        assert ds._frames.data_ptr() == ptr
+        assert ds._frames.is_shared()
+
+        """Exceeding the emitter capacity requires reallocation"""
+        em = decode.RandomEmitterSet(4096)
+        em.frame_ix = torch.randint_like(em.frame_ix, 0, 256)
+        ds.simulator.sample = lambda: (em, torch.rand((256, 64, 64)), torch.rand((256, 64, 64)))
+
+        ds.sample()
+        assert ds.store.generation == generation + 1
+
+    def test_save_load_sample(self, ds, tmpdir):
+        ds.sample()
+        frames, bg_frames, em = ds._frames.clone(), ds._bg_frames.clone(), ds.store.get_emitter_set()
+        ds.save_sample(tmpdir / 'train_set')
+
+        ds.sample()
+        assert ds.load_sample(tmpdir / 'train_set')
+        assert (ds._frames == frames).all()
+        assert (ds._bg_frames == bg_frames).all()
+        assert ds.store.get_emitter_set() == em
+
+        assert not ds.load_sample(tmpdir / 'non_existing')
+
+    def test_unknown_emitter_attribute(self, ds):
+        """Emitter attributes the store does not keep must not be dropped silently."""
+        class EmitterSetSNR(decode.generic.emitter.EmitterSet):
+            @property
+            def data(self):
+                return {**super().data, 'snr': torch.ones(len(self))}
+
+        em = EmitterSetSNR(**decode.RandomEmitterSet(10).to_dict())
+        ds.simulator.sample = lambda: (em, torch.rand((256, 64, 64)), torch.rand((256, 64, 64)))
+
+        with pytest.raises(ValueError):
+            ds.sample()
+
+    def test_persistent_workers(self, ds):
+        """Workers must see the new sample without being restarted."""
+        ds.sample()
+        dl = torch.utils.data.DataLoader(ds, batch_size=None, shuffle=False, num_workers=1, persistent_workers=True)
+
+        for _ in range(2):
+            x = torch.stack([x for x, _, _ in dl])
+            assert (x == ds._frames.unsqueeze(1)).all()
+
+            ds.sample()
+
 
 class TestSMLMAPrioriDataset:
 
@@ -214,12 +283,44 @@ class TestSMLMAPrioriDataset:
         """Assertions"""
         assert isinstance(ds._emitter, decode.generic.emitter.EmitterSet)
         assert isinstance(ds._em_split, list)
+        assert ds.store is None, "Processed a priori, i.e. no shared sample store."
 
     def test_len(self, ds):
 
         ds.sample()
         assert len(ds) == 5000 - (ds.frame_window - 1)
 
+    def test_sample_seed(self, ds):
+
+        ds.sample(seed=42)
+        frames, em = ds._frames.clone(), ds._emitter.clone()
+
+        torch.manual_seed(0)
+        r = torch.rand(1)
+
+        ds.sample(seed=42)
+        assert (ds._frames == frames).all()
+        assert ds._emitter == em
+
+        """Global random state must be unaffected"""
+        torch.manual_seed(0)
+        assert torch.rand(1) == r
+
+    def test_sample_cache(self, ds, tmpdir):
+        cache = tmpdir / 'test_set'
+
+        ds.sample(seed=42, cache=cache)
+        frames, target, em = ds._frames.clone(), ds._target.clone(), ds._emitter.clone()
+
+        """Reload from cache, the simulation must not be invoked"""
+        ds.simulator.sample = None
+        ds.sample(seed=42, cache=cache)
+
+        assert (ds._frames == frames).all()
+        assert (ds._target == target).all()
+        assert ds._emitter == em
+        assert isinstance(ds._em_split, list)
+
 
 class TestLiveSampleDataset:
     @pytest.fixture()
@@ -273,3 +374,33 @@ class TestLiveSampleDataset:
         assert x.dim() == 3
         assert y_tar.dim() == 3
         assert weight.dim() == 3
+
+
+def test_test_set_key(tmpdir):
+    from decode.neuralfitter.utils import dataset_cache
+    from decode.utils import param_io, types
+
+    calib = tmpdir / 'calib.mat'
+    calib.write_binary(b'dummy calibration')
+
+    param = types.RecursiveNamespace(**param_io.load_reference())
+    param.InOut.calibration_file = str(calib)
+
+    key = dataset_cache.test_set_key(param, 42)
+    assert key == dataset_cache.test_set_key(param, 42)
+    assert key != dataset_cache.test_set_key(param, 43)
+
+    """Training only parameters do not invalidate the test set"""
+    param.HyperParameter.lr = 1.
+    assert key == dataset_cache.test_set_key(param, 42)
+
+    """Moving the cache does not invalidate it"""
+    param.TestSet.cache_dir = str(tmpdir / 'moved')
+    assert key == dataset_cache.test_set_key(param, 42)
+
+    param.Simulation.intensity_mu_sig = [1., 2.]
+    key_sim = dataset_cache.test_set_key(param, 42)
+    assert key_sim != key
+
+    calib.write_binary(b'other calibration')
+    assert key_sim != dataset_cache.test_set_key(param, 42)
@@ -1,4 +1,9 @@
 # Tests the importability of decode, i.e. the most basic test.
+import subprocess
+import sys
+import time
+
+import pytest
 
 
 def test_import_decode():
@@ -7,3 +12,28 @@ def test_import_decode():
 
 def test_import_decode_utils():
     import decode.utils
+
+
+def test_import_lazy_attributes():
+    import decode
+
+    assert decode.EmitterSet is decode.generic.emitter.EmitterSet
+    assert decode.simulation.Simulation is decode.simulation.simulator.Simulation
+    assert 'neuralfitter' in dir(decode)
+
+    with pytest.raises(AttributeError):
+        _ = decode.a_non_existing_attribute
+
+
+@pytest.mark.parametrize("module", ["decode", "decode.neuralfitter.inference.inference"])
+def test_import_time(module):
+    """Benchmark import time in a clean interpreter and check that heavy dependencies are not loaded."""
+    heavy = ['matplotlib', 'seaborn', 'sklearn', 'pandas', 'h5py', 'scipy.stats', 'torch.utils.tensorboard']
+
+    t0 = time.time()
+    out = subprocess.run([sys.executable, '-c', f"import sys, {module}; print(','.join(sys.modules))"],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    print(f"Import of {module} took {time.time() - t0:.2f}s (including interpreter startup).")
+
+    loaded = set(out.strip().split(','))
+    assert not [h for h in heavy if h in loaded]
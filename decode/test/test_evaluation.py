@@ -269,3 +269,57 @@ class TestSMLMEval:
 
         assert isinstance(evaluator.descriptors, dict)
         assert evaluator.descriptors == descriptors
+
+
+class TestIncrementalSMLMEval:
+
+    @pytest.fixture()
+    def em_batches(self):
+        """Batches of tp, fp, fn, tp_match."""
+        def random_set(n):
+            em_set = em.RandomEmitterSet(n, extent=100, xy_unit='nm')
+            em_set.phot = torch.rand(n) * 1000 + 100
+            em_set.bg = torch.rand(n) * 10 + 1
+            em_set.xyz_cr = torch.rand(n, 3) * 10 + 1
+            em_set.phot_cr = torch.rand(n) * 10 + 1
+            em_set.bg_cr = torch.rand(n) + 0.1
+            return em_set
+
+        batches = []
+        for n_tp, n_fp, n_fn in ((10, 2, 3), (0, 1, 0), (25, 0, 5)):
+            tp = random_set(n_tp)
+            tp_match = tp.clone()
+            tp_match.xyz += torch.randn_like(tp.xyz)
+            tp_match.phot += torch.randn_like(tp.phot) * 10
+            tp_match.bg += torch.randn_like(tp.bg)
+            batches.append((tp, random_set(n_fp), random_set(n_fn), tp_match))
+
+        return batches
+
+    @pytest.mark.parametrize("reduction", ['gaussian', 'mstd'])
+    def test_equal_to_full(self, em_batches, reduction):
+        evaluator = evaluation.IncrementalSMLMEvaluation(
+            weighted_eval=evaluation.WeightedErrors(mode='crlb', reduction=reduction))
+        for batch in em_batches:
+            evaluator.update(*batch)
+
+        tp, fp, fn, tp_match = (em.EmitterSet.cat([b[i] for b in em_batches]) for i in range(4))
+        result_full = evaluation.SMLMEvaluation(
+            weighted_eval=evaluation.WeightedErrors(mode='crlb', reduction=reduction)).forward(tp, fp, fn, tp_match)
+        result = evaluator.compute()
+
+        for k, v in result_full._asdict().items():
+            assert getattr(result, k) == pytest.approx(v, rel=1e-4), f"Mismatch in {k}."
+
+    def test_empty(self):
+        evaluator = evaluation.IncrementalSMLMEvaluation()
+        evaluator.update(em.EmptyEmitterSet('nm'), em.RandomEmitterSet(5, xy_unit='nm'), em.EmptyEmitterSet('nm'),
+                         em.EmptyEmitterSet('nm'))
+        result = evaluator.compute()
+
+        assert result.prec == 0.
+        assert math.isnan(result.rmse_lat)
+        assert math.isnan(result.dx_red_sig)
+
+        evaluator.reset()
+        assert evaluator.n_fp == 0
@@ -221,6 +221,11 @@ class TestEmitterSet:
         assert 5 == cat_sets.frame_ix[0]
         assert 50 == cat_sets.frame_ix[50]
 
+        sets = [RandomEmitterSet(5, xy_unit='px', px_size=(100., 200.)), RandomEmitterSet(2, xy_unit='px')]
+        cat_sets = EmitterSet.cat(sets)
+        assert cat_sets.xy_unit == 'px'
+        assert (cat_sets.px_size == torch.tensor([100., 200.])).all()
+
     def test_split_cat(self):
         """
         Tests whether split and cat (and sort by ID) returns the same result as the original starting.
@@ -1,5 +1,8 @@
+import copy
 import os
+import threading
 import time
+from unittest import mock
 
 import pytest
 import torch
@@ -45,3 +48,83 @@ def test_save(model_interface, unet):
 
 def test_load_init(model_interface):
     model_interface.load_init(deepsmlm_root + 'decode/test/assets/test_load_save_0.pt')
+
+
+class TestLoadCached:
+
+    @pytest.fixture()
+    def model_file(self, tmpdir):
+        model = torch.nn.Sequential(torch.nn.Conv2d(1, 2, 3), torch.nn.BatchNorm2d(2))
+        path = tmpdir / 'model.pt'
+        torch.save(model.state_dict(), str(path))
+
+        return path
+
+    def test_hash_cached(self, model_file):
+        assert io_model.hash_model_cached(model_file) == io_model.hash_model(model_file)
+
+        with mock.patch.object(io_model, 'hash_model') as mock_hash:
+            io_model.hash_model_cached(model_file)
+            mock_hash.assert_not_called()
+
+    def test_hash_invalidated(self, model_file):
+        h = io_model.hash_model_cached(model_file)
+        torch.save({'a': torch.rand(5)}, str(model_file))
+
+        assert io_model.hash_model_cached(model_file) != h
+
+    def test_state_dict_cached(self, model_file):
+        sd = io_model.load_state_dict_cached(model_file)
+        assert io_model.load_state_dict_cached(model_file) is sd
+
+        if not io_model._torch_load_mmap_available():
+            with pytest.raises(ValueError):
+                io_model.load_state_dict_cached(model_file, mmap=True)
+
+    @pytest.mark.parametrize("cache", [True, False])
+    def test_load_init(self, model_file, cache):
+        model = torch.nn.Sequential(torch.nn.Conv2d(1, 2, 3), torch.nn.BatchNorm2d(2))
+        ref = torch.load(str(model_file))
+
+        for _ in range(2):
+            model_ls = io_model.LoadSaveModel(copy.deepcopy(model), output_file=None, input_file=model_file,
+                                              cache=cache)
+            model_re = model_ls.load_init('cpu')
+
+            for k, v in model_re.state_dict().items():
+                assert (v == ref[k]).all()
+
+            model_re[0].weight.data += 1.  # must not leak into the cache
+
+        assert (io_model.load_state_dict_cached(model_file)['0.weight'] == ref['0.weight']).all()
+
+    def test_legacy_format(self, tmpdir):
+        """Files of the legacy (non-zip) format can not be memory-mapped and must be read instead."""
+        model = torch.nn.Conv2d(1, 2, 3)
+        model_file = tmpdir / 'legacy.pt'
+        torch.save(model.state_dict(), str(model_file), _use_new_zipfile_serialization=False)
+
+        with mock.patch.object(io_model, '_load_state_dict_cached', wraps=io_model._load_state_dict_cached) as load:
+            model_re = io_model.LoadSaveModel(torch.nn.Conv2d(1, 2, 3), output_file=None,
+                                              input_file=model_file).load_init('cpu')
+
+        assert (model_re.weight == model.weight).all()
+        assert not any(c.args[-1] for c in load.call_args_list), "Legacy files must not be memory-mapped."
+
+
+def test_save_async_in_flight(tmpdir, capsys):
+    """A save while the previous one is in flight is written after it, and only reported once written"""
+    model = torch.nn.Conv2d(1, 2, 3)
+    model_ls = io_model.LoadSaveModel(model, output_file=tmpdir / 'model.pt', max_files=1, asynchronous=True)
+
+    block = threading.Event()
+    model_ls._writer.submit(block.wait)
+
+    model_ls.save(model, None)
+    assert 'Saved model' not in capsys.readouterr().out
+
+    block.set()
+    model_ls.wait()
+
+    assert 'Saved model' in capsys.readouterr().out
+    assert (torch.load(str(tmpdir / 'model_0.pt'))['weight'] == model.weight).all()
@@ -1,7 +1,117 @@
+import numpy as np
 import pytest
+import torch
+
+from decode.evaluation import match_emittersets
+from decode.generic import emitter
+from decode.neuralfitter import post_processing
+from decode.neuralfitter.utils import log_train_val_progress
+from decode.neuralfitter.utils import logger as logger_utils
+
 
 class TestLogTrain:
 
     @pytest.fixture()
     def hallo(self):
-        return
\ No newline at end of file
+        return
+
+class TestAsyncPostProcessLogTest:
+
+    @pytest.fixture()
+    def post_processor(self):
+        return post_processing.SpatialIntegration(raw_th=0.5, xy_unit='px', px_size=(100., 100.))
+
+    @pytest.fixture()
+    def matcher(self):
+        return match_emittersets.GreedyHungarianMatching(match_dims=2, dist_lat=50.)
+
+    @pytest.fixture()
+    def test_out(self):
+        n = 4
+        y_out = torch.rand(n, 10, 32, 32)
+        y_out[:, 0] = (torch.rand(n, 32, 32) > 0.99).float()
+
+        em_tar = emitter.RandomEmitterSet(40, extent=1, xy_unit='px', px_size=(100., 100.))
+        em_tar.frame_ix = torch.randint(n, size=(40, ))
+        em_tar.xyz_cr = torch.rand(40, 3) * 0.1 + 0.01
+        em_tar.phot_cr = torch.rand(40) * 0.1 + 0.01
+        em_tar.bg = torch.rand(40)
+        em_tar.bg_cr = torch.rand(40) * 0.1 + 0.01
+
+        return {'loss_cmp': torch.rand(n, 2), 'loss_scalar': 0.5, 'x': torch.rand(n, 3, 32, 32), 'y_out': y_out,
+                'y_tar': None, 'weight': None, 'em_tar': em_tar}
+
+    def test_record_logger(self, post_processor, matcher, test_out):
+        """Logging via record and replay is the same as logging directly."""
+        logger_direct = logger_utils.DictLogger()
+        logger_rec = logger_utils.RecordLogger()
+
+        for logger in (logger_direct, logger_rec):
+            log_train_val_progress.post_process_log_test(**test_out, px_border=-0.5, px_size=1.,
+                                                         post_processor=post_processor, matcher=matcher,
+                                                         logger=logger, step=0, log_figures=False)
+
+        logger_replay = logger_utils.DictLogger()
+        logger_rec.replay(logger_replay)
+
+        assert logger_replay.log_dict.keys() == logger_direct.log_dict.keys()
+        for k, v in logger_direct.log_dict.items():
+            np.testing.assert_array_equal(logger_replay.log_dict[k]['scalar'], v['scalar'])
+
+    def test_async(self, post_processor, matcher, test_out):
+        logger_sync = logger_utils.DictLogger()
+        logger_async = logger_utils.DictLogger()
+        post_process_async = log_train_val_progress.AsyncPostProcessLogTest(
+            post_processor=post_processor, matcher=matcher, px_border=-0.5, px_size=1., logger=logger_async)
+
+        try:
+            for step in range(3):
+                log_train_val_progress.post_process_log_test(**test_out, px_border=-0.5, px_size=1.,
+                                                             post_processor=post_processor, matcher=matcher,
+                                                             logger=logger_sync, step=step, log_figures=False)
+                post_process_async.submit(**test_out, step=step, log_figures=False)
+        finally:
+            post_process_async.close()
+
+        assert logger_async.log_dict.keys() == logger_sync.log_dict.keys()
+        for k, v in logger_sync.log_dict.items():
+            assert logger_async.log_dict[k]['step'] == [0, 1, 2]
+            np.testing.assert_array_equal(logger_async.log_dict[k]['scalar'], v['scalar'])
+
+    @pytest.mark.parametrize("batch_size", [1, 3, 4])
+    def test_streaming(self, post_processor, matcher, test_out, batch_size):
+        """Streaming evaluation is the same as evaluating the whole test set at once."""
+        logger_full = logger_utils.DictLogger()
+        logger_stream = logger_utils.DictLogger()
+
+        stream = log_train_val_progress.StreamingPostProcessLogTest(
+            post_processor=post_processor, matcher=matcher, em_tar=test_out['em_tar'], px_border=-0.5, px_size=1.,
+            n_frames_sample=2)
+
+        for x, y_out in zip(test_out['x'].split(batch_size), test_out['y_out'].clone().split(batch_size)):
+            stream.update(x=x, y_out=y_out.clone())
+
+        assert sum(len(x) for x in stream._x) == 2
+
+        stream.log(loss_cmp=test_out['loss_cmp'], loss_scalar=test_out['loss_scalar'], logger=logger_stream,
+                   step=0, log_figures=False)
+        log_train_val_progress.post_process_log_test(**test_out, px_border=-0.5, px_size=1.,
+                                                     post_processor=post_processor, matcher=matcher,
+                                                     logger=logger_full, step=0, log_figures=False)
+
+        assert logger_stream.log_dict.keys() == logger_full.log_dict.keys()
+        for k, v in logger_full.log_dict.items():
+            np.testing.assert_allclose(logger_stream.log_dict[k]['scalar'], v['scalar'], rtol=1e-4)
+
+    @pytest.mark.plot
+    def test_streaming_figures(self, post_processor, matcher, test_out):
+        stream = log_train_val_progress.StreamingPostProcessLogTest(
+            post_processor=post_processor, matcher=matcher, em_tar=test_out['em_tar'], px_border=-0.5, px_size=1.)
+
+        for x, y_out in zip(test_out['x'].split(3), test_out['y_out'].split(3)):
+            stream.update(x=x, y_out=y_out)
+
+        logger = logger_utils.RecordLogger()
+        stream.log(loss_cmp=test_out['loss_cmp'], loss_scalar=test_out['loss_scalar'], logger=logger, step=0)
+
+        assert any(rec[0] == 'add_image' for rec in logger.records)
@@ -1,4 +1,6 @@
 import warnings
+import matplotlib.pyplot as plt
+import numpy as np
 import pytest
 import torch
 
@@ -26,6 +28,38 @@ class TestDictLogger:
         assert (torch.tensor(logger.log_dict["dummy_scalar"]['scalar']) == torch.tensor(scalar_data)).all()
 
 
+class TestRecordLogger:
+
+    def test_record_replay(self):
+        logger_rec = logger.RecordLogger()
+        logger_rec.add_scalar('a', 1., 0)
+        logger_rec.add_scalar_dict('b/', {'c': 2., 'd': 3.}, 1)
+        logger_rec.add_figure('fig', plt.figure(), 2)
+
+        assert logger_rec.records[-1][0] == 'add_image', "Figures should be rendered to images."
+
+        logger_dict = logger.DictLogger()
+        logger_rec.replay(logger_dict)
+
+        assert logger_dict.log_dict['a']['scalar'] == [1.]
+        assert logger_dict.log_dict['b/c']['scalar'] == [2.]
+        assert logger_dict.log_dict['b/d']['step'] == [1]
+
+    def test_add_figure(self):
+        f = plt.figure(figsize=(2, 1), dpi=10)
+        f.patch.set_facecolor('red')
+
+        logger_rec = logger.RecordLogger()
+        logger_rec.add_figure('fig', f, 0)
+
+        _, (tag, img, step), kwargs = logger_rec.records[0]
+        assert img.shape == (3, 10, 20)
+        assert img.dtype == np.uint8
+        assert (img[0] == 255).all() and (img[1:] == 0).all()
+        assert kwargs['dataformats'] == 'CHW'
+        assert not plt.fignum_exists(f.number), "Figure should be closed."
+
+
 class TestMultiLogger:
     class ALogger:
         def log_scalar(self, a):
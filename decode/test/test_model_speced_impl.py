@@ -43,3 +43,45 @@ class TestSigmaMUNet:
         for mod, mod_old in zip(model.named_parameters(), model_old.named_parameters()):
             if mod[0][-6:] == 'weight':
                 assert (mod[1] != mod_old[1]).all()
+
+    @pytest.mark.parametrize("norm", [None, 'GroupNorm'])
+    @pytest.mark.parametrize("train", [False, True])
+    def test_forward_shared_batched(self, norm, train):
+        """Tests that the batched shared UNet pass equals separate passes per frame of the window."""
+
+        """Setup"""
+        model = model_impl.SigmaMUNet(3, depth_shared=2, depth_union=1, initial_features=16, inter_features=16,
+                                      norm=norm, norm_groups=2 if norm is not None else None)
+        model.train(train)
+        x = torch.rand((2, 3, 32, 32))
+
+        """Run"""
+        with torch.no_grad():
+            out = model.forward(x)
+            f = torch.cat([model.forward_shared(x[:, [i]]) for i in range(3)], 1)
+            out_sep = model._forward_heads(model.unet_union.forward(f))
+
+        """Assertions"""
+        assert torch.equal(out, out_sep)
+
+    @pytest.mark.parametrize("norm_head", [None, 'GroupNorm'])
+    def test_fuse_heads(self, norm_head):
+
+        """Setup"""
+        model = model_impl.SigmaMUNet(3, depth_shared=1, depth_union=1, initial_features=16, inter_features=16,
+                                      norm_head=norm_head, norm_head_groups=4 if norm_head is not None else None,
+                                      kaiming_normal=False)
+        for p in model.parameters():  # non-trivial affine parameters of the norms
+            torch.nn.init.uniform_(p, -0.5, 0.5)
+        state_keys = model.state_dict().keys()
+        model.eval()
+        x = torch.rand((2, 3, 32, 32))
+
+        """Run"""
+        with torch.no_grad():
+            out = model.forward(x)
+            out_fused = model.forward(x, heads_fused=model.fuse_heads())
+
+        """Assertions"""
+        assert model.state_dict().keys() == state_keys
+        assert torch.allclose(out_fused, out, atol=1e-6)
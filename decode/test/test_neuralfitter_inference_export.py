@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+from decode.generic import emitter
+from decode.neuralfitter import coord_transform
+from decode.neuralfitter import models
+from decode.neuralfitter import post_processing
+from decode.neuralfitter import scale_transform
+from decode.neuralfitter.inference import export
+from decode.neuralfitter.utils import processing
+
+
+class TestExport:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).eval()
+
+    @pytest.fixture(params=['LookUp', 'NMS'])
+    def post_proc(self, request):
+        if request.param == 'LookUp':
+            lookup = post_processing.LookUpPostProcessing(raw_th=0.002, xy_unit='px', px_size=(100., 100.))
+        else:
+            lookup = post_processing.SpatialIntegration(raw_th=0.002, xy_unit='px', px_size=(100., 100.))
+
+        return processing.TransformSequence([
+            scale_transform.InverseParamListRescale(phot_max=1000., z_max=500., bg_max=100.),
+            coord_transform.Offset2Coordinate((-0.5, 31.5), (-0.5, 23.5), (32, 24)),
+            lookup
+        ])
+
+    @pytest.mark.parametrize("batch_size", [1, 5])
+    def test_forward(self, model, post_proc, batch_size, tmpdir):
+        """Exported graph must give the same localizations as model and post-processing."""
+        path = tmpdir / 'model_graph.pt'
+        export.export(model, post_proc, path)
+        graph = export.load(path)
+
+        x = torch.rand(batch_size, 3, 32, 24)
+        with torch.no_grad():
+            em_ref = post_proc.forward(model(x))
+            em = export.to_emitterset(graph(x), graph)
+
+        assert isinstance(em, emitter.EmitterSet)
+        assert len(em) == len(em_ref) >= 1
+        assert em.xy_unit == em_ref.xy_unit
+        torch.testing.assert_allclose(em.px_size, em_ref.px_size)
+
+        for attr in ('frame_ix', 'xyz', 'phot', 'prob', 'bg', 'xyz_sig', 'phot_sig'):
+            torch.testing.assert_allclose(getattr(em, attr), getattr(em_ref, attr))
+
+    def test_forward_frame_size(self, model, post_proc, tmpdir):
+        """Graph must not be limited to the frame size at which it was traced."""
+        graph = export.export(model, post_proc, tmpdir / 'model_graph.pt')
+        post_proc.com[1] = coord_transform.Offset2Coordinate((-0.5, 63.5), (-0.5, 39.5), (64, 40))
+
+        x = torch.rand(2, 3, 64, 40)
+        with torch.no_grad():
+            em_ref = post_proc.forward(model(x))
+            em = export.to_emitterset(graph(x), graph)
+
+        assert len(em) == len(em_ref) >= 1
+        for attr in ('frame_ix', 'xyz', 'phot', 'prob', 'bg'):
+            torch.testing.assert_allclose(getattr(em, attr), getattr(em_ref, attr))
+
+    def test_export_graph(self, model, post_proc):
+        """Exporting a graph must not change it"""
+        graph = export.InferenceGraph.from_transform_sequence(model, post_proc)
+        export.export(model, graph)
+
+        assert graph.model is model
+
+    def test_unsupported_post_processing(self, model):
+        with pytest.raises(TypeError):
+            export.InferenceGraph.from_transform_sequence(model, processing.TransformSequence(
+                [post_processing.NoPostProcessing()]))
+
+    def test_graph_path(self):
+        assert export.graph_path('out/model.pt').name == 'model_graph.pt'
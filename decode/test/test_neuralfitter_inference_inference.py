@@ -9,8 +9,15 @@ import torch
 from decode.generic import emitter
 from decode.generic import test_utils
 from decode.generic.process import Identity
+from decode.neuralfitter import coord_transform
+from decode.neuralfitter import models
 from decode.neuralfitter import post_processing
+from decode.neuralfitter import scale_transform
 from decode.neuralfitter.inference import inference
+from decode.neuralfitter.inference import tiling
+from decode.neuralfitter.utils import padding_calc
+from decode.neuralfitter.utils import processing
+from decode.utils import emitter_io
 from decode.utils import frames_io
 
 from .test_utils_frames_io import online_tiff_writer
@@ -65,6 +72,23 @@ class TestInfer:
         assert isinstance(out, torch.Tensor)
         assert out.size() == torch.Size((100, 1, 64, 64))
 
+    @pytest.mark.parametrize("err", [NotImplementedError, PermissionError])
+    def test_batch_size_fallback(self, infer, err):
+        """Where the peak memory can not be measured, the batch size falls back to a fixed value."""
+        infer.device = 'cpu'
+        with mock.patch.object(inference.hardware, 'peak_memory', side_effect=err):
+            with pytest.warns(UserWarning):
+                assert infer._batch_size(infer.model, (3, 64, 64)) == inference.Infer._batch_size_fallback
+
+    def test_batch_size_cached(self, infer):
+        infer.device = 'cpu'
+        with mock.patch.object(inference.Infer, 'get_max_batch_size', return_value=10) as get_max_batch_size:
+            infer.forward(torch.rand(20, 32, 32))
+            infer.forward(torch.rand(20, 32, 32))
+            infer.forward(torch.rand(20, 16, 16))
+
+        assert get_max_batch_size.call_count == 2
+
     @pytest.mark.skipif(not torch.cuda.is_available(), reason="Needs CUDA.")
     def test_get_max_batch_size(self, infer):
         infer.model = torch.hub.load('mateuszbuda/brain-segmentation-pytorch', 'unet',
@@ -75,6 +99,224 @@ class TestInfer:
         assert 16 <= bs <= 1024
 
 
+class TestInferSequential:
+
+    @pytest.fixture(params=[1, 3])
+    def model(self, request):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=request.param, depth_shared=1, depth_union=1, initial_features=8,
+                                 inter_features=8)
+
+    @pytest.mark.parametrize("batch_size", [1, 7, 64])
+    def test_forward(self, model, batch_size):
+        """Sequential inference must give the same output as the per frame window one."""
+        frames = torch.rand(20, 16, 16)
+        frame_proc = scale_transform.AmplitudeRescale(scale=10., offset=1.)
+
+        out = [inference.Infer(model=model, ch_in=model.ch_in, frame_proc=frame_proc, post_proc=Identity(),
+                               device='cpu', batch_size=batch_size, forward_cat='frames',
+                               sequential=sequential).forward(frames)
+               for sequential in (False, True)]
+
+        assert out[0].size() == out[1].size() == torch.Size((20, 10, 16, 16))
+        torch.testing.assert_allclose(out[1], out[0], rtol=1e-4, atol=1e-5)
+
+    def test_shared_once_per_frame(self, model):
+        infer = inference.Infer(model=model, ch_in=model.ch_in, frame_proc=None, post_proc=Identity(),
+                                device='cpu', batch_size=8, forward_cat='frames', sequential=True)
+
+        with mock.patch.object(model, 'forward_shared', wraps=model.forward_shared) as forward_shared:
+            infer.forward(torch.rand(20, 16, 16))
+
+        assert sum(call[0][0].size(0) for call in forward_shared.call_args_list) == 20
+
+    def test_model_without_shared_part(self):
+        with pytest.raises(ValueError):
+            inference.Infer(model=torch.nn.Conv2d(3, 1, 1), ch_in=3, frame_proc=None, post_proc=Identity(),
+                            device='cpu', sequential=True)
+
+
+class TestInferFusedHeads:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).eval()
+
+    def test_current_weights(self, model):
+        """On cuda the heads are fused from the current weights, the model itself is not changed."""
+        infer = inference.Infer(model, 3, None, Identity(), 'cpu', batch_size=4, forward_cat='frames')
+        assert infer._forward_kwargs(model) == {}
+
+        infer.device = 'cuda'  # without moving anything there
+        x = torch.rand(2, 3, 16, 16)
+        with torch.no_grad():
+            torch.testing.assert_close(model(x, **infer._forward_kwargs(model)), model(x), atol=1e-6, rtol=1e-5)
+
+            model.mt_heads[1].out_conv.bias += 1.  # e.g. new weights loaded
+            torch.testing.assert_close(model(x, **infer._forward_kwargs(model)), model(x), atol=1e-6, rtol=1e-5)
+
+        assert not any(isinstance(m, models.model_param.FusedMLTHeads) for m in model.modules())
+
+    @pytest.mark.parametrize("mode", ['batch', 'sequential', 'tiled'])
+    def test_forward(self, model, mode):
+        """Fused heads are used in all modes of forward"""
+        post_proc = TestInferTiled.post_proc((16, 16)) if mode == 'tiled' else Identity()
+        infer = inference.Infer(model, 3, None, post_proc, 'cpu', batch_size=4,
+                                forward_cat='emitter' if mode == 'tiled' else 'frames', sequential=mode == 'sequential',
+                                tile_size=16 if mode == 'tiled' else None, tile_overlap=4)
+
+        frames = torch.rand(6, 32, 32)
+        out = infer.forward(frames)
+
+        with mock.patch.object(inference.Infer, '_forward_kwargs', lambda self, m: {'heads_fused': m.fuse_heads()}), \
+                mock.patch.object(models.SigmaMUNet, '_forward_heads_fused', autospec=True,
+                                  side_effect=models.SigmaMUNet._forward_heads_fused) as forward_fused:
+            out_fused = infer.forward(frames)
+
+        forward_fused.assert_called()
+        if mode == 'tiled':
+            assert len(out_fused) == len(out) >= 1
+            torch.testing.assert_close(out_fused.xyz, out.xyz, atol=1e-4, rtol=1e-4)
+        else:
+            torch.testing.assert_close(out_fused, out, atol=1e-5, rtol=1e-4)
+
+
+class TestInferTiled:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).eval()
+
+    @staticmethod
+    def post_proc(size):
+        return processing.TransformSequence([
+            scale_transform.InverseParamListRescale(phot_max=1000., z_max=500., bg_max=100.),
+            coord_transform.Offset2Coordinate((-0.5, size[0] - 0.5), (-0.5, size[1] - 0.5), size),
+            post_processing.SpatialIntegration(raw_th=0.0025, xy_unit='px', px_size=(100., 100.))
+        ])
+
+    def test_receptive_field(self, model):
+        assert padding_calc.receptive_field(torch.nn.Conv2d(3, 1, 5, padding=2), 3) == 2
+        assert 10 <= padding_calc.receptive_field(model, 3) < 32
+        assert all(p.grad is None for p in model.parameters())
+
+    def test_tiling(self):
+        t = tiling.Tiling((128, 96), 64, overlap=7, align=4)
+
+        assert t.overlap == 8
+        assert (t.origins % 4 == 0).all()
+        assert (t.origins[:, 0] + 64 <= 128).all() and (t.origins[:, 1] + 64 <= 96).all()
+
+        """Cores partition the frame"""
+        cover = torch.zeros(128, 96)
+        for c in t.cores:
+            cover[c[0]:c[1], c[2]:c[3]] += 1
+        assert (cover == 1).all()
+
+        assert t.crop(torch.rand(5, 3, 128, 96)).size() == torch.Size((5 * len(t), 3, 64, 64))
+
+    @pytest.mark.parametrize("batch_size", [5, 64])
+    def test_forward(self, model, batch_size):
+        """Tiled inference must give the same localizations as whole frame inference."""
+        frames = torch.rand(6, 128, 96)
+
+        em = inference.Infer(model, 3, None, self.post_proc((128, 96)), 'cpu', batch_size=8).forward(frames)
+        em_tiled = inference.Infer(model, 3, None, self.post_proc((64, 64)), 'cpu', batch_size=batch_size,
+                                   tile_size=64).forward(frames)
+
+        assert len(em) == len(em_tiled) >= 1
+
+        sort = lambda e: e[torch.argsort(e.frame_ix * 1e6 + e.xyz[:, 0].round() * 1e3 + e.xyz[:, 1].round())]
+        em, em_tiled = sort(em), sort(em_tiled)
+
+        assert (em.frame_ix == em_tiled.frame_ix).all()
+        torch.testing.assert_allclose(em_tiled.xyz, em.xyz, rtol=1e-4, atol=1e-3)
+        torch.testing.assert_allclose(em_tiled.phot, em.phot, rtol=1e-4, atol=1e-2)
+
+    def test_sequential(self, model):
+        with pytest.raises(ValueError):
+            inference.Infer(model, 3, None, self.post_proc((64, 64)), 'cpu', tile_size=64, sequential=True)
+
+
+class TestInferPipelined:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).eval()
+
+    @pytest.mark.parametrize("tile_size", [None, 32])
+    def test_forward(self, model, tile_size):
+        """Pipelined inference must give the same localizations (in the same order) as serial inference."""
+        frames = torch.rand(37, 64, 48)  # last batch is smaller
+        size = (64, 48) if tile_size is None else (tile_size, tile_size)
+
+        em = [inference.Infer(model, 3, None, TestInferTiled.post_proc(size), 'cpu', batch_size=8,
+                              tile_size=tile_size, tile_overlap=8, post_proc_workers=workers).forward(frames)
+              for workers in (0, 3)]
+
+        assert len(em[0]) == len(em[1]) >= 1
+        assert (em[0].frame_ix == em[1].frame_ix).all()
+        assert em[1].frame_ix.max() <= 36 and em[1].frame_ix.max() >= 32
+        torch.testing.assert_allclose(em[1].xyz, em[0].xyz)
+
+    def test_map_ordered(self):
+        def func(x):
+            time.sleep(0.01 * (x % 3))  # finish out of order
+            return x
+
+        assert list(inference._map_ordered(func, range(20), 4)) == list(range(20))
+        assert list(inference._map_ordered(func, range(20), 0)) == list(range(20))
+
+    def test_map_ordered_bounded(self):
+        """The producer must not run ahead of the consumer by more than 2 * workers items."""
+        produced = []
+
+        def producer():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        for i, _ in enumerate(inference._map_ordered(lambda x: x, producer(), 2)):
+            assert len(produced) - i <= 4
+
+
+class TestInferSink:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).eval()
+
+    @pytest.mark.parametrize("tile_size,post_proc_workers", [(None, 0), (None, 2), (32, 0)])
+    def test_forward_to(self, model, tile_size, post_proc_workers, tmpdir):
+        """Localizations passed to the sink must equal the output of forward, incl. absolute frame indices."""
+        frames = torch.rand(21, 64, 48)  # last batch is smaller
+        size = (64, 48) if tile_size is None else (tile_size, tile_size)
+        infer = inference.Infer(model, 3, None, TestInferTiled.post_proc(size), 'cpu', batch_size=4,
+                                tile_size=tile_size, tile_overlap=8, post_proc_workers=post_proc_workers)
+
+        em = infer.forward(frames)
+        with emitter_io.H5Sink(tmpdir / 'em.h5') as sink:
+            infer.forward_to(frames, sink)
+
+        sink = infer.forward_to(frames, emitter_io.MemorySink())
+
+        assert len(sink._em) >= 2
+        for em_sink in (sink.emitters, emitter.EmitterSet.load(tmpdir / 'em.h5')):
+            assert len(em_sink) == len(em) >= 1
+            assert (em_sink.frame_ix == em.frame_ix).all()
+            torch.testing.assert_allclose(em_sink.xyz, em.xyz)
+
+    def test_forward_cat_frames(self, model):
+        infer = inference.Infer(model, 3, None, Identity(), 'cpu', batch_size=4, forward_cat='frames')
+
+        with pytest.raises(ValueError):
+            infer.forward_to(torch.rand(5, 16, 16), emitter_io.MemorySink())
+
+
 class TestLiveInfer(TestInfer):
 
     @pytest.fixture()
@@ -95,6 +337,16 @@ class TestLiveInfer(TestInfer):
     def test_forward_frames(self):
         return
 
+    def test_batch_size_cached(self, infer):
+        """The batch size must not be determined again for each chunk."""
+        infer._stream = mock.MagicMock()
+        infer._time_wait = 0.1
+        with mock.patch.object(inference.Infer, 'get_max_batch_size', return_value=10) as get_max_batch_size:
+            infer.forward(TestLiveInferIncremental.GrowingFrames(torch.rand(40, 32, 32), 10, 0.1))
+
+        assert infer._stream.call_count >= 2
+        assert get_max_batch_size.call_count == 1
+
     def test_forward_online(self, infer, tmpdir):
         path = tmpdir / 'online.tiff'
         tiff_writer = threading.Thread(target=online_tiff_writer, args=[path, 10, 0.5])
@@ -118,3 +370,95 @@ class TestLiveInfer(TestInfer):
         # check that last call of inference ends with last index of frames
         args, _ = infer._stream.call_args_list[-1]
         assert args[2] == 1000
+
+
+class TestLiveInferIncremental:
+
+    class GrowingFrames:
+        """Frames of which a writer thread makes more available over time"""
+
+        def __init__(self, frames, n_step, time_step):
+            self._frames = frames
+            self._n = 0
+            self._writer = threading.Thread(target=self._write, args=[n_step, time_step])
+            self._writer.start()
+
+        def _write(self, n_step, time_step):
+            while self._n < len(self._frames):
+                self._n = min(self._n + n_step, len(self._frames))
+                time.sleep(time_step)
+
+        def __len__(self):
+            return self._n
+
+        def __getitem__(self, pos):
+            return self._frames[:self._n][pos]
+
+    @pytest.fixture(params=[1, 3])
+    def model(self, request):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=request.param, depth_shared=1, depth_union=1, initial_features=8,
+                                 inter_features=8).eval()
+
+    @pytest.mark.parametrize("post_proc_workers", [0, 2])
+    def test_forward(self, model, post_proc_workers):
+        """Incremental live inference must give the same localizations as inference on the whole stack."""
+        frames = torch.rand(47, 32, 24)
+        stream = mock.MagicMock()
+
+        infer = inference.LiveInfer(model, model.ch_in, stream=stream, time_wait=0.2,
+                                    post_proc=TestInferTiled.post_proc((32, 24)), device='cpu', batch_size=4,
+                                    incremental=True, post_proc_workers=post_proc_workers)
+        infer.forward(self.GrowingFrames(frames, 9, 0.1))
+
+        chunks = [call[0] for call in stream.call_args_list]
+        assert len(chunks) >= 2
+        assert chunks[0][1] == 0 and chunks[-1][2] == 47
+        assert all(c[2] == c_next[1] for c, c_next in zip(chunks[:-1], chunks[1:]))
+
+        for em, n_low, n_high in chunks:
+            em.frame_ix += n_low
+        em_live = emitter.EmitterSet.cat([c[0] for c in chunks])
+
+        em = inference.Infer(model, model.ch_in, None, TestInferTiled.post_proc((32, 24)), 'cpu',
+                             batch_size=8).forward(frames)
+
+        assert len(em_live) == len(em) >= 1
+        assert (em_live.frame_ix == em.frame_ix).all()
+        torch.testing.assert_allclose(em_live.xyz, em.xyz, rtol=1e-4, atol=1e-3)
+        torch.testing.assert_allclose(em_live.phot, em.phot, rtol=1e-4, atol=1e-2)
+
+    def test_forward_tiff(self, model, tmpdir):
+        """Incremental live inference on a growing tiff (woken by the file watcher)."""
+        path = tmpdir / 'growing.tiff'
+        frames = torch.rand(47, 32, 24)
+        chunks = torch.split(frames, 9)
+
+        def write():
+            for c in chunks[1:]:
+                time.sleep(0.3)
+                tifffile.imwrite(str(path), c.numpy(), append=True)
+
+        tifffile.imwrite(str(path), chunks[0].numpy())
+        writer = threading.Thread(target=write)
+        writer.start()
+
+        stream = mock.MagicMock()
+        infer = inference.LiveInfer(model, model.ch_in, stream=stream, time_wait=1.,
+                                    post_proc=TestInferTiled.post_proc((32, 24)), device='cpu', batch_size=4,
+                                    incremental=True)
+        infer.forward(frames_io.TiffTensor(path))
+        writer.join()
+
+        chunks = [call[0] for call in stream.call_args_list]
+        assert len(chunks) >= 2
+        assert chunks[0][1] == 0 and chunks[-1][2] == 47
+        assert all(c[2] == c_next[1] for c, c_next in zip(chunks[:-1], chunks[1:]))
+
+        em_live = emitter.EmitterSet.cat([c[0] for c in chunks], remap_frame_ix=torch.tensor([c[1] for c in chunks]))
+        em = inference.Infer(model, model.ch_in, None, TestInferTiled.post_proc((32, 24)), 'cpu',
+                             batch_size=8).forward(frames)
+
+        assert len(em_live) == len(em) >= 1
+        assert (em_live.frame_ix == em.frame_ix).all()
+        torch.testing.assert_allclose(em_live.xyz, em.xyz, rtol=1e-4, atol=1e-3)
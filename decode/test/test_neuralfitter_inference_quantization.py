@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from decode.evaluation import match_emittersets
+from decode.neuralfitter import models
+from decode.neuralfitter import post_processing
+from decode.neuralfitter.inference import quantization
+
+
+@pytest.mark.skipif('fbgemm' not in torch.backends.quantized.supported_engines, reason="Needs fbgemm.")
+class TestQuantization:
+
+    @pytest.fixture(params=[None, 'GroupNorm'])
+    def model(self, request):
+        torch.manual_seed(0)
+        return models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8,
+                                 norm=request.param, norm_groups=2).eval()
+
+    @pytest.fixture()
+    def frames(self):
+        return torch.rand(20, 32, 32)
+
+    def test_quantize(self, model, frames):
+        model_quant = quantization.quantize(model, frames, ch_in=3, batch_size=8)
+
+        """Trunk quantized, heads in float, original model untouched"""
+        assert isinstance(model_quant.unet_shared, quantization.QuantizedTrunk)
+        assert isinstance(model_quant.unet_union, quantization.QuantizedTrunk)
+        assert isinstance(model.unet_shared.encoder[0][-2], torch.nn.Conv2d)
+        assert type(model_quant.mt_heads[0].out_conv) is torch.nn.Conv2d
+        assert any(isinstance(m, torch.nn.quantized.Conv2d) for m in model_quant.unet_union.modules())
+
+        x = torch.rand(4, 3, 32, 32)
+        with torch.no_grad():
+            out, out_quant = model(x), model_quant(x)
+
+        assert out_quant.size() == out.size()
+        assert out_quant.dtype == torch.float32
+
+        """Quantized trunks close to the float ones, relative to their output range"""
+        f = x.view(-1, 1, 32, 32)
+        for t in ('unet_shared', 'unet_union'):
+            with torch.no_grad():
+                f, f_quant = getattr(model, t)(f), getattr(model_quant, t)(f)
+
+            assert (f_quant - f).abs().max() <= 0.2 * f.abs().max()
+            f = f.view(4, -1, 32, 32)
+
+    def test_unsupported(self, frames):
+        with pytest.raises(TypeError):
+            quantization.prepare(torch.nn.Conv2d(3, 10, 1))
+
+        with pytest.raises(ValueError):
+            quantization.prepare(models.SigmaMUNet(ch_in=3, depth_shared=1, depth_union=1, initial_features=8,
+                                                   inter_features=8), backend='qnnpack_')
+
+    def test_compare(self, model, frames):
+        model_quant = quantization.quantize(model, frames, ch_in=3, batch_size=8)
+
+        out = quantization.compare(model, model_quant, frames[:4, :16, :16], ch_in=3,
+                                   post_proc=post_processing.LookUpPostProcessing(raw_th=0.002, xy_unit='px',
+                                                                                  px_size=(100., 100.)),
+                                   matcher=match_emittersets.GreedyHungarianMatching(match_dims=2, dist_lat=100.))
+
+        assert out.float.jac == pytest.approx(1.)  # float model is the reference
+        assert 0.9 <= out.quantized.jac <= 1.
+        assert out.fps_float > 0 and out.fps_quantized > 0
@@ -1,3 +1,6 @@
+import time
+
+import numpy as np
 import pytest
 import torch
 
@@ -211,3 +214,93 @@ class TestGaussianMixtureModelLoss:
         assert log_out['gmm'] == 0.
         assert log_out['bg'] != 0.
 
+
+    @pytest.fixture()
+    def data_random(self):
+        n, m = 3, 20
+        p = torch.rand(n, 32, 32) * 0.98 + 0.01
+        pxyz_mu = torch.randn(n, 4, 32, 32) * 0.5
+        pxyz_sig = torch.rand(n, 4, 32, 32) + 0.1
+
+        pxyz_tar = torch.rand(n, m, 4)
+        pxyz_tar[..., 1:3] = pxyz_tar[..., 1:3] * 32 - 0.5
+        mask = (torch.rand(n, m) > 0.3).long()
+
+        return mask, p, pxyz_mu, pxyz_sig, pxyz_tar
+
+    @pytest.mark.parametrize("sparse_arg", [{'n_components': 32 * 32}, {'radius': 50.}])
+    def test_gmm_sparse_exact(self, data_random, sparse_arg):
+        """Sparse mixture with all pixels as components must match the full one (incl. gradient)."""
+        mask, p, pxyz_mu, pxyz_sig, pxyz_tar = data_random
+        loss_full = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32), device='cpu')
+        loss_sparse = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32),
+                                          device='cpu', **sparse_arg)
+
+        mu_full = pxyz_mu.clone().requires_grad_(True)
+        mu_sparse = pxyz_mu.clone().requires_grad_(True)
+
+        out_full = loss_full._compute_gmm_loss(p, mu_full, pxyz_sig, pxyz_tar, mask)
+        out_sparse = loss_sparse._compute_gmm_loss(p, mu_sparse, pxyz_sig, pxyz_tar, mask)
+        out_full.sum().backward()
+        out_sparse.sum().backward()
+
+        np.testing.assert_allclose(out_sparse.detach(), out_full.detach(), rtol=1e-4)
+        np.testing.assert_allclose(mu_sparse.grad, mu_full.grad, rtol=1e-3, atol=1e-5)
+
+    @pytest.mark.parametrize("sparse_arg", [{'n_components': 16}, {'radius': 0.}, {'radius': 3.}])
+    def test_gmm_sparse_bound(self, data_random, sparse_arg):
+        """Dropping components can only increase the loss."""
+        mask, p, pxyz_mu, pxyz_sig, pxyz_tar = data_random
+        loss_full = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32), device='cpu')
+        loss_sparse = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32),
+                                          device='cpu', **sparse_arg)
+
+        out_full = loss_full._compute_gmm_loss(p, pxyz_mu, pxyz_sig, pxyz_tar, mask)
+        out_sparse = loss_sparse._compute_gmm_loss(p, pxyz_mu, pxyz_sig, pxyz_tar, mask)
+
+        assert torch.isfinite(out_sparse).all()
+        assert (out_sparse >= out_full - 1e-3).all()
+
+    def test_gmm_sparse_close(self, data_handcrafted):
+        """Components far away from the targets do not matter."""
+        mask, p, pxyz_mu, pxyz_sig, pxyz_tar = data_handcrafted
+        pxyz_sig = pxyz_sig.clamp(max=3.)
+        loss_full = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32), device='cpu')
+        loss_sparse = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32),
+                                          device='cpu', radius=2.)
+
+        out_full = loss_full._compute_gmm_loss(p, pxyz_mu, pxyz_sig, pxyz_tar, mask)
+        out_sparse = loss_sparse._compute_gmm_loss(p, pxyz_mu, pxyz_sig, pxyz_tar, mask)
+
+        np.testing.assert_allclose(out_sparse, out_full, rtol=1e-4)
+
+    def test_gmm_sparse_args(self):
+        with pytest.raises(ValueError):
+            loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32), device='cpu',
+                                n_components=10, radius=2.)
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize("sparse_arg", [{'n_components': 64}, {'radius': 3.}])
+    def test_gmm_sparse_benchmark(self, sparse_arg):
+        n, m, size = 16, 250, 64
+        p = torch.rand(n, size, size).requires_grad_(True)
+        pxyz_mu = torch.randn(n, 4, size, size).requires_grad_(True)
+        pxyz_sig = (torch.rand(n, 4, size, size) + 0.1).requires_grad_(True)
+        pxyz_tar = torch.rand(n, m, 4) * size
+        mask = torch.ones(n, m).long()
+
+        loss_full = loss.GaussianMMLoss(xextent=(-0.5, size - 0.5), yextent=(-0.5, size - 0.5),
+                                        img_shape=(size, size), device='cpu')
+        loss_sparse = loss.GaussianMMLoss(xextent=(-0.5, size - 0.5), yextent=(-0.5, size - 0.5),
+                                          img_shape=(size, size), device='cpu', **sparse_arg)
+
+        def step(loss_impl):
+            t0 = time.perf_counter()
+            loss_impl._compute_gmm_loss(p, pxyz_mu, pxyz_sig, pxyz_tar, mask).sum().backward()
+            return time.perf_counter() - t0
+
+        t_full = min(step(loss_full) for _ in range(3))
+        t_sparse = min(step(loss_sparse) for _ in range(3))
+        print(f"GMM loss forward + backward, full: {t_full:.3f}s, sparse ({sparse_arg}): {t_sparse:.3f}s")
+
+        assert t_sparse < t_full
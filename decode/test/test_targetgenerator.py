@@ -305,3 +305,32 @@ class TestParameterListTarget(TestTargetGenerator):
         assert (param_tar[[0, 1], 0, 0] == fem.phot).all()
         assert (param_tar[[0, 1], 0, 1:] == fem.xyz_px).all()
         assert (param_tar[2:] == 0.).all()
+
+    @pytest.mark.parametrize("n", [0, 1, 1000])
+    def test_forward_vs_loop(self, n):
+        """Compare against straight forward frame by frame implementation."""
+        targ = target_generator.ParameterListTarget(n_max=100, xextent=(-.5, 63.5), yextent=(-.5, 63.5),
+                                                    xy_unit='px', ix_low=-2, ix_high=20)
+
+        em = RandomEmitterSet(n, extent=64, xy_unit='px')
+        em.phot = torch.rand(n)
+        em.frame_ix = torch.randint(-5, 25, size=(n,))
+
+        param_tar, mask_tar, _ = targ.forward(em)
+
+        em_filt = targ._fov_filter.forward(em.get_subset_frame(-2, 20, 2))
+        assert mask_tar.sum() == len(em_filt)
+        for i in range(param_tar.size(0)):
+            em_i = em_filt[em_filt.frame_ix == i]
+
+            assert (mask_tar[i, :len(em_i)]).all()
+            assert not (mask_tar[i, len(em_i):]).any()
+            assert (param_tar[i, :len(em_i), 0] == em_i.phot).all()
+            assert (param_tar[i, :len(em_i), 1:] == em_i.xyz_px).all()
+            assert (param_tar[i, len(em_i):] == 0.).all()
+
+    def test_forward_overflow(self, targ):
+        em = RandomEmitterSet(targ.n_max + 1, extent=60, xy_unit='px')
+
+        with pytest.raises(ValueError):
+            targ.forward(em)
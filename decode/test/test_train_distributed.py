@@ -0,0 +1,109 @@
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from decode.neuralfitter import loss
+from decode.neuralfitter import models
+from decode.neuralfitter import train_val_impl
+from decode.neuralfitter.train import distributed
+from decode.neuralfitter.utils import logger as logger_utils
+from decode.utils import param_io, types
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, port, out):
+    """Runs in a spawned process per rank."""
+    import os
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'MASTER_ADDR': 'localhost', 'MASTER_PORT': str(port)})
+
+    ctx = distributed.init('gloo')
+    seed = distributed.seed_rank(ctx)
+
+    """Rank dependent data, gradients must be averaged"""
+    model = torch.nn.parallel.DistributedDataParallel(torch.nn.Linear(1, 1, bias=False))
+    model(torch.ones(1, 1) * (rank + 1)).sum().backward()
+
+    out[rank] = torch.tensor([seed, model.module.weight.grad.item(),
+                              distributed.broadcast_object(rank, ctx)], dtype=torch.float64)
+    distributed.cleanup()
+
+
+def _worker_grad_rescale(rank, world_size, port, out):
+    """Trains a DDP wrapped model with last layer gradient rescaling on rank dependent data."""
+    import os
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'MASTER_ADDR': 'localhost', 'MASTER_PORT': str(port)})
+
+    distributed.init('gloo')
+
+    torch.manual_seed(0)
+    model = models.model_param.DoubleMUnet(ch_in=1, ch_out=6, depth_shared=1, depth_union=1, initial_features=8,
+                                           inter_features=8, pool_mode='StrideConv')
+    model_ddp = torch.nn.parallel.DistributedDataParallel(model)
+
+    torch.manual_seed(rank + 1)
+    data = torch.rand(4, 1, 16, 16), torch.rand(4, 6, 16, 16), torch.rand(4, 6, 16, 16)
+    dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(*data), batch_size=2)
+
+    train_val_impl.train(model_ddp, torch.optim.SGD(model.parameters(), lr=0.1), loss.PPXYZBLoss(torch.device('cpu')),
+                         dl, grad_rescale=True, grad_mod=False, epoch=0, device=torch.device('cpu'),
+                         logger=logger_utils.NoLog())
+
+    out[rank] = torch.nn.utils.parameters_to_vector(model.parameters()).detach()
+    distributed.cleanup()
+
+
+def test_init_single():
+    ctx = distributed.init()
+
+    assert not ctx.distributed
+    assert ctx.is_main
+    assert not dist.is_initialized()
+
+
+def test_shard_param():
+    param = types.RecursiveNamespace(**param_io.load_reference())
+    param.HyperParameter.batch_size = 64
+    param.HyperParameter.pseudo_ds_size = 1000
+
+    distributed.shard_param(param, 4)
+    assert param.HyperParameter.batch_size == 16
+    assert param.HyperParameter.pseudo_ds_size == 250
+
+    with pytest.raises(ValueError):
+        distributed.shard_param(param, 3)
+
+
+def test_gloo():
+    world_size = 2
+    out = torch.zeros(world_size, 3, dtype=torch.float64).share_memory_()
+
+    torch.multiprocessing.spawn(_worker, args=(world_size, _free_port(), out), nprocs=world_size)
+
+    seed, grad, src = out.unbind(1)
+    assert seed[0] != seed[1], "Ranks must simulate with independent seeds"
+    assert (grad == 1.5).all(), "Gradient must be averaged over ranks"
+    assert (src == 0).all()
+
+
+def test_gloo_grad_rescale():
+    """Replicas must stay identical with last layer gradient rescaling."""
+    world_size = 2
+    torch.manual_seed(0)
+    n_param = sum(p.numel() for p in models.model_param.DoubleMUnet(
+        ch_in=1, ch_out=6, depth_shared=1, depth_union=1, initial_features=8, inter_features=8,
+        pool_mode='StrideConv').parameters())
+    out = torch.zeros(world_size, n_param).share_memory_()
+
+    torch.multiprocessing.spawn(_worker_grad_rescale, args=(world_size, _free_port(), out), nprocs=world_size)
+
+    assert (out[0] != 0).any()
+    torch.testing.assert_close(out[0], out[1])
@@ -2,10 +2,13 @@ import pytest
 import torch
 
 from decode.neuralfitter import loss
+from decode.neuralfitter import models
 from decode.neuralfitter import post_processing
 from decode.neuralfitter import train_val_impl
 from decode.neuralfitter.models import unet_param
+from decode.neuralfitter.utils import amp
 from decode.neuralfitter.utils import logger as logger_utils
+from decode.utils import timing
 
 
 class TestTrain:
@@ -55,6 +58,27 @@ class TestTrain:
 
         assert (param_before != param_after).any(), "No weights changed although they should have."
 
+    def test_timing(self, opt, loss, dataloader, logger, train_val_environment):
+        device, model, _ = train_val_environment
+        timer = timing.StageTimer()
+
+        train_val_impl.train(model, opt, loss, dataloader, False, True, 0, device, logger, timer=timer)
+
+        for stage in ('data', 'h2d', 'forward', 'loss', 'backward', 'clip', 'optimizer'):
+            assert len(timer.durations[stage]) == len(dataloader)
+
+    @pytest.mark.skipif(not hasattr(torch, 'autocast') and not torch.cuda.is_available(),
+                        reason="Mixed precision on CPU requires torch >= 1.10.")
+    def test_iterate_batch_mixed_precision(self, opt, loss, dataloader, logger, train_val_environment):
+        device, model, param_before = train_val_environment
+
+        train_val_impl.train(model, opt, loss, dataloader, False, True, 0, device, logger,
+                             mixed_precision=True, grad_scaler=amp.grad_scaler(device))
+        param_after = model.encoder[0][0].weight.data.clone()
+
+        assert param_after.dtype == torch.float32, "Master weights must stay in float32."
+        assert (param_before != param_after).any(), "No weights changed although they should have."
+
 
 class TestVal(TestTrain):
 
@@ -72,3 +96,90 @@ class TestVal(TestTrain):
 
         """Assert"""
         assert (param_before == param_after).all(), "Weights must not change."
+
+
+class TestMixedPrecision:
+
+    @pytest.mark.skipif(not hasattr(torch, 'autocast'), reason="Mixed precision on CPU requires torch >= 1.10.")
+    def test_sigma_munet_gmm_loss_mixed_precision(self):
+        model = models.SigmaMUNet(3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8)
+        loss_impl = loss.GaussianMMLoss(xextent=(-0.5, 31.5), yextent=(-0.5, 31.5), img_shape=(32, 32),
+                                        device='cpu')
+
+        tar_param = torch.rand(2, 5, 4) * 30
+        tar_mask = torch.ones(2, 5).long()
+        tar_bg = torch.rand(2, 32, 32)
+
+        with amp.autocast('cpu'):
+            out = model(torch.rand(2, 3, 32, 32))
+            loss_val = loss_impl(out, (tar_param, tar_mask, tar_bg), None)
+
+        assert out.dtype == torch.float32
+        assert (out[:, model.pxyz_sig_ch_ix] >= model.sigma_eps).all()
+        assert loss_val.dtype == torch.float32
+        assert torch.isfinite(loss_val).all()
+
+    def test_sigma_munet_full_precision(self):
+        """Only reduced precision outputs are cast to float32"""
+        model = models.SigmaMUNet(3, depth_shared=1, depth_union=1, initial_features=8, inter_features=8).double()
+
+        for heads_fused in (None, model.fuse_heads()):
+            assert model(torch.rand(2, 3, 32, 32, dtype=torch.float64), heads_fused=heads_fused).dtype == torch.float64
+
+    def test_amp_disabled(self):
+        assert amp.grad_scaler('cpu') is None
+        assert amp.grad_scaler('cuda', enabled=False) is None
+
+        with amp.autocast('cpu', enabled=False):
+            assert torch.rand(2, 2).matmul(torch.rand(2, 2)).dtype == torch.float32
+
+
+class TestGradRescale:
+
+    @pytest.fixture()
+    def model(self):
+        torch.manual_seed(0)
+        return models.model_param.DoubleMUnet(ch_in=1, ch_out=6, depth_shared=1, depth_union=1, initial_features=8,
+                                              inter_features=8, pool_mode='StrideConv')
+
+    @pytest.fixture()
+    def data(self):
+        return torch.rand(4, 1, 16, 16), torch.rand(4, 6, 16, 16), torch.rand(4, 6, 16, 16)
+
+    def test_single_backward(self, model, data):
+        """Gradients must be the same as with one extra backward per head."""
+        x, y_tar, weight = data
+        crit = loss.PPXYZBLoss(torch.device('cpu'))
+        opt = torch.optim.SGD(model.parameters(), lr=1.)
+
+        """Reference"""
+        loss_val = crit(model(x), y_tar, weight)
+        w_ref, _, _ = model.rescale_last_layer_grad(loss_val, opt)
+        (loss_val * w_ref).mean().backward()
+        grad_ref = [p.grad.clone() for p in model.parameters()]
+
+        """Single backward"""
+        opt.zero_grad()
+        rescale = model.last_layer_grad_rescale()
+        with rescale.capture():
+            loss_val = crit(model(x), y_tar, weight)
+        loss_val.mean().backward()
+        w = rescale.apply(model.parameters())
+
+        torch.testing.assert_allclose(w, w_ref)
+        for g, g_ref in zip([p.grad for p in model.parameters()], grad_ref):
+            torch.testing.assert_allclose(g, g_ref, rtol=1e-4, atol=1e-7)
+
+    def test_apply_without_backward(self, model):
+        with pytest.raises(RuntimeError):
+            model.last_layer_grad_rescale().apply(model.parameters())
+
+    def test_train(self, model, data):
+        dl = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(*data), batch_size=2)
+        param_before = [p.detach().clone() for p in model.parameters()]
+
+        train_val_impl.train(model, torch.optim.Adam(model.parameters()), loss.PPXYZBLoss(torch.device('cpu')), dl,
+                             grad_rescale=True, grad_mod=False, epoch=0, device=torch.device('cpu'),
+                             logger=logger_utils.NoLog())
+
+        assert any((p != p_before).any() for p, p_before in zip(model.parameters(), param_before))
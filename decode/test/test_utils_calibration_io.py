@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import scipy.io as sio
+import torch
+
+from decode.utils import calibration_io
+
+
+class TestSMAPSplineCoefficient:
+
+    @pytest.fixture()
+    def calib_file(self, tmpdir):
+        """Write a minimal SMAP-like calibration file."""
+        path = tmpdir / 'calib.mat'
+        cspline = {'coeff': np.random.rand(5, 5, 4, 64).astype('float32'), 'x0': 3., 'z0': 2., 'dz': 10.}
+        sio.savemat(str(path), {'SXY': {'cspline': cspline}})
+
+        calibration_io._load_spline_coeff.cache_clear()
+        return path
+
+    @pytest.mark.parametrize("cache", [True, False])
+    def test_load(self, calib_file, cache):
+        smap = calibration_io.SMAPSplineCoefficient(str(calib_file), cache=cache)
+
+        assert smap.coeff.size() == torch.Size((5, 5, 4, 64))
+        assert smap.ref0 == (2., 2., 2.)
+        assert smap.dz == 10.
+        assert smap.calib_mat.cspline.dz == 10.
+
+        cache_files = list(calib_file.dirpath().listdir(fil=lambda p: p.basename.endswith('.coeff.npy')))
+        assert len(cache_files) == (1 if cache else 0)
+
+    def test_load_cached(self, calib_file):
+        smap = calibration_io.SMAPSplineCoefficient(str(calib_file))
+
+        # drop in-process cache such that the disk cache is used
+        calibration_io._load_spline_coeff.cache_clear()
+        smap_re = calibration_io.SMAPSplineCoefficient(str(calib_file))
+
+        np.testing.assert_array_equal(smap.coeff.numpy(), smap_re.coeff.numpy())
+        assert smap.ref0 == smap_re.ref0
+        assert smap.dz == smap_re.dz
+
+    @pytest.mark.parametrize("cache", [True, False])
+    def test_modify_coeff(self, calib_file, cache):
+        """Coefficients are shared with the cache (no copy per instance), replacing them must not reach it."""
+        smap = calibration_io.SMAPSplineCoefficient(str(calib_file), cache=cache)
+        ref = smap.coeff.clone()
+
+        smap_re = calibration_io.SMAPSplineCoefficient(str(calib_file), cache=cache)
+        assert np.shares_memory(smap.coeff.numpy(), smap_re.coeff.numpy())
+
+        smap.coeff = smap.coeff / 2.
+        smap_re = calibration_io.SMAPSplineCoefficient(str(calib_file), cache=cache)
+
+        assert (smap_re.coeff == ref).all()
+
+    def test_cache_invalidation(self, calib_file):
+        _ = calibration_io.SMAPSplineCoefficient(str(calib_file))
+
+        """Overwrite calibration with different content"""
+        cspline = {'coeff': np.zeros((5, 5, 4, 64), dtype='float32'), 'x0': 4., 'z0': 2., 'dz': 20.}
+        sio.savemat(str(calib_file), {'SXY': {'cspline': cspline}})
+
+        smap = calibration_io.SMAPSplineCoefficient(str(calib_file))
+
+        assert (smap.coeff == 0.).all()
+        assert smap.ref0 == (3., 3., 2.)
+        assert smap.dz == 20.
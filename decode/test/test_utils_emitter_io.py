@@ -54,3 +54,41 @@ def test_streamer(last_index, tmpdir):
         stream(emitter.RandomEmitterSet(20), 0, 100)
 
     mock_save.assert_called_once()
+
+
+@pytest.mark.parametrize('sink', ['memory', 'h5', 'csv'])
+def test_sink(sink, em_rand, em_all_attrs, tmpdir):
+    em_empty = emitter.EmptyEmitterSet(xy_unit='px', px_size=(100, 200))
+    batches = [em_rand, em_empty, em_rand.clone()]
+    em = emitter.EmitterSet.cat(batches)
+
+    if sink == 'memory':
+        with emitter_io.MemorySink() as s:
+            for b in batches:
+                s.write(b)
+        assert s.emitters == em
+
+    elif sink == 'h5':
+        for batches in (batches, [em_all_attrs, em_all_attrs]):
+            with emitter_io.H5Sink(tmpdir / 'emitter.h5') as s:
+                for b in batches:
+                    s.write(b)
+            assert emitter.EmitterSet.load(tmpdir / 'emitter.h5') == emitter.EmitterSet.cat(batches)
+
+    elif sink == 'csv':
+        with emitter_io.CSVSink(tmpdir / 'emitter.csv') as s:
+            for b in batches:
+                s.write(b)
+        data, _, _ = emitter_io.load_csv(tmpdir / 'emitter.csv', comment='#')
+
+        torch.testing.assert_close(data['xyz'], em.xyz)
+        assert (data['frame_ix'] == em.frame_ix).all()
+
+
+@pytest.mark.parametrize('meta', [{}, {'xy_unit': 'px', 'px_size': (100., 200.)}])
+def test_h5_sink_empty(meta, tmpdir):
+    """A sink closed without any batch must give a loadable empty emitter set."""
+    with emitter_io.H5Sink(tmpdir / 'emitter.h5', **meta):
+        pass
+
+    assert emitter.EmitterSet.load(tmpdir / 'emitter.h5') == emitter.EmptyEmitterSet(**meta)
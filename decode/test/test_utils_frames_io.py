@@ -61,3 +61,25 @@ def test_tiff_tensor(tmpdir):
 
     assert len(torch.Tensor(n).unique()) >= 5  # kind of stochastic, would fail for ultra slow write
     assert lengths[-1] == 1000
+
+
+def test_file_watcher(tmpdir):
+    fname = tmpdir / 'growing.bin'
+    watcher = frames_io.FileWatcher(fname, interval=0.01)
+
+    assert not watcher.wait(0.1)  # file does not exist
+
+    def write():
+        time.sleep(0.2)
+        with open(fname, 'ab') as f:
+            f.write(b'0' * 100)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+
+    t0 = time.monotonic()
+    assert watcher.wait(10.)
+    assert time.monotonic() - t0 < 5.  # woke on the write, not on the timeout
+    thread.join()
+
+    assert not watcher.wait(0.1)  # no change since last call
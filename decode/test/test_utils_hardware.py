@@ -34,3 +34,45 @@ def test_get_max_batch_size(size_low, size_high, expct):
         with pytest.raises(RuntimeError) as err:
             hardware.get_max_batch_size(dummy, x_size, 'cuda:0', size_low, size_high)
         assert "Lowest possible batch size is outside of provided bounds." == str(err.value)
+
+
+def test_available_memory():
+    assert 0 < hardware.available_memory()
+
+
+@pytest.mark.skipif(not hardware.Path('/proc/self/clear_refs').exists(), reason="Only works on Linux.")
+def test_peak_memory():
+    def dummy(x):
+        return (x ** 2 + 2 * x).sum()
+
+    mem = hardware.peak_memory(dummy, torch.rand(64, 512, 512))
+    assert 64 * 512 * 512 * 4 <= mem < 10 * 64 * 512 * 512 * 4
+
+
+@pytest.mark.skipif(not hardware.Path('/proc/self/clear_refs').exists(), reason="Only works on Linux.")
+@pytest.mark.parametrize("available,expct", [(2 ** 28, 256), (2 ** 40, 512), (2 ** 10, 'err')])
+def test_get_max_batch_size_cpu(available, expct):
+    def dummy(x):
+        return (x ** 2 + 2 * x).sum()
+
+    with patch.object(hardware, 'available_memory', return_value=available):
+        if expct == 'err':
+            with pytest.raises(RuntimeError):
+                hardware.get_max_batch_size_cpu(dummy, (256, 256), 1, 512)
+            return
+
+        bs = hardware.get_max_batch_size_cpu(dummy, (256, 256), 1, 512)
+
+    if expct == 512:
+        assert bs == 512
+    else:
+        # about 2 frames of 256 kB alive per sample
+        assert expct / 4 <= bs <= 4 * expct
+
+
+def test_get_fastest_batch_size():
+    def dummy(x):
+        return x ** 2
+
+    bs = hardware.get_fastest_batch_size(dummy, (32, 32), 'cpu', 12, n_samples=24)
+    assert bs in (1, 2, 4, 8, 12)
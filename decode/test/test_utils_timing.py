@@ -0,0 +1,69 @@
+import json
+import time
+
+import pytest
+
+from decode.neuralfitter.utils import logger as logger_utils
+from decode.neuralfitter.utils import log_train_val_progress
+from decode.utils import timing
+
+
+class TestStageTimer:
+
+    @pytest.fixture()
+    def timer(self):
+        return timing.StageTimer(trace=True)
+
+    def test_stage(self, timer):
+        for _ in range(5):
+            with timer.stage('a'):
+                time.sleep(0.01)
+            with timer.stage('b'):
+                pass
+
+        assert len(timer.durations['a']) == 5
+        assert len(timer.durations['b']) == 5
+        assert min(timer.durations['a']) >= 0.01
+
+        pct = timer.percentiles()
+        assert pct['a/p50'] >= 0.01
+        assert pct['a/p50'] <= pct['a/p90'] <= pct['a/p99'] <= pct['a/total']
+        assert pct['b/p50'] < pct['a/p50']
+
+        timer.reset()
+        assert timer.percentiles() == {}
+
+    def test_stage_exception(self, timer):
+        """Stage is recorded even if the wrapped code raises."""
+        with pytest.raises(ValueError):
+            with timer.stage('a'):
+                raise ValueError
+
+        assert len(timer.durations['a']) == 1
+
+    def test_chrome_trace(self, timer, tmpdir):
+        t0 = time.perf_counter()
+        timer.record('data', t0, t0 + 0.5)
+        with timer.stage('forward'):
+            pass
+
+        timer.dump_chrome_trace(tmpdir / 'trace.json')
+        trace = json.loads((tmpdir / 'trace.json').read_text('utf-8'))
+
+        assert [e['name'] for e in trace['traceEvents']] == ['data', 'forward']
+        assert trace['traceEvents'][0]['dur'] == pytest.approx(0.5e6)
+        assert all(e['ph'] == 'X' for e in trace['traceEvents'])
+
+    def test_chrome_trace_disabled(self, tmpdir):
+        with pytest.raises(ValueError):
+            timing.StageTimer().dump_chrome_trace(tmpdir / 'trace.json')
+
+    def test_log(self, timer):
+        with timer.stage('forward'):
+            pass
+
+        logger = logger_utils.DictLogger()
+        log_train_val_progress.log_timing(timer, logger=logger, step=3)
+
+        assert {'timing/forward/p50', 'timing/forward/p90', 'timing/forward/total'} <= set(logger.log_dict.keys())
+        assert logger.log_dict['timing/forward/p50']['step'] == [3]
@@ -1,11 +1,7 @@
-from . import bookkeeping
-from . import calibration_io
-from . import checkpoint
-from . import emitter_io
-from . import emitter_trafo
-from . import example_helper
-from . import frames_io
-from . import hardware
-from . import model_io
-from . import param_io
-from . import types
+from .lazy import lazy_package
+
+__getattr__, __dir__ = lazy_package(
+    __name__,
+    submodules=['bookkeeping', 'calibration_io', 'checkpoint', 'deprecate_warning', 'emitter_io', 'emitter_trafo',
+                'example_helper', 'frames_io', 'hardware', 'loader', 'model_io', 'notebooks', 'param_io', 'timing',
+                'types'])
@@ -1,25 +1,145 @@
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import warnings
+from typing import Tuple, Union
+
+import numpy as np
 import scipy.io as sio
 import torch
 
 import decode.simulation.psf_kernel as psf_kernel
 
 
+def hash_calibration(calib_file: Union[str, pathlib.Path]) -> str:
+    """
+    SHA-256 hash of the calibration file's content.
+
+    Args:
+        calib_file: path to calibration file
+
+    """
+    hasher = hashlib.sha256()
+    with open(calib_file, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+def _cache_paths(calib_file: pathlib.Path, hashv: str) -> Tuple[pathlib.Path, pathlib.Path]:
+    """Paths of the (coefficient, meta) cache files which live next to the calibration."""
+    stem = calib_file.parent / f".{calib_file.name}.{hashv[:16]}"
+    return stem.with_name(stem.name + '.coeff.npy'), stem.with_name(stem.name + '.meta.json')
+
+
+def _load_disk_cache(calib_file: pathlib.Path, hashv: str):
+    coeff_path, meta_path = _cache_paths(calib_file, hashv)
+    if not (coeff_path.exists() and meta_path.exists()):
+        return None
+
+    try:
+        meta = json.loads(meta_path.read_text())
+        if meta['hash'] != hashv:
+            return None
+        # copy-on-write memory map, i.e. pages are shared between processes until someone writes to them
+        coeff = np.load(coeff_path, mmap_mode='c')
+
+    except (OSError, ValueError, KeyError):  # corrupt or concurrently deleted cache, fall back to parsing
+        return None
+
+    return coeff, meta['x0'], meta['z0'], meta['dz']
+
+
+def _write_disk_cache(calib_file: pathlib.Path, hashv: str, coeff: np.ndarray, x0: float, z0: float, dz: float):
+    """Write cache files via temporary file and rename, so that concurrent readers never see partial files."""
+    coeff_path, meta_path = _cache_paths(calib_file, hashv)
+    meta = {'hash': hashv, 'x0': x0, 'z0': z0, 'dz': dz}
+
+    try:
+        coeff_tmp = coeff_path.with_name(coeff_path.name + f'.{os.getpid()}.tmp')
+        meta_tmp = meta_path.with_name(meta_path.name + f'.{os.getpid()}.tmp')
+
+        with coeff_tmp.open('wb') as f:
+            np.save(f, np.ascontiguousarray(coeff))
+        meta_tmp.write_text(json.dumps(meta))
+
+        os.replace(coeff_tmp, coeff_path)
+        os.replace(meta_tmp, meta_path)  # meta last, because its presence marks the cache as complete
+
+    except OSError as err:  # e.g. read-only calibration folder
+        warnings.warn(f"Could not write calibration cache next to {calib_file} ({err}). "
+                      f"Will parse the calibration file every time.")
+
+
+@functools.lru_cache(maxsize=8)
+def _load_spline_coeff(calib_file: str, mtime_ns: int, size: int, disk_cache: bool) -> tuple:
+    """
+    Loads spline coefficients and meta information of a SMAP calibration. Results are cached in-process (keyed by
+    path, modification time and file size) and optionally on disk next to the calibration (keyed by content hash).
+    Modification time and size are only part of the signature to invalidate the in-process cache.
+
+    Returns:
+        coeff (np.ndarray, read-only since it is shared between calls), x0, z0, dz
+
+    """
+    calib_file = pathlib.Path(calib_file)
+
+    hashv = hash_calibration(calib_file) if disk_cache else None
+    if disk_cache:
+        cached = _load_disk_cache(calib_file, hashv)
+        if cached is not None:
+            cached[0].setflags(write=False)  # shared by all callers
+            return cached
+
+    calib_mat = sio.loadmat(str(calib_file), struct_as_record=False, squeeze_me=True)['SXY']
+    coeff = calib_mat.cspline.coeff
+    x0, z0, dz = float(calib_mat.cspline.x0), float(calib_mat.cspline.z0), float(calib_mat.cspline.dz)
+
+    if disk_cache:
+        _write_disk_cache(calib_file, hashv, coeff, x0, z0, dz)
+
+    coeff.setflags(write=False)  # shared by all callers
+    return coeff, x0, z0, dz
+
+
 class SMAPSplineCoefficient:
     """Wrapper class as an interface for MATLAB Spline calibration data."""
-    def __init__(self, calib_file):
+    def __init__(self, calib_file, cache: bool = True):
         """
         Loads a calibration file from SMAP and the relevant meta information
+
         Args:
-            file:
+            calib_file: path to calibration file
+            cache: cache the parsed coefficients next to the calibration file (memory-mappable .npy, keyed by the
+                content hash of the calibration) and reuse them in subsequent calls / processes
+
         """
         self.calib_file = calib_file
-        self.calib_mat = sio.loadmat(self.calib_file, struct_as_record=False, squeeze_me=True)['SXY']
+        self._calib_mat = None
+
+        calib_path = pathlib.Path(calib_file).resolve()
+        stat = calib_path.stat()
+        coeff, x0, z0, dz = _load_spline_coeff(str(calib_path), stat.st_mtime_ns, stat.st_size, cache)
 
-        self.coeff = torch.from_numpy(self.calib_mat.cspline.coeff)
-        self.ref0 = (self.calib_mat.cspline.x0 - 1, self.calib_mat.cspline.x0 - 1, self.calib_mat.cspline.z0)
-        self.dz = self.calib_mat.cspline.dz
+        # shares memory with the cache, i.e. read-only: replace instead of modifying it in place
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            self.coeff = torch.from_numpy(coeff)
+        self.ref0 = (x0 - 1, x0 - 1, z0)
+        self.dz = dz
         self.spline_roi_shape = self.coeff.shape[:3]
 
+    @property
+    def calib_mat(self):
+        """The raw calibration struct. Parsed on first access only, since not needed for the spline itself."""
+        if self._calib_mat is None:
+            self._calib_mat = sio.loadmat(self.calib_file, struct_as_record=False, squeeze_me=True)['SXY']
+
+        return self._calib_mat
+
     def init_spline(self, xextent, yextent, img_shape, device='cuda:0' if torch.cuda.is_available() else 'cpu', **kwargs):
         """
         Initializes the CubicSpline function
@@ -36,4 +156,4 @@ class SMAPSplineCoefficient:
         psf = psf_kernel.CubicSplinePSF(xextent=xextent, yextent=yextent, img_shape=img_shape, ref0=self.ref0,
                                         coeff=self.coeff, vx_size=(1., 1., self.dz), device=device, **kwargs)
 
-        return psf
\ No newline at end of file
+        return psf
@@ -1,11 +1,149 @@
+import copy
+import os
+import random
+import shutil
+import threading
 from pathlib import Path
-from typing import Union, Optional
+from typing import Union, Optional, Callable, Dict
 
+import numpy as np
 import torch
 
 
+def state_to_cpu(x):
+    """
+    Snapshot of (nested) state, e.g. state dicts. Tensors are copied to host memory, everything else is deep-copied,
+    so that the snapshot is unaffected by subsequent (in-place) updates of the original.
+
+    Args:
+        x: tensor, dict, list or tuple thereof, or any deep-copyable object
+
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to('cpu', copy=True)
+
+    elif isinstance(x, dict):
+        return type(x)((k, state_to_cpu(v)) for k, v in x.items())
+
+    elif isinstance(x, (list, tuple)):
+        return type(x)(state_to_cpu(v) for v in x)
+
+    return copy.deepcopy(x)
+
+
+def get_rng_state() -> dict:
+    """State of the python, numpy and torch (incl. cuda) random number generators."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+
+    return {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),  # no np array
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state: dict):
+    """Restores the random number generators from get_rng_state."""
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+
+    random.setstate(state['python'])
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path: Union[str, Path], pre_replace: Optional[Callable] = None):
+    """
+    Saves via torch.save to a temporary file in the target folder and renames it to the final path afterwards, so
+    that the file at path is either the previous or the new version but never a partially written one.
+
+    Args:
+        obj: object to save
+        path: final path
+        pre_replace: called after the temporary file is written but before it is moved to path
+
+    """
+    path = Path(path)
+    path_tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    try:
+        torch.save(obj, path_tmp)
+        if pre_replace is not None:
+            pre_replace()
+        os.replace(path_tmp, path)
+
+    finally:
+        if path_tmp.exists():
+            path_tmp.unlink()
+
+
+class AsyncWriter:
+    def __init__(self):
+        """
+        Writes to file in a background thread, one write at a time. A write submitted while another one is in flight is
+        queued and run right after it, where only the most recent one is kept (i.e. a queued write which is superseded
+        before it started is dropped). Errors of the background thread are raised on the next call.
+
+        """
+        self._thread = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._pending = None  # queued fn and args
+        self._err = None
+
+    @property
+    def busy(self) -> bool:
+        return self._running
+
+    def _raise_err(self):
+        if self._err is not None:
+            err, self._err = self._err, None
+            raise RuntimeError("Background write failed.") from err
+
+    def _run(self, fn: Callable, args):
+        while True:
+            try:
+                fn(*args)
+            except Exception as err:
+                self._err = err
+
+            with self._lock:
+                if self._pending is None:
+                    self._running = False
+                    return
+                (fn, args), self._pending = self._pending, None
+
+    def submit(self, fn: Callable, *args) -> bool:
+        """
+        Run fn(*args) in the background thread, after the write in flight (if any).
+
+        Returns:
+            bool: whether the write started right away, false if it was queued (replacing a queued one)
+
+        """
+        self._raise_err()
+        with self._lock:
+            if self._running:
+                self._pending = (fn, args)
+                return False
+            self._running = True
+
+        # not daemonic, so that the interpreter waits for the last write before exiting
+        self._thread = threading.Thread(target=self._run, args=(fn, args), daemon=False)
+        self._thread.start()
+        return True
+
+    def wait(self):
+        """Block until the write in flight and the queued one (if any) are done."""
+        if self._thread is not None:
+            self._thread.join()
+        self._raise_err()
+
+
 class CheckPoint:
-    def __init__(self, path: Union[str, Path]):
+    def __init__(self, path: Union[str, Path], asynchronous: bool = False, keep_last: int = 1):
         """
         Checkpointing intended to resume to an already started training.
         Warning:
@@ -14,15 +152,26 @@ class CheckPoint:
 
         Args:
             path: filename / path where to dump the checkpoints
+            asynchronous: snapshot the states to host memory and write to file in a background thread. A dump while
+                the previous one is still being written is written after it, unless it is superseded by the next dump
+                before (see AsyncWriter).
+            keep_last: number of checkpoints to keep. The most recent one is always at path, older ones are renamed
+                to path with a running index appended (ckpt_1.pt being the second most recent)
 
         """
         self.path = path
+        self.asynchronous = asynchronous
+        self.keep_last = keep_last
 
         self.model_state = None
         self.optimizer_state = None
         self.lr_sched_state = None
         self.step = None
         self.log = None
+        self.rng_state = None
+        self.grad_scaler_state = None
+
+        self._writer = None  # lazily init, only needed for async
 
     @property
     def dict(self):
@@ -31,18 +180,66 @@ class CheckPoint:
             'model_state': self.model_state,
             'optimizer_state': self.optimizer_state,
             'lr_sched_state': self.lr_sched_state,
-            'log': self.log
+            'log': self.log,
+            'rng_state': self.rng_state,
+            'grad_scaler_state': self.grad_scaler_state
         }
 
-    def update(self, model_state: dict, optimizer_state: dict, lr_sched_state: dict, step: int, log=None):
+    def update(self, model_state: dict, optimizer_state: dict, lr_sched_state: dict, step: int, log=None,
+               rng_state: Optional[Dict] = None, grad_scaler_state: Optional[Dict] = None):
         self.model_state = model_state
         self.optimizer_state = optimizer_state
         self.lr_sched_state = lr_sched_state
         self.step = step
         self.log = log
+        self.rng_state = rng_state
+        self.grad_scaler_state = grad_scaler_state
+
+    def _rotate(self):
+        """Shift previous checkpoints (ckpt.pt -> ckpt_1.pt -> ckpt_2.pt ...) and drop those exceeding keep_last."""
+        path = Path(self.path)
+        if self.keep_last <= 1 or not path.exists():
+            return
+
+        def path_old(i):
+            return path.with_name(f"{path.stem}_{i}{path.suffix}")
+
+        for i in range(self.keep_last - 2, 0, -1):
+            if path_old(i).exists():
+                os.replace(path_old(i), path_old(i + 1))
+
+        # link (or copy) instead of move, such that path exists until it is replaced by the new checkpoint
+        path_tmp = path.with_name(f".{path_old(1).name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.link(path, path_tmp)
+        except OSError:  # file system without hard links
+            shutil.copy2(path, path_tmp)
+        os.replace(path_tmp, path_old(1))
+
+    def _write(self, ckpt_dict: dict):
+        atomic_save(ckpt_dict, self.path, pre_replace=self._rotate)
+
+    def save(self) -> bool:
+        """
+        Saves to file (in the background if asynchronous).
+
+        Returns:
+            bool: false if the write was queued because the previous one is still in flight
+
+        """
+        if not self.asynchronous:
+            self._write(self.dict)
+            return True
+
+        if self._writer is None:
+            self._writer = AsyncWriter()
+
+        return self._writer.submit(self._write, state_to_cpu(self.dict))
 
-    def save(self):
-        torch.save(self.dict, self.path)
+    def wait(self):
+        """Wait for the background writes (in flight and queued) to finish."""
+        if self._writer is not None:
+            self._writer.wait()
 
     @classmethod
     def load(cls, path: Union[str, Path], path_out: Optional[Union[str, Path]] = None):
@@ -53,11 +250,13 @@ class CheckPoint:
         ckpt = cls(path=path_out)
         ckpt.update(model_state=ckpt_dict['model_state'], optimizer_state=ckpt_dict['optimizer_state'],
                     lr_sched_state=ckpt_dict['lr_sched_state'], step=ckpt_dict['step'],
-                    log=ckpt_dict['log'] if 'log' in ckpt_dict.keys() else None)
+                    log=ckpt_dict.get('log'), rng_state=ckpt_dict.get('rng_state'),
+                    grad_scaler_state=ckpt_dict.get('grad_scaler_state'))
 
         return ckpt
 
-    def dump(self, model_state: dict, optimizer_state: dict, lr_sched_state: dict, step: int, log=None):
+    def dump(self, model_state: dict, optimizer_state: dict, lr_sched_state: dict, step: int, log=None,
+             rng_state: Optional[Dict] = None, grad_scaler_state: Optional[Dict] = None) -> bool:
         """Updates and saves to file."""
-        self.update(model_state, optimizer_state, lr_sched_state, step, log)
-        self.save()
+        self.update(model_state, optimizer_state, lr_sched_state, step, log, rng_state, grad_scaler_state)
+        return self.save()
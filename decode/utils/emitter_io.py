@@ -1,13 +1,14 @@
 import copy
 import pathlib
-from typing import Union, Tuple
+from abc import ABC, abstractmethod
+from typing import Optional, Union, Tuple
 
 import h5py
 import numpy as np
 import pandas as pd
 import torch
 
-from decode.generic.emitter import EmitterSet
+from decode.generic.emitter import EmitterSet, EmptyEmitterSet
 from decode.utils import bookkeeping
 
 challenge_mapping = {'x': 'xnano',
@@ -60,37 +61,27 @@ def load_csv(file: (str, pathlib.Path), mapping: (None, dict) = None, **pd_csv_a
     return {'xyz': xyz, 'phot': phot, 'frame_ix': frame_ix, 'id': identifier}, None, None
 
 
-def save_csv(file: (str, pathlib.Path), data: dict) -> None:
-    def convert_dict_torch_numpy(data: dict) -> dict:
-        """Convert all torch tensors in dict to numpy."""
-        for k, v in data.items():
-            if isinstance(v, torch.Tensor):
-                data[k] = v.numpy()
-        return data
-
-    def change_to_one_dim(data: dict) -> dict:
-        """
-        Change xyz tensors to be one-dimensional.
+def _csv_columns(data: dict) -> dict:
+    """Emitter dictionary (without px_size) to one dimensional numpy columns as written to csv."""
+    data = {k: v.numpy() if isinstance(v, torch.Tensor) else v for k, v in data.items()}
 
-        Args:
-            data: emitterset as dictionary
+    xyz = data.pop('xyz')
+    xyz_cr = data.pop('xyz_cr')
+    xyz_sig = data.pop('xyz_sig')
 
-        """
-        xyz = data.pop('xyz')
-        xyz_cr = data.pop('xyz_cr')
-        xyz_sig = data.pop('xyz_sig')
+    data_one_dim = {'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]}
+    data_one_dim.update(data)
+    data_one_dim.update({'x_cr': xyz_cr[:, 0], 'y_cr': xyz_cr[:, 1], 'z_cr': xyz_cr[:, 2]})
+    data_one_dim.update({'x_sig': xyz_sig[:, 0], 'y_sig': xyz_sig[:, 1], 'z_sig': xyz_sig[:, 2]})
 
-        data_one_dim = {'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2]}
-        data_one_dim.update(data)
-        data_one_dim.update({'x_cr': xyz_cr[:, 0], 'y_cr': xyz_cr[:, 1], 'z_cr': xyz_cr[:, 2]})
-        data_one_dim.update({'x_sig': xyz_sig[:, 0], 'y_sig': xyz_sig[:, 1], 'z_sig': xyz_sig[:, 2]})
+    return data_one_dim
 
-        return data_one_dim
 
+def save_csv(file: (str, pathlib.Path), data: dict) -> None:
     """Change torch to numpy and convert 2D elements to 1D"""
     data = copy.deepcopy(data)
     data.pop('px_size')
-    data = change_to_one_dim(convert_dict_torch_numpy(data))
+    data = _csv_columns(data)
 
     # create file and add metadata to it
     with pathlib.Path(file).open('w+') as f:
@@ -236,3 +227,115 @@ class EmitterWriteStream:
 
         fname = self._path / (self._name + ix + self._suffix)
         em.save(fname)
+
+
+class EmitterSink(ABC):
+    """
+    Destination of localizations which arrive in batches, e.g. from Infer.forward_to. Closes on exit when used as
+    context manager.
+    """
+
+    @abstractmethod
+    def write(self, em: EmitterSet):
+        """Write a batch of emitters."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MemorySink(EmitterSink):
+    def __init__(self):
+        """Keeps the batches in memory."""
+        self._em = []
+
+    def write(self, em: EmitterSet):
+        self._em.append(em)
+
+    @property
+    def emitters(self) -> EmitterSet:
+        """All emitters written so far"""
+        return EmitterSet.cat(self._em)
+
+
+class H5Sink(EmitterSink):
+    _volatile = ('xyz_sig', 'xyz_cr', 'phot_cr', 'phot_sig', 'bg_cr', 'bg_sig')  # empty datasets if all nan
+
+    def __init__(self, path: Union[str, pathlib.Path], xy_unit: Optional[str] = None, px_size=None):
+        """
+        Appends the batches to resizable datasets of an hdf5 file in the layout of save_h5, i.e. the file can be
+        loaded by load_h5 / EmitterSet.load once closed. The metadata is taken from the first batch.
+
+        Args:
+            path: output file (overwritten)
+            xy_unit: xy unit of the file if closed without any batch written
+            px_size: pixel size of the file if closed without any batch written
+        """
+        self._f = h5py.File(path, 'w')
+        self._f.create_group('decode').attrs.update(get_decode_meta())
+        self._g = self._f.create_group('data')
+
+        self._meta_empty = {'xy_unit': xy_unit, 'px_size': px_size}
+        self._finite = {k: False for k in self._volatile}
+
+    def write(self, em: EmitterSet):
+        if 'meta' not in self._f:
+            if any(v is None for v in em.meta.values()):
+                raise ValueError(f"Cannot save to hdf5 because encountered None in one of {em.meta.keys()}")
+            self._f.create_group('meta').attrs.update(em.meta)
+
+        for k, v in em.data.items():
+            v = v.numpy()
+
+            if k not in self._g:
+                self._g.create_dataset(k, data=v, maxshape=(None, *v.shape[1:]), chunks=True)
+            else:
+                d = self._g[k]
+                d.resize(len(d) + len(v), axis=0)
+                d[len(d) - len(v):] = v
+
+            if k in self._finite:
+                self._finite[k] |= bool(not np.isnan(v).all())
+
+    def close(self):
+        if not self._f:  # closed already
+            return
+
+        if 'meta' not in self._f:  # no batch written, still write an (empty) emitter set, None can not be stored
+            self._f.create_group('meta').attrs.update({k: v for k, v in self._meta_empty.items() if v is not None})
+            self.write(EmptyEmitterSet(**self._meta_empty))
+
+        for k, finite in self._finite.items():
+            if not finite and k in self._g:
+                del self._g[k]
+                self._g.create_dataset(k, data=h5py.Empty("f"))
+
+        self._f.close()
+
+
+class CSVSink(EmitterSink):
+    def __init__(self, path: Union[str, pathlib.Path]):
+        """
+        Appends the batches as rows to a csv file in the columns of save_csv (the first line is the decode version
+        as comment, i.e. load by load_csv(path, comment='#')).
+
+        Args:
+            path: output file (overwritten)
+        """
+        self._f = pathlib.Path(path).open('w')
+        self._f.write(f"# DECODE version: {bookkeeping.decode_state()}\n")
+        self._header = True
+
+    def write(self, em: EmitterSet):
+        df = pd.DataFrame.from_dict(_csv_columns({'xy_unit': em.xy_unit, **em.data}))
+        df.to_csv(self._f, header=self._header, index=False)
+        self._header = False
+
+    def close(self):
+        self._f.close()
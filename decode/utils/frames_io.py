@@ -1,3 +1,5 @@
+import os
+import time
 import warnings
 
 import torch
@@ -78,6 +80,10 @@ class TiffTensor:
 
         return torch.from_numpy(image).__getitem__(pos[1:])
 
+    @property
+    def file(self):
+        return self._file
+
     def __setitem(self, key, value):
         raise NotImplementedError
 
@@ -88,6 +94,61 @@ class TiffTensor:
         return n
 
 
+class FileWatcher:
+    def __init__(self, file: Union[str, pathlib.Path], interval: float = 0.05):
+        """
+        Stat based watcher of a file which is being written, e.g. the tiff of an ongoing acquisition. Cheap enough to
+        be polled at a high rate, such that a reader wakes up shortly after new data was written instead of sleeping
+        for a fixed time.
+
+        Args:
+            file: path to the file (does not need to exist yet)
+            interval: polling interval in s
+        """
+        self._file = file
+        self._interval = interval
+        self._state = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(str(self._file))
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Blocks until the file changed (since the last call or initialisation) and then stopped changing for one
+        polling interval (i.e. a write is likely completed, at most 10 intervals are waited for this), or until
+        timeout.
+
+        Args:
+            timeout: maximum waiting time in s
+
+        Returns:
+            whether the file changed
+        """
+        t_end = time.monotonic() + timeout
+
+        state = self._stat()
+        while state == self._state and time.monotonic() < t_end:
+            time.sleep(self._interval)
+            state = self._stat()
+
+        if state == self._state:
+            return False
+
+        for _ in range(10):  # until the write settled
+            time.sleep(self._interval)
+            state_new = self._stat()
+            if state_new == state:
+                break
+            state = state_new
+
+        self._state = state
+        return True
+
+
 class BatchFileLoader:
 
     def __init__(self, par_folder: Union[str, pathlib.Path],
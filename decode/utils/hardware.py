@@ -1,4 +1,10 @@
-from typing import Tuple, Union
+import ctypes
+import ctypes.util
+import os
+import time
+import warnings
+from pathlib import Path
+from typing import Tuple, Union, Callable, Optional
 
 import torch
 
@@ -8,6 +14,26 @@ def get_device_capability() -> str:
     return f'{capability[0]}.{capability[1]}'
 
 
+def check_device_capability(min_capability: float = 3.7):
+    """
+    Warns if the (current) CUDA device is too old. Does nothing if CUDA is not available.
+
+    Args:
+        min_capability: minimum supported cuda capability
+
+    """
+    if not torch.cuda.is_available():
+        return
+
+    device_capa = get_device_capability()
+    if float(device_capa) < min_capability:
+        warnings.warn(
+            f"Your GPU {torch.cuda.get_device_name()} has cuda capability {device_capa} and is no longer supported "
+            f"(minimum is {min_capability})."
+            f"\nIf you have multiple devices make sure to select the index of the most modern one."
+            f"\nOtherwise you can use your CPU to run DECODE or switch to Google Colab.", category=UserWarning)
+
+
 def get_max_batch_size(callable, x_size: Tuple, device: Union[str, torch.device], size_low: int, size_high: int):
     if size_low > size_high:
         raise ValueError("Lower bound must be lower than upper bound.")
@@ -42,3 +68,139 @@ def get_max_batch_size(callable, x_size: Tuple, device: Union[str, torch.device]
     del x_try
     torch.cuda.empty_cache()
     return bs
+
+
+def available_memory() -> int:
+    """
+    Available host memory in bytes, i.e. MemAvailable of the system limited by the memory limit of the cgroup (e.g.
+    of a container) if there is one.
+
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = {line.split(':')[0]: int(line.split()[1]) * 1024 for line in f}
+        avail = meminfo['MemAvailable']
+
+    except (OSError, KeyError):
+        avail = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+    """cgroup v2 and v1 limits"""
+    for limit_file, usage_file in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        try:
+            limit = Path(limit_file).read_text().strip()
+            usage = int(Path(usage_file).read_text())
+        except (OSError, ValueError):
+            continue
+
+        if limit.isdigit():
+            avail = min(avail, int(limit) - usage)
+        break
+
+    return max(avail, 0)
+
+
+def _rss() -> Tuple[int, int]:
+    """Current and peak (since the last reset) resident set size of this process in bytes (Linux)."""
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            k, v = line.split(':', 1)
+            status[k] = v
+
+    return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+
+
+def peak_memory(callable: Callable, x: torch.Tensor) -> int:
+    """
+    Peak host memory in bytes needed by callable(x), measured as the growth of the resident set size over the call.
+    Free heap memory is returned to the system beforehand (glibc), such that allocations of the call are not served
+    from memory that is already resident. Only supported on Linux.
+
+    Args:
+        callable: function to measure
+        x: input
+
+    """
+    if not Path('/proc/self/clear_refs').exists():
+        raise NotImplementedError("Measuring the peak memory is only supported on Linux.")
+
+    libc = ctypes.util.find_library('c')
+    if libc is not None and hasattr(ctypes.CDLL(libc), 'malloc_trim'):
+        ctypes.CDLL(libc).malloc_trim(0)
+
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')  # reset the peak to the current resident set size
+
+    rss, _ = _rss()
+    out = callable(x)
+    _, rss_peak = _rss()
+    del out
+
+    return rss_peak - rss
+
+
+def get_max_batch_size_cpu(callable: Callable, x_size: Tuple, size_low: int, size_high: int,
+                           memory_fraction: float = 0.5, probe: Tuple[int, int] = (2, 8)) -> int:
+    """
+    Maximum batch size on cpu such that callable fits in a fraction of the available memory. The peak memory is
+    measured for two (small) batch sizes and extrapolated linearly.
+
+    Args:
+        callable: function that is called on batches
+        x_size: size of a sample (without batch dimension)
+        size_low: lower batch size limit
+        size_high: upper batch size limit
+        memory_fraction: fraction of the available memory to be used
+        probe: batch sizes at which the memory is measured
+
+    """
+    if size_low > size_high:
+        raise ValueError("Lower bound must be lower than upper bound.")
+
+    callable(torch.rand(probe[0], *x_size))  # warm up, e.g. lazy initialisations
+
+    mem = [peak_memory(callable, torch.rand(bs, *x_size)) for bs in probe]
+    # the difference is noisy (page granularity, allocator), do not assume less than half of the mean per sample
+    per_sample = max((mem[1] - mem[0]) / (probe[1] - probe[0]), mem[1] / probe[1] / 2, 1)
+    offset = max(mem[1] - per_sample * probe[1], 0)
+
+    bs = int((memory_fraction * available_memory() - offset) / per_sample)
+    if bs < size_low:
+        raise RuntimeError("Lowest possible batch size is outside of provided bounds.")
+
+    return min(bs, size_high)
+
+
+def get_fastest_batch_size(callable: Callable, x_size: Tuple, device: Union[str, torch.device], size_high: int,
+                           n_samples: Optional[int] = None) -> int:
+    """
+    Batch size with the highest throughput among the powers of two up to size_high (and size_high).
+
+    Args:
+        callable: function that is called on batches
+        x_size: size of a sample (without batch dimension)
+        device: device of the input
+        size_high: largest batch size (e.g. the maximum that fits into memory)
+        n_samples: number of samples per batch size to measure with (default: twice size_high)
+
+    """
+    n_samples = n_samples if n_samples is not None else 2 * size_high
+    candidates = sorted({2 ** i for i in range(size_high.bit_length()) if 2 ** i <= size_high} | {size_high})
+
+    throughput = []
+    for bs in candidates:
+        x = torch.rand(bs, *x_size, device=device)
+        callable(x)  # warm up
+
+        n = max(n_samples // bs, 1)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            callable(x)
+        if 'cuda' in str(device):
+            torch.cuda.synchronize(device)
+
+        throughput.append(n * bs / (time.perf_counter() - t0))
+
+    return candidates[max(range(len(candidates)), key=throughput.__getitem__)]
@@ -0,0 +1,48 @@
+import importlib
+import sys
+from typing import Callable, Dict, Iterable, Tuple
+
+
+def lazy_package(package: str, submodules: Iterable[str], attributes: Dict[str, str] = None) -> Tuple[Callable, Callable]:
+    """
+    Defers the import of a package's submodules (and of attributes re-exported from them) to their first access
+    (PEP 562). Use in a package's __init__ as
+
+        __getattr__, __dir__ = lazy_package(__name__, ['submodule'], {'SomeClass': 'submodule'})
+
+    On Python < 3.7, which does not support module level __getattr__, everything is imported eagerly.
+
+    Args:
+        package: name of the package, i.e. __name__ of the calling __init__
+        submodules: submodules relative to package that are imported on access
+        attributes: attribute name to submodule (relative to package) from which the attribute is re-exported
+
+    Returns:
+        module level __getattr__ and __dir__
+
+    """
+    submodules = set(submodules)
+    attributes = attributes if attributes is not None else {}
+    mod = sys.modules[package]
+
+    def __getattr__(name: str):
+        if name in submodules:
+            return importlib.import_module(f"{package}.{name}")
+
+        if name in attributes:
+            attr = getattr(importlib.import_module(f"{package}.{attributes[name]}"), name)
+            setattr(mod, name, attr)  # cache, such that __getattr__ is not called again
+            return attr
+
+        raise AttributeError(f"module {package!r} has no attribute {name!r}")
+
+    def __dir__():
+        return sorted(set(mod.__dict__.keys()) | submodules | set(attributes.keys()))
+
+    if sys.version_info < (3, 7):
+        for s in sorted(submodules):
+            importlib.import_module(f"{package}.{s}")
+        for a in attributes:
+            __getattr__(a)
+
+    return __getattr__, __dir__
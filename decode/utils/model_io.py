@@ -1,11 +1,17 @@
+import copy
+import functools
 import hashlib
+import inspect
 import math
 import pathlib
 import time
+import zipfile
 from typing import Union
 
 import torch
 
+from .checkpoint import AsyncWriter, atomic_save, state_to_cpu
+
 
 def hash_model(modelfile):
     """
@@ -22,9 +28,81 @@ def hash_model(modelfile):
     return hasher.hexdigest()
 
 
+def _file_key(file: Union[str, pathlib.Path]) -> tuple:
+    """Identifies a file's version without reading it, i.e. by resolved path, modification time and size."""
+    file = pathlib.Path(file).resolve()
+    stat = file.stat()
+    return str(file), stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=64)
+def _hash_model_cached(file: str, mtime_ns: int, size: int) -> str:
+    return hash_model(file)
+
+
+def hash_model_cached(modelfile: Union[str, pathlib.Path]) -> str:
+    """
+    Same as hash_model but cached in-process by (path, modification time, size), i.e. files are only re-hashed when
+    they changed.
+    """
+    return _hash_model_cached(*_file_key(modelfile))
+
+
+def _torch_load_mmap_available() -> bool:
+    return 'mmap' in inspect.signature(torch.load).parameters
+
+
+@functools.lru_cache(maxsize=4)
+def _load_state_dict_cached(file: str, mtime_ns: int, size: int, mmap: bool) -> dict:
+    if mmap:
+        return torch.load(file, map_location='cpu', mmap=True)
+    return torch.load(file, map_location='cpu')
+
+
+def load_state_dict_cached(modelfile: Union[str, pathlib.Path], mmap: Union[bool, None] = None) -> dict:
+    """
+    Loads a state dict to host memory and caches it in-process by (path, modification time, size). The returned dict is
+    shared between calls, so copy it before modifying it in place.
+
+    Args:
+        modelfile: path to state dict
+        mmap: memory-map the weights instead of reading them (only for zip format files and pytorch versions that
+            support it). If None, mmap is used where available and falls back to reading for legacy format files.
+
+    """
+    mmap_available = _torch_load_mmap_available()
+    if mmap and not mmap_available:
+        raise ValueError(f"Memory mapping in torch.load is not supported by your pytorch version {torch.__version__}.")
+
+    key = _file_key(modelfile)
+    if mmap is None:
+        # legacy (non-zip) format can not be memory-mapped
+        mmap = mmap_available and zipfile.is_zipfile(key[0])
+
+    return _load_state_dict_cached(*key, bool(mmap))
+
+
 class LoadSaveModel:
     def __init__(self, model_instance, output_file: (str, pathlib.Path), input_file=None, name_time_interval=(60 * 60),
-                 better_th=1e-6, max_files=3, state_dict_update=None):
+                 better_th=1e-6, max_files=3, state_dict_update=None, asynchronous: bool = False, cache: bool = True):
+        """
+        Model loading and saving.
+
+        Args:
+            model_instance: model
+            output_file: path where to save the model (suffix is appended)
+            input_file: model file for warmstart
+            name_time_interval: time interval after which a new suffix is used
+            better_th: relative improvement of the metric needed to save
+            max_files: max number of suffixes before they are recycled
+            state_dict_update: dict with which the loaded state dict is updated
+            asynchronous: snapshot the state dict to host memory and write to file in a background thread. A save
+                while the previous one is still being written is written after it, unless it is superseded by the next
+                save before (see AsyncWriter).
+            cache: cache hash and state dict of the input file in-process, such that repeated instantiation of the
+                same model file neither re-hashes nor re-reads it (memory-mapped where supported)
+
+        """
 
         self.warmstart_file = pathlib.Path(input_file) if input_file is not None else None
         self.output_file = pathlib.Path(output_file) if output_file is not None else None
@@ -38,6 +116,9 @@ class LoadSaveModel:
         self.better_th = better_th
         self.max_files = max_files if ((max_files is not None) or (max_files != -1)) else float('inf')
         self.state_dict_update = state_dict_update
+        self.asynchronous = asynchronous
+        self._writer = AsyncWriter() if asynchronous else None
+        self.cache = cache
 
     def _create_target_folder(self):
         """
@@ -70,11 +151,16 @@ class LoadSaveModel:
             print('Model initialised as specified in the constructor.')
 
         else:
-            hashv = hash_model(self.warmstart_file)
+            hashv = hash_model_cached(self.warmstart_file) if self.cache else hash_model(self.warmstart_file)
             print(f'Model SHA-1 hash: {hashv}')
             model.hash = hashv
 
-            state_dict = torch.load(self.warmstart_file, map_location=device)
+            if self.cache:
+                # shallow copy because the cached dict is shared, load_state_dict copies the tensors anyway
+                state_dict = copy.copy(load_state_dict_cached(self.warmstart_file))
+            else:
+                state_dict = torch.load(self.warmstart_file, map_location=device)
+
             if self.state_dict_update is not None:
                 state_dict.update(self.state_dict_update)
 
@@ -115,7 +201,19 @@ class LoadSaveModel:
 
         """Determine file name and save."""
         fname = pathlib.Path(str(self.output_file.with_suffix('')) + '_' + str(self.output_file_suffix) + '.pt')
-        torch.save(model.state_dict(), fname)
-        print('Saved model to file: {}'.format(fname))
+
+        def write(state_dict):
+            atomic_save(state_dict, fname)
+            print('Saved model to file: {}'.format(fname))
+
+        if self._writer is not None:
+            self._writer.submit(write, state_to_cpu(model.state_dict()))
+        else:
+            write(model.state_dict())
 
         self._last_saved = time.time()
+
+    def wait(self):
+        """Wait for the background saves (in flight and queued) to finish."""
+        if self._writer is not None:
+            self._writer.wait()
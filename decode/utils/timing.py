@@ -0,0 +1,99 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Sequence, Union
+
+import numpy as np
+import torch
+
+
+class StageTimer:
+    def __init__(self, cuda_sync: bool = False, trace: bool = False):
+        """
+        Lightweight wall-clock timer for the stages of a loop (e.g. data, forward, backward of the training loop).
+        Durations are collected per stage name and can be summarised as percentiles and exported as Chrome trace.
+
+        Example:
+            >>> timer = StageTimer()
+            >>> with timer.stage('forward'):
+            >>>     y = model(x)
+
+        Args:
+            cuda_sync: synchronize cuda before start and end of each stage. Without, asynchronous cuda kernels are
+                attributed to the stage that waits for them, but syncing slows down the loop.
+            trace: keep the individual events for export as Chrome trace
+
+        """
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.trace = trace
+
+        self._durations = defaultdict(list)
+        self._events = []
+        self._t_origin = time.perf_counter()
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+    def record(self, name: str, t_start: float, t_end: float):
+        """
+        Record a stage by its start and end time (as by time.perf_counter), e.g. for stages that can not be wrapped in
+        a context such as the wait for the next batch of a dataloader.
+
+        """
+        self._durations[name].append(t_end - t_start)
+
+        if self.trace:
+            self._events.append((name, t_start, t_end, threading.get_ident()))
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Context that records its duration under the stage name."""
+        self._sync()
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self.record(name, t_start, time.perf_counter())
+
+    @property
+    def durations(self) -> Dict[str, list]:
+        """Recorded durations (in s) per stage."""
+        return dict(self._durations)
+
+    def percentiles(self, q: Sequence[int] = (50, 90, 99)) -> Dict[str, float]:
+        """
+        Percentiles and total of the durations (in s) per stage.
+
+        Returns:
+            dict with keys <stage>/p<q> and <stage>/total
+
+        """
+        out = {}
+        for name, dur in self._durations.items():
+            for q_, v in zip(q, np.percentile(dur, q)):
+                out[f"{name}/p{q_}"] = float(v)
+            out[f"{name}/total"] = float(np.sum(dur))
+
+        return out
+
+    def reset(self):
+        self._durations.clear()
+        self._events.clear()
+
+    def dump_chrome_trace(self, path: Union[str, Path]):
+        """Writes the recorded events in Chrome trace format (open in chrome://tracing or https://ui.perfetto.dev)."""
+        if not self.trace:
+            raise ValueError("Timer was not set up to trace events.")
+
+        events = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                   'ts': (t_start - self._t_origin) * 1e6, 'dur': (t_end - t_start) * 1e6}
+                  for name, t_start, t_end, tid in self._events]
+
+        with Path(path).open('w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)